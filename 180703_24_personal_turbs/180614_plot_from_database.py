@@ -1,7 +1,27 @@
-import sqlite3
+#!python3
+'''
+Plot turbidostat ODs and lagoon luminescence from a measurements database, one figure per
+vessel, rendered in parallel worker processes.
+
+    py 180614_plot_from_database.py --db 180703_24_personal_turbs.db [--deck deck_0] [--window_hours 48]
+    py 180614_plot_from_database.py --db 180703_24_personal_turbs.db --live --refresh 600
+
+With --live the database is polled every --refresh seconds; only rows added since the last
+poll are read, each vessel's series is kept between polls, and only vessels with new points
+are redrawn. A database several decks share needs --deck, since their vessel numbers overlap.
+'''
+import os, sys, time, argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg') # workers draw straight to files
 import matplotlib.pyplot as plt
-from datetime import datetime
-import sys
+
+basic_pace_mod_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'basic_pace')
+if basic_pace_mod_path not in sys.path:
+    sys.path.append(basic_pace_mod_path)
+from meas_store import MeasurementStore
+from live_series import SeriesCache
+from turb_control import abs_to_od
 '''
 from importlib import import_module
 method_module = import_module('180518_personal_turbs_shaker_mods')
@@ -13,53 +33,75 @@ if '--controller' in sys.argv:
     plt.show()
     exit()
 '''
-number_of_turb = 3
-
-conn = sqlite3.connect('180518_personal_turbs_shaker_mods.db')
-c = conn.cursor()
+plot_types = {'turbidostat': ('abs', 'r.-', (0.0, 2.0), 'OD'), # data type, style, y limits, y label
+              'lagoon': ('lum', 'b.-', (0.0, 250.0), 'luminescence')}
 
-
-for plot_type in ['lagoon', 'turbidostat']:    
+def render_vessel(path, title, hours, values, style, ylim, ylabel):
     scale = 0.8
-    fig1 = plt.figure(figsize=(30*scale, 6*scale))
-    for turb in range(number_of_turb):
-        # set up plot
-        ax = fig1.add_subplot(1, number_of_turb, turb+1)
-        ax.set_title(plot_type + str(turb), x=0.5, y=0.8)
+    fig = plt.figure(figsize=(6*scale, 4*scale))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_title(title, x=0.5, y=0.8)
+    ax.plot(hours, values, style)
+    ax.set_ylim(*ylim)
+    ax.set_xlabel('hours')
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.savefig(path + '.tmp.png', dpi=100)
+    plt.close(fig)
+    os.replace(path + '.tmp.png', path) # a viewer never sees a half-written figure
+    return path
+
+def render_updated(pool, caches, updated, out_dir, num_points, start_time):
+    jobs = []
+    for plot_type, cache in caches.items():
+        data_type, style, ylim, ylabel = plot_types[plot_type]
+        for vessel in sorted(updated[plot_type]):
+            times, readings = cache.visible(vessel, num_points)
+            values = abs_to_od(readings) if plot_type == 'turbidostat' else readings
+            path = os.path.join(out_dir, plot_type + '_' + str(vessel) + '.png')
+            jobs.append(pool.submit(render_vessel, path, plot_type + str(vessel), (times - start_time)/3600,
+                    values, style, ylim, ylabel))
+    return [job.result() for job in jobs]
 
-        if plot_type == 'turbidostat':    
-            n = (turb, 'abs', )
-            c.execute('SELECT filename, well, reading FROM measurements WHERE turb_number=? AND data_type=?', n)
-        else:
-            n = (turb, 'lum', )
-            c.execute('SELECT filename, well, reading FROM measurements WHERE lagoon_number=? AND data_type=?', n)
-       
-        x = c.fetchall()
-        print(len(x), "entries fetched")
-        vals = [(datetime.strptime(f[-15:-4], '%y%m%d_%H%M'), w, v) for (f, w, v) in x]
-        vals = [(t, w, v) for t, w, v in vals if t > datetime(2018, 4, 27, 0, 0)]
-        
-        
-        if plot_type == 'turbidostat':   
-            plt.plot([j for (j, _, _) in vals], [4.171943074*abs - .1075750317 for (_, _, abs) in vals], 'r.-') # OD conversion formula
-            plt.ylim(0.0, 2.0)
-        else:
-            plt.plot([j for (j, _, _) in vals], [lum for (j, _, lum) in vals])
-            plt.ylim(0.0, 250.0)
-            
-        # decrease number of plotted X axis labels
-        # make there be fewer labels so that you can read them
-        times = [x for (x, _, _) in vals]
-        deltas = [t - times[0] for t in times]
-        labels = [int(d.seconds/60/60 + d.days*24) for d in deltas]
-        labels_sparse = [labels[x] if x % 12 == 0 else '' for x in range(len(labels))]
-        plt.xticks(times, labels_sparse)
-        locs, labels = plt.xticks()
+def main():
+    parser = argparse.ArgumentParser(description='Plot vessel measurements from a measurements database')
+    parser.add_argument('--db', default='180703_24_personal_turbs.db')
+    parser.add_argument('--deck', help='only this deck, for databases several decks share')
+    parser.add_argument('--out_dir', default='plots')
+    parser.add_argument('--window_hours', type=float, help='only plot this many hours before the latest reading')
+    parser.add_argument('--points', type=int, default=1000, help='points drawn per vessel, by LTTB downsampling')
+    parser.add_argument('--live', action='store_true', help='keep polling for new rows and redrawing')
+    parser.add_argument('--refresh', type=float, default=600, help='seconds between polls with --live')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
 
-    
-    fig1.tight_layout()
-    plt.savefig('5_21_' + plot_type + '_plot.png', dpi = 200)
+    if not os.path.exists(args.out_dir):
+        os.mkdir(args.out_dir)
+    store = MeasurementStore(args.db) # migrates old databases in place
+    decks = store.decks()
+    if args.deck is None and len(decks) > 1:
+        store.close()
+        parser.error('the database holds readings from decks ' + ', '.join(str(deck) for deck in decks) +
+                ', whose vessel numbers overlap; pick one with --deck')
+    window = None if args.window_hours is None else args.window_hours*3600
+    caches = {plot_type: SeriesCache(store, plot_type, data_type, args.deck, window, max_points=args.points*2)
+              for plot_type, (data_type, _, _, _) in plot_types.items()}
+    start_time = None
+    try:
+        with ProcessPoolExecutor(args.workers) as pool:
+            while True:
+                updated = {plot_type: cache.refresh() for plot_type, cache in caches.items()}
+                if start_time is None:
+                    firsts = [times[0] for cache in caches.values() for times, _ in cache.series.values() if len(times)]
+                    start_time = min(firsts) if firsts else None
+                if start_time is not None:
+                    paths = render_updated(pool, caches, updated, args.out_dir, args.points, start_time)
+                    print(len(paths), 'figures updated in', args.out_dir)
+                if not args.live:
+                    break
+                time.sleep(args.refresh)
+    finally:
+        store.close()
 
-# We can also close the connection if we are done with it.
-# Just be sure any changes have been committed or they will be lost.
-conn.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
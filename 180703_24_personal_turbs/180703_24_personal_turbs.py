@@ -1,6 +1,6 @@
 #!python3
 
-import sys, os, time, logging, sqlite3, types
+import sys, os, time, logging, types, json
 
 this_file_dir = os.path.dirname(__file__)
 package_dir = os.path.abspath(os.path.join(this_file_dir, '..'))
@@ -15,85 +15,90 @@ from basic_pace_180705x import (
     HamiltonInterface, ClarioStar, LBPumps, Shaker, PlateData,
     initialize, hepa_on, tip_pick_up, tip_eject, aspirate, dispense, wash_empty_refill,
     tip_pick_up_96, tip_eject_96, aspirate_96, dispense_96,
-    resource_list_with_prefix, read_plate,
-    run_async, yield_in_chunks, log_banner)
-
-def ensure_meas_table_exists(db_conn):
+    resource_list_with_prefix, move_plate, pipelined,
+    yield_in_chunks, log_banner)
+from auxshaker import make_transport, ShakerController
+from meas_store import MeasurementStore
+from ingest import IngestionWorker
+from scheduler import Scheduler, COALESCE
+from command_plan import compile_plan
+from digital_twin import DeckTwin, log_twin_report
+from tracing import tracer, traced, span, instrument
+from checkpoint import Checkpoint
+from log_pipeline import start_logging, stop_logging
+from metrics import registry, time_calls, reader_protocol_seconds, set_deck
+from executor import DeviceLocks, DeckExecutor, bind_device_locks, hold_calls
+from step_graph import StepGraph, log_graph_report
+from layout_index import layout_index
+from reader_alloc import ReaderPlateAllocator, ReadRequest, combined_protocols, demultiplex
+from transfer_plan import Transfer, plan_transfers, run_plan
+from wash_station import WashStation, WashChamber
+from turb_control import (flow_rate_controller, abs_to_od, acceptable_od,
+    controller_strategies, PlateController)
+
+default_layfile = os.path.join(this_file_dir, '180703_24_personal_turbs.lay')
+reader_file_timeout = 300 # s a read's result file may take to appear before that read is given up on
+parse_timeout = reader_file_timeout + 60 # s to wait on a read's parsed data, so a stuck ingestion can't hold the deck's locks forever
+
+def deck_options(argv):
+    '''Command line flags, shared by this script and the multi-deck orchestrator.'''
+    opts = types.SimpleNamespace()
+    opts.no_equilibribus = '--no_equilibribus' in argv
+    opts.disable_pumps = '--no_pumps' in argv
+    opts.simulation_on = '--simulate' in argv
+    opts.twin_on = '--twin' in argv # discrete-event digital twin on a virtual clock, no hardware at all
+    opts.trace_on = '--trace' in argv # span timeline of every step, written to the log directory at exit
+    opts.separate_reads = '--separate_reads' in argv # one reader trip per service, as before reads were combined
+    opts.resume = '--resume' in argv # carry on from the last checkpoint instead of starting over
+    opts.multi_dispense = '--multi_dispense' in argv # let turbidostats share dilution tips: fewer channel trips
+    opts.twin_hours = 72
+    opts.controller_name = 'bangbang' # or 'pi', 'model'; see turb_control.py
+    opts.metrics_port = None # serve live metrics at http://localhost:<port>/metrics
+    opts.db_path = None # measurement database; see meas_db_path
+    opts.log_dir = os.path.join(this_file_dir, 'log')
+    for arg in argv:
+        if arg.startswith('--twin_hours='):
+            opts.twin_hours = float(arg.split('=', 1)[1])
+        if arg.startswith('--controller='):
+            opts.controller_name = arg.split('=', 1)[1]
+        if arg.startswith('--metrics_port='):
+            opts.metrics_port = int(arg.split('=', 1)[1])
+        if arg.startswith('--db='):
+            opts.db_path = arg.split('=', 1)[1]
+        if arg.startswith('--log_dir='):
+            opts.log_dir = arg.split('=', 1)[1]
+    if opts.controller_name not in controller_strategies:
+        raise ValueError('Unknown controller ' + repr(opts.controller_name) + '; expected one of ' +
+                ', '.join(sorted(controller_strategies)))
+    return opts
+
+def meas_db_path(opts):
+    if opts.db_path is not None:
+        return opts.db_path
+    return os.path.join(this_file_dir, __file__.split('.')[0] + ('_twin.db' if opts.twin_on else '.db'))
+
+def open_meas_store(db_path):
+    store = MeasurementStore(db_path) # only ingestion workers write, already off the critical path
+    instrument(store, ['_write_rows'], 'db')
+    time_calls(store, ['_write_rows'], 'db')
+    return store
+
+def run_deck(opts, store, log_dir, deck_name=None, layfile=default_layfile, ingest_watch_dir=reader_results_dir,
+        shaker_config=None, hamilton_config=None, pumps_config=None, reader_config=None, seed=0):
     '''
-    Definitions of the fields in this table:
-    Exactly one of the following should have a value:
-        lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
-        turb_number - the number of a turbidostat, uniquely identifying the culture contained
-    filename - absolute path to the file in which this data is housed
-    plate_id - ID field given when measurement was requested, should match ID in data file
-    timestamp - time at which the measurement was taken
-    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
-    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
-                            measurement was taken. For migration, we consider this to be 0
-                            minutes in the absense of pipetting time values
-    reading - the raw measured value from the plate reader
-    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
+    Set up one deck from its layout file and run its service schedule until stopped, or for
+    opts.twin_hours in twin mode. Everything the deck owns (layout, device handles, device
+    locks, schedule, reader plates, controller) lives in this call, so several decks can run
+    side by side in threads or processes while sharing one measurement store. The deck's
+    state is checkpointed in log_dir after every step; with --resume it carries on from
+    there. hamilton_config, pumps_config and reader_config are keyword arguments for this
+    deck's HamiltonInterface (e.g. address, port), LBPumps (putty_session,
+    remote_script_dir) and ClarioStar. Returns the schedule stats, and in twin mode the
+    twin's device report.
     '''
-    c = db_conn.cursor()
-    c.execute('''CREATE TABLE if not exists measurements
-                (lagoon_number, turb_number, filename, plate_id, timestamp, well, measurement_delay_time, reading, data_type)''')
-    db_conn.commit()
-
-def db_add_plate_data(plate_data, data_type, plate, vessel_numbers, read_wells, vessel_type):
-    db_conn = sqlite3.connect(os.path.join(this_file_dir, __file__.split('.')[0] + '.db'))
-    ensure_meas_table_exists(db_conn)
-    c = db_conn.cursor()
-    for vessel_number, read_well in zip(vessel_numbers, read_wells):
-        filename = plate_data.path
-        plate_id = plate_data.header.plate_ids[0]
-        timestamp = plate_data.header.time
-        well = plate.position_id(read_well)
-        measurement_delay_time = 0.0
-        reading = plate_data.value_at(*plate.well_coords(read_well))
-        if vessel_type == 'turbidostat':
-            turb_number = vessel_number
-            lagoon_number = None
-        elif vessel_type == 'lagoon':
-            turb_number = None
-            lagoon_number = vessel_number
-        else:
-            raise ValueError("Only vessel types are 'turbidostat' and 'lagoon'")
-        data = (lagoon_number, turb_number, filename, plate_id, timestamp, well, measurement_delay_time, 
-                 reading, data_type)
-        c.execute("INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?,?)", data)
-    db_conn.commit()
-    db_conn.close()
-
-def flow_rate_controller(od, target_od=.45, margin=.05):
-    max_od = .7
-    min_od = .2
-    max_flow_through = 3.8
-    decrease_rate = 3.8
-    increase_rate = 1.5
-    if od > max_od:
-        return max_flow_through
-    elif od > target_od + margin:
-        return decrease_rate
-    elif od < min_od:
-        return 0
-    elif od < target_od - margin:
-        return increase_rate
-    else:
-        return (increase_rate + decrease_rate)/2
-
-def abs_to_od(absorbance):
-    return 4.171943074*absorbance - .1075750317 # best fit line
-
-def acceptable_od(od):
-    return od > .2
-
-if __name__ == '__main__':
-    local_log_dir = os.path.join(this_file_dir, 'log')
-    if not os.path.exists(local_log_dir):
-        os.mkdir(local_log_dir)
-    main_logfile = os.path.join(local_log_dir, 'main.log')
-    logging.basicConfig(filename=main_logfile, level=logging.DEBUG, format='[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    for banner_line in log_banner('Begin execution of ' + __file__):
+    deck_label = deck_name or __file__
+    set_deck(deck_name) # labels the metrics recorded on this thread and the tasks it starts
+    for banner_line in log_banner('Begin deck ' + deck_label):
         logging.info(banner_line)
 
     num_lagoons = 24
@@ -114,34 +119,48 @@ if __name__ == '__main__':
     fixed_lagoon_height = 19 # mm
     lagoon_fly_disp_height = fixed_lagoon_height + 15 # mm
     wash_vol = max_transfer_vol # uL
+    wash_chamber_vol = 200e3 # uL in each wash station chamber, which overflows to drain
+    min_bleach_strength = .5 # fraction of fresh bleach left once diluted by the waste dispensed into it
+    max_rinses = 6 # tip washes through the rinse water before it carries over too much bleach
+    max_wash_age = 12*3600 # s; hypochlorite breaks down standing in the chamber
     
     # shaker parameters
     shaker_vortex_rpm = 800
     shaker_normal_shake_rpm = 400
 
     sys_state = types.SimpleNamespace()
-    sys_state.done_equilibrating = False
+    sys_state.done_equilibrating = opts.no_equilibribus
+
+    disable_pumps = opts.disable_pumps
+    simulation_on = opts.simulation_on
+    twin_on = opts.twin_on
+    twin_hours = opts.twin_hours
+    separate_reads = opts.separate_reads
+    controller_name = opts.controller_name
+    ingestion = IngestionWorker(store, watch_dir=None if twin_on else ingest_watch_dir, # the twin's plate data never touches disk
+            file_timeout=reader_file_timeout, deck=deck_name)
 
-    layfile = os.path.join(this_file_dir, '180703_24_personal_turbs.lay')
     lmgr = LayoutManager(layfile)
+    layout = layout_index(lmgr, layfile) # cached beside the layfile, rebuilt whenever it changes
 
-    lagoon_plate = lmgr.assign_unused_resource(ResourceType(Plate96, 'lagoons'))
-    turb_plate = lmgr.assign_unused_resource(ResourceType(Plate96, 'turbidostats'))
+    lagoon_plate = layout.assign(Plate96, 'lagoons')
+    turb_plate = layout.assign(Plate96, 'turbidostats')
     reader_plates_tl = resource_list_with_prefix(lmgr, 'reader_tl_', Plate96, num_reader_plates)
     reader_plates_tr = resource_list_with_prefix(lmgr, 'reader_tr_', Plate96, num_reader_plates)
     reader_plates_bl = resource_list_with_prefix(lmgr, 'reader_bl_', Plate96, num_reader_plates)
     reader_plates_br = resource_list_with_prefix(lmgr, 'reader_br_', Plate96, num_reader_plates)
     reader_plates = list(zip(reader_plates_tl, reader_plates_tr, reader_plates_bl, reader_plates_br))
-    media_reservoir = lmgr.assign_unused_resource(ResourceType(Plate96, 'waffle'))
-    turb_tips = lmgr.assign_unused_resource(ResourceType(Tip96, 'turbidostat_tips'))
-    lagoon_tips = lmgr.assign_unused_resource(ResourceType(Tip96, 'lagoon_tips'))
-    turb_tip_corral = lmgr.assign_unused_resource(ResourceType(Tip96, 'turbidostat_dirty_tips'))
-    lagoon_tip_corral = lmgr.assign_unused_resource(ResourceType(Tip96, 'lagoon_dirty_tips')) 
-    reader_tray = lmgr.assign_unused_resource(ResourceType(Plate96, 'reader_tray'))
-    bleach_site = lmgr.assign_unused_resource(ResourceType(Tip96, 'RT300_HW_96WashDualChamber1_bleach'))
-    rinse_site = lmgr.assign_unused_resource(ResourceType(Tip96, 'RT300_HW_96WashDualChamber1_water'))
+    media_reservoir = layout.assign(Plate96, 'waffle')
+    turb_tips = layout.assign(Tip96, 'turbidostat_tips')
+    lagoon_tips = layout.assign(Tip96, 'lagoon_tips')
+    turb_tip_corral = layout.assign(Tip96, 'turbidostat_dirty_tips')
+    lagoon_tip_corral = layout.assign(Tip96, 'lagoon_dirty_tips') 
+    reader_tray = layout.assign(Plate96, 'reader_tray')
+    bleach_site = layout.assign(Tip96, 'RT300_HW_96WashDualChamber1_bleach')
+    rinse_site = layout.assign(Tip96, 'RT300_HW_96WashDualChamber1_water')
 
     dummy_24_plate = Plate24('')
+    excess_vol = max_transfer_vol*.8 # uL per vessel, aspirated off and dispensed into the bleach
 
     def idx_24_to_96(idx):
         col96, row96 = (c*2 for c in dummy_24_plate.well_coords(idx)) # upsample a 6x4 well plate to be accessed by a 12x8 template
@@ -153,24 +172,7 @@ if __name__ == '__main__':
     def corral_pos_for_lagoon(lagoon_idx):
         return lagoon_tip_corral, idx_24_to_96(lagoon_idx)
 
-    def reader_plate_poss_gen():
-        service_round = 0
-        reader_plate_idx = 0
-        offsets = [0, 8, 1, 9] # 96-indexed offsets to get cell and cells to right, bottom, and bottom-right
-        while reader_plate_idx < len(reader_plates_tl):
-            reader_plate_idx = service_round//4
-            yield (reader_plates_tl[reader_plate_idx],
-                reader_plates[reader_plate_idx][service_round%4],
-                [idx_24_to_96(lagoon_idx) + offsets[service_round%4] for lagoon_idx in lagoons])
-            service_round += 1
-
-    reader_plate_poss_gen = reader_plate_poss_gen() # singleton
-
-    def next_reader_plate_poss():
-        try:
-            return next(reader_plate_poss_gen)
-        except StopIteration:
-            return None
+    reader_allocator = ReaderPlateAllocator(reader_plates, recycle=twin_on) # the twin assumes used reader plates get swapped for fresh ones
 
     def turb_pos_for_lagoon(lagoon_idx): # reasonable for now because there is one personal turbidostat per lagoon
         return turb_plate, idx_24_to_96(lagoon_idx)
@@ -184,189 +186,413 @@ if __name__ == '__main__':
     def media_pos_for_lagoon(lagoon_idx):
         return media_reservoir, lagoon_idx%8 # aspirating from first column only for now
 
+    def refill_wash(ham_int):
+        logging.info('\n##### Refilling water and bleach.')
+        with span('wash_refill', 'head96'):
+            wash.refill(lambda: wash_empty_refill(ham_int, refillAfterEmpty=1,
+                    chamber1WashLiquid=1, # 1=liquid 2 (blue container) (water)
+                    chamber2WashLiquid=1)) # TODO: back to 0) # 0=Liquid 1 (red container) (bleach)
+
+    def bleach_mounted_tips_commands(ham_int, destination=None):
+        small_vol = 10
+        with pipelined(ham_int): # only the 96 head is involved, so no intermediate sync points
+            logging.info('\n##### Bleaching.')
+            aspirate_96(ham_int, bleach_site, small_vol, mixCycles=2, mixPosition=1, mixVolume=wash_vol, airTransportRetractDist=1)
+            dispense_96(ham_int, bleach_site, small_vol, dispenseMode=9, liquidHeight=10) # mode: blowout
+            logging.info('\n##### Rinsing.')
+            aspirate_96(ham_int, rinse_site, wash_vol, mixCycles=rinse_cycles, mixPosition=1, mixVolume=wash_vol, airTransportRetractDist=1)
+            dispense_96(ham_int, rinse_site, wash_vol, dispenseMode=9, liquidHeight=10) # mode: blowout
+            if destination:
+                tip_eject_96(ham_int, destination)
+
+    def compile_bleach_plan(destination):
+        return compile_plan('bleach tips, re-rack at ' + destination.layout_name(), bleach_mounted_tips_commands, destination)
+
+    bleach_plans = {tips: compile_bleach_plan(tips) for tips in (turb_tips, lagoon_tips)} # replayed every cycle
+
+    # Where each set of tips is, by rack layout name or 'mounted' on the 96 head, for recovery after a crash
+    home_racks = {'turbidostat': turb_tips, 'lagoon': lagoon_tips}
+    tip_set_homed_at = {rack: tip_set for tip_set, rack in home_racks.items()}
+    tip_racks = {rack.layout_name(): rack for rack in (turb_tips, lagoon_tips, turb_tip_corral, lagoon_tip_corral)}
+    sys_state.tips = {tip_set: rack.layout_name() for tip_set, rack in home_racks.items()}
+    sys_state.cycle = None # scheduled tasks the current service cycle is for, and its steps done so far
+
+    def tips_at(tip_set, rack=None):
+        sys_state.tips[tip_set] = 'mounted' if rack is None else rack.layout_name()
+
+    @traced('service')
     def bleach_mounted_tips(ham_int, destination=None):
         logging.info('\n##### Bleaching currently mounted tips and depositing at ' + destination.layout_name())
-        small_vol = 10
-        logging.info('\n##### Refilling water and bleach.')
-        wash_empty_refill(ham_int, refillAfterEmpty=1,
-                                   chamber1WashLiquid=1, # 1=liquid 2 (blue container) (water)
-                                   chamber2WashLiquid=1) # TODO: back to 0) # 0=Liquid 1 (red container) (bleach)
-        logging.info('\n##### Bleaching.')
-        aspirate_96(ham_int, bleach_site, small_vol, mixCycles=2, mixPosition=1, mixVolume=wash_vol, airTransportRetractDist=1)
-        dispense_96(ham_int, bleach_site, small_vol, dispenseMode=9, liquidHeight=10) # mode: blowout
-        logging.info('\n##### Rinsing.')
-        aspirate_96(ham_int, rinse_site, wash_vol, mixCycles=rinse_cycles, mixPosition=1, mixVolume=wash_vol, airTransportRetractDist=1)
-        dispense_96(ham_int, rinse_site, wash_vol, dispenseMode=9, liquidHeight=10) # mode: blowout
-        if destination:
-            tip_eject_96(ham_int, destination)
+        if destination not in bleach_plans:
+            bleach_plans[destination] = compile_bleach_plan(destination)
+        if wash.needs_refill({'bleach': (1, 0.0), 'rinse': (1, 0.0)}): # not refilled ahead of time, so now
+            refill_wash(ham_int)
+        bleach_plans[destination].replay(ham_int)
+        wash.wash('bleach', 'rinse')
+        if destination in tip_set_homed_at:
+            tips_at(tip_set_homed_at[destination], destination)
         logging.info('\n##### Done bleaching tips.')
 
-    def absorbance_at(read_idx, abs_platedata, reader_plate):
-        return abs_platedata.value_at(*reader_plate.well_coords(read_idx))
-
-    def controller_replace_vol(lagoon, read_idx, abs_platedata, reader_plate): # convenience method, messy args but avoids a messy loop
-        absorbance = absorbance_at(read_idx, abs_platedata, reader_plate)
-        od = abs_to_od(absorbance)
-        flow_rate_set = flow_rate_controller(od)
-        logging.info('Turb for lagoon ' + str(lagoon) + ': Plate ' + reader_plate.layout_name() +
-                ', well ' + reader_plate.position_id(read_idx) + ', absorbance ' + str(absorbance) +
-                ', OD ' + str(od) + ', flow rate setting ' + str(flow_rate_set))
-        return flow_rate_set*turb_vol/turb_cycles_per_hour
+    turb_controller = PlateController(controller_strategies[controller_name](), lagoons, turb_vol, turb_cycles_per_hour)
+
+    checkpoint = Checkpoint(os.path.join(log_dir, ('' if deck_name is None else deck_name + '_') +
+            ('twin_' if twin_on else '') + 'checkpoint.json'))
+    checkpoint.track('equilibrium', lambda: {'done_equilibrating': sys_state.done_equilibrating})
+    checkpoint.track('tips', lambda: dict(sys_state.tips))
+    checkpoint.track('cycle', lambda: None if sys_state.cycle is None else
+            {'tasks': list(sys_state.cycle['tasks']), 'done_steps': list(sys_state.cycle['done_steps'])})
+    checkpoint.track('reader_plates', reader_allocator.state)
+    checkpoint.track('controller', turb_controller.state)
+    saved = checkpoint.load() if opts.resume else None
+    if opts.resume and saved is None:
+        logging.warning('Nothing to resume from at ' + checkpoint.path + '; starting over')
+    if saved is not None:
+        sys_state.done_equilibrating = sys_state.done_equilibrating or saved['equilibrium']['done_equilibrating']
+        sys_state.tips.update(saved['tips'])
+        reader_allocator.restore(saved['reader_plates']) # never reuse wells that were already filled
+        try:
+            turb_controller.restore(saved['controller'])
+        except ValueError as e:
+            logging.warning('Controller state not restored: ' + str(e))
 
     def reader_plate_id(reader_plate):
-        return __file__ + ' plate ' + str(reader_plates_tl.index(reader_plate))
-
-    turb_shaker = Shaker()
-
-    def service_turbidostats(ham_int, pump_int, reader_int):
-        logging.info('\n##### ---------------- Servicing turbidostats ----------------')
-        
+        return deck_label + ' plate ' + str(reader_plates_tl.index(reader_plate))
+
+    if twin_on:
+        reader_sites = {}
+        for plate_quadrants in reader_plates:
+            for site, offset in zip(plate_quadrants, reader_allocator.offsets):
+                reader_sites[site.layout_name()] = (plate_quadrants[0].layout_name(), offset)
+        twin = DeckTwin(vessel_plates={turb_plate.layout_name(): 'turbidostat', lagoon_plate.layout_name(): 'lagoon'},
+                vessel_wells=[idx_24_to_96(l) for l in lagoons], reader_sites=reader_sites,
+                reader_tray_name=reader_tray.layout_name(), working_vol=turb_vol,
+                abs_from_od=lambda od: (od + .1075750317)/4.171943074, seed=seed) # inverse of abs_to_od
+        clock, sleep = twin.clock.time, twin.clock.sleep
+    else:
+        clock, sleep = time.time, time.sleep
+
+    wash = WashStation([WashChamber('bleach', wash_chamber_vol, min_strength=min_bleach_strength, max_age=max_wash_age),
+                        WashChamber('rinse', wash_chamber_vol, max_uses=max_rinses, max_age=max_wash_age)], clock)
+    checkpoint.track('wash', wash.state)
+    if saved is not None and 'wash' in saved:
+        wash.restore(saved['wash'])
+
+    deck_locks = DeviceLocks()
+    deck_executor = DeckExecutor(deck_locks)
+    shaker_device = twin.shaker() if twin_on else Shaker(make_transport(shaker_config) if shaker_config else None)
+    instrument(shaker_device, ['start', 'stop'], 'shaker') # only the commands that actually go out
+    time_calls(shaker_device, ['start', 'stop'], 'shaker')
+    hold_calls(shaker_device, ['start', 'stop'], deck_locks, 'shaker')
+    # the controller's own lock is the device lock, so a step holding the shaker and a
+    # lease being taken elsewhere can't each wait on the other's lock
+    turb_shaker = ShakerController(shaker_device, shaker_normal_shake_rpm, lock=deck_locks.lock('shaker'))
+    if opts.trace_on and not tracer.enabled: # several decks tracing together keep the tracer's clock
+        tracer.enable(clock)
+    if twin_on and registry.clock is time.time: # likewise several decks in one process keep the first one's
+        registry.clock = clock
+
+    def sample_turbidostats(ham_int, quadrant):
         logging.info('\n##### ----- Turbidostats ' + ', '.join((str(l) for l in lagoons)) + ' -----')
 
         logging.info('\n##### Sampling liquid from turbidostats into reader plates.')
         tip_pick_up_96(ham_int, turb_tips)
-        turb_shaker.stop()
-        aspirate_96(ham_int, turb_plate, read_sample_vol, liquidFollowing=1, liquidHeight=(fixed_turb_height - 3))
-        turb_shaker.start(shaker_normal_shake_rpm)
-        reader_plate, reader_plate_site, well_idxs = next_reader_plate_poss()
-        dispense_96(ham_int, reader_plate_site, read_sample_vol, liquidHeight=5, dispenseMode=9) # mode: blowout
+        tips_at('turbidostat')
+        with turb_shaker.still():
+            aspirate_96(ham_int, turb_plate, read_sample_vol, liquidFollowing=1, liquidHeight=(fixed_turb_height - 3))
+        dispense_96(ham_int, quadrant.site, read_sample_vol, liquidHeight=5, dispenseMode=9) # mode: blowout
         # TODO tip_eject_96(ham_int, turb_tip_corral) # need to eject tips before read
-        media_fill_thread = run_async(lambda:(
-            logging.info('\n##### Asynchronously bleaching LB reservoir.'),
-            pump_int.bleach_clean(),
-            logging.info('\n##### Asynchronously refilling LB reservoir.'),
-            pump_int.refill(media_supply_vol))) # clean and refill media sequentially, asynchronously
-        def async_bleach():
-            # TODO tip_pick_up_96(ham_int, turb_tip_corral)
-            bleach_mounted_tips(ham_int, destination=turb_tips)
-        abs_platedata, = read_plate(ham_int, reader_int, reader_tray, reader_plate, ['17_8_12_abs'],
-                plate_id=reader_plate_id(reader_plate), async_task=async_bleach) # meanwhile, asynchronously bleach
-        if simulation_on:
-            abs_platedata = PlateData(os.path.join(reader_results_dir, '17_8_12_abs_180426_1910.csv')) # sim dummy
-        abs_platedata.wait_for_file()
-        db_add_plate_data(abs_platedata, 'abs', reader_plate, vessel_numbers=lagoons, read_wells=well_idxs, vessel_type='turbidostat')
+        return ReadRequest('turbidostats', quadrant, ['17_8_12_abs'], ['abs'], 'turbidostat', lagoons,
+                quadrant.wells(idx_24_to_96(l) for l in lagoons))
+
+    def dilute_turbidostats(ham_int, read_request):
+        with span('wait_for_abs', 'reader'):
+            abs_platedata = read_request.parsed['abs'].result(parse_timeout)
+        reader_plate = read_request.quadrant.plate
+        well_idxs = read_request.wells
 
         ## Perform turbidostat dilution liquid transfers
         logging.info('\n##### Moving fresh LB into turbidostats.')
-        all_ods_acceptable = True
-        for batch in yield_in_chunks(zip(lagoons, well_idxs), 8):
-            lagoon_batch, idx_batch = zip(*batch)
-            batch_tips = [turb_tip_pos_for_lagoon(l) for l in lagoon_batch]
-            batch_turbs = [turb_pos_for_lagoon(l) for l in lagoon_batch]
-            batch_media_poss = [media_pos_for_lagoon(l) for l in lagoon_batch]
-            batch_corral_poss = [turb_corral_pos_for_lagoon(l) for l in lagoon_batch]
-            replace_vols = [controller_replace_vol(l, well_idx, abs_platedata, reader_plate) for l, well_idx in zip(lagoon_batch, idx_batch)]
-            tip_pick_up(ham_int, batch_tips)
-            add_vols = [max(read_sample_vol*2, v) for v in replace_vols] # make sure there's more than enough liquid to read next time
-            media_fill_thread.join() # make sure media is there
-            aspirate(ham_int, batch_media_poss, add_vols, liquidHeight=1)
-            turb_shaker.stop()
-            dispense(ham_int, batch_turbs, add_vols, liquidHeight=fly_disp_height, dispenseMode=9) # mode: blowout
-            turb_shaker.start(shaker_normal_shake_rpm)
-            tip_eject(ham_int, batch_corral_poss)
-            all_ods_acceptable = all_ods_acceptable and all((acceptable_od(abs_to_od(absorbance_at(well_idx, abs_platedata, reader_plate)))
-                                                                                                                for well_idx in idx_batch))
+        control = turb_controller.evaluate(abs_platedata, reader_plate, well_idxs) # every vessel in one pass
+        for l, well_idx, absorbance, od, flow_rate_set in zip(lagoons, well_idxs, control.absorbances, control.ods, control.flow_rates):
+            logging.info('Turb for lagoon ' + str(l) + ': Plate ' + reader_plate.layout_name() +
+                    ', well ' + reader_plate.position_id(well_idx) + ', absorbance ' + str(absorbance) +
+                    ', OD ' + str(od) + ', flow rate setting ' + str(flow_rate_set))
+        all_add_vols = {l: float(max(read_sample_vol*2, v)) for l, v in zip(lagoons, control.replace_vols)} # make sure there's more than enough liquid to read next time
+        all_ods_acceptable = bool(control.acceptable.all())
+        transfers = [Transfer(l, turb_tip_pos_for_lagoon(l), media_pos_for_lagoon(l), turb_pos_for_lagoon(l),
+                turb_corral_pos_for_lagoon(l), all_add_vols[l]) for l in lagoons]
+        plan = plan_transfers(transfers, tip_capacity=max_transfer_vol, shared_tips=opts.multi_dispense)
+        logging.info('Dilution transfer plan ' + plan.describe())
+        plan_start = clock()
+        with turb_shaker.still(): # one stop and start for the whole plan rather than one per dispense
+            run_plan(ham_int, plan, aspirate_options={'liquidHeight': 1},
+                    dispense_options={'liquidHeight': fly_disp_height, 'dispenseMode': 9}, # mode: blowout
+                    partial_dispense_options={'liquidHeight': fly_disp_height, 'dispenseMode': 0}) # mode: jet, part volume
+        logging.info('Dilution took ' + '{:.0f}'.format(clock() - plan_start) + ' s, predicted ' +
+                '{:.0f}'.format(plan.predicted_duration) + ' s')
+        tips_at('turbidostat', turb_tip_corral if plan.tips_returned else turb_tips) # shared tips go back where they came from
         if not sys_state.done_equilibrating and all_ods_acceptable:
             logging.info('\n##### >>>>>>>>>> Turbidostats have equilibrated! <<<<<<<<<<')
             sys_state.done_equilibrating = True # latch True for remainder of experiment
 
+    def remove_turbidostat_excess(ham_int):
         logging.info('\n##### Removing liquid from turbidostats down to constant volume.')
-        tip_pick_up_96(ham_int, turb_tip_corral)
-        turb_shaker.stop()
-        excess_vol = max_transfer_vol*.8
-        aspirate_96(ham_int, turb_plate, excess_vol, liquidHeight=fixed_turb_height)
-        vortex_thread = run_async(lambda:(
-            turb_shaker.start(shaker_vortex_rpm),
-            time.sleep(3.5),
-            turb_shaker.start(shaker_normal_shake_rpm)))
-        dispense_96(ham_int, bleach_site, excess_vol, liquidHeight=10, dispenseMode=9) # mode: blowout
+        tip_pick_up_96(ham_int, tip_racks[sys_state.tips['turbidostat']]) # the corral, unless the dilution shared tips
+        tips_at('turbidostat')
+        with turb_shaker.still(then=shaker_vortex_rpm): # straight into the vortex afterwards
+            aspirate_96(ham_int, turb_plate, excess_vol, liquidHeight=fixed_turb_height)
+
+    def vortex_turbidostats():
+        turb_shaker.start(shaker_vortex_rpm)
+        sleep(3.5)
+        turb_shaker.start(shaker_normal_shake_rpm)
 
+    def discard_turbidostat_excess(ham_int):
+        dispense_96(ham_int, bleach_site, excess_vol, liquidHeight=10, dispenseMode=9) # mode: blowout
+        wash.add_waste('bleach', excess_vol*96)
         logging.info('\n##### Bleaching tips and re-racking.')
         bleach_mounted_tips(ham_int, destination=turb_tips)
 
-        vortex_thread.join()
-        logging.info('\n##### ------------- Done servicing turbidostats -------------\n')
-
-    def service_lagoons(ham_int, pump_int, reader_int):
-        if not sys_state.done_equilibrating:
-            logging.info('\n\n##### ------ Not yet equilibrated, lagoons not serviced ------\n')
-            return
-        logging.info('\n\n##### ------------------ Servicing lagoons ------------------')
-
+    def sample_lagoons(ham_int, quadrant):
         logging.info('\n##### Moving fresh bacteria into lagoons.')
         tip_pick_up_96(ham_int, lagoon_tips)
-        turb_shaker.stop()
-        aspirate_96(ham_int, turb_plate, cycle_replace_vol, liquidHeight=4)
-        turb_shaker.start(shaker_normal_shake_rpm)
+        tips_at('lagoon')
+        with turb_shaker.still():
+            aspirate_96(ham_int, turb_plate, cycle_replace_vol, liquidHeight=4)
         dispense_96(ham_int, lagoon_plate, cycle_replace_vol,liquidHeight=lagoon_fly_disp_height, dispenseMode=9) # mode: blowout
 
         logging.info('\n##### Removing liquid from lagoons to reader plates')
-        aspirate_96(ham_int, lagoon_plate, read_sample_vol, mixCycles=2, mixPosition=2,
-                mixVolume=500, liquidFollowing=1, liquidHeight=fixed_lagoon_height-3)
-        excess_vol = max_transfer_vol*.8
-        reader_plate, reader_plate_site, well_idxs = next_reader_plate_poss()
-        dispense_96(ham_int, reader_plate_site, read_sample_vol, liquidHeight=5, dispenseMode=9) # mode: blowout
-        aspirate_96(ham_int, lagoon_plate, excess_vol, liquidHeight=fixed_lagoon_height)
-        dispense_96(ham_int, bleach_site, excess_vol, liquidHeight=10, dispenseMode=9) # mode: blowout
+        with pipelined(ham_int):
+            aspirate_96(ham_int, lagoon_plate, read_sample_vol, mixCycles=2, mixPosition=2,
+                    mixVolume=500, liquidFollowing=1, liquidHeight=fixed_lagoon_height-3)
+            dispense_96(ham_int, quadrant.site, read_sample_vol, liquidHeight=5, dispenseMode=9) # mode: blowout
+            aspirate_96(ham_int, lagoon_plate, excess_vol, liquidHeight=fixed_lagoon_height)
+            dispense_96(ham_int, bleach_site, excess_vol, liquidHeight=10, dispenseMode=9) # mode: blowout
+        wash.add_waste('bleach', excess_vol*96)
         # TODO tip_eject_96(ham_int, lagoon_tip_corral) # need to eject tips before read
-        plate_id = reader_plate_id(reader_plate)
-        protocols = ['17_8_12_lum', '17_8_12_abs']
-        data_types = ['lum', 'abs']
-        def async_bleach():
-            # TODO tip_pick_up_96(ham_int, lagoon_tip_corral)
-            bleach_mounted_tips(ham_int, destination=lagoon_tips)
-        platedatas = read_plate(ham_int, reader_int, reader_tray, reader_plate, protocols, plate_id, async_task=async_bleach) # meanwhile, asynchronously bleach
-        if simulation_on:
-            platedatas = [PlateData(os.path.join(reader_results_dir, '17_8_12_abs_180426_1910.csv'))]*2 # sim dummies
-        for platedata, data_type in zip(platedatas, data_types):
-            platedata.wait_for_file()
-            db_add_plate_data(platedata, data_type, reader_plate, lagoons, well_idxs, 'lagoon')
-        reader_int.plate_in(block=False)
-        logging.info('\n##### --------------- Done servicing lagoons ---------------\n')
-
-    disable_pumps = '--no_pumps' in sys.argv
-    simulation_on = '--simulate' in sys.argv
-    sys_state.done_equilibrating = '--no_equilibribus' in sys.argv
-
-    def times_at_intervals(interval):
-        target_time = time.time()
-        while True:
-            yield target_time
-            target_time += 1 if simulation_on else interval
-
-    schedule_items = [ # tuples (function to schedule, monotonic absolute time generator)
-        (service_lagoons, times_at_intervals(generation_time)),
-        (service_turbidostats, times_at_intervals(3600/turb_cycles_per_hour))
-        ]
-
-    with HamiltonInterface(simulate=simulation_on) as ham_int, LBPumps() as pump_int, ClarioStar() as reader_int:
+        return ReadRequest('lagoons', quadrant, ['17_8_12_lum', '17_8_12_abs'], ['lum', 'abs'], 'lagoon', lagoons,
+                quadrant.wells(idx_24_to_96(l) for l in lagoons))
+
+    deck_arms = ('iswap', 'head96', 'channels') # the iSWAP rides the channel arm, and plate moves stay clear of the 96 head
+
+    @traced('service')
+    def service_reader_cycle(ham_int, pump_int, reader_int, do_turbidostats=True, do_lagoons=False):
+        '''
+        Sample every due service into quadrants of one reader plate, take it to the reader
+        once for the union of their protocols, and hand each service back its own wells.
+        The cycle runs as a step graph, so the media refill, tip bleaching, plate moves
+        and reader tray overlap wherever their devices and dependencies allow.
+        '''
+        if do_lagoons and not sys_state.done_equilibrating:
+            logging.info('\n\n##### ------ Not yet equilibrated, lagoons not serviced ------\n')
+            do_lagoons = False
+        if not (do_turbidostats or do_lagoons):
+            return
+        service_names = [name for name, due in (('turbidostats', do_turbidostats), ('lagoons', do_lagoons)) if due]
+        logging.info('\n##### ---------------- Servicing ' + ' and '.join(service_names) + ' ----------------')
+        quadrants = reader_allocator.allocate(len(service_names))
+        sys_state.cycle = {'tasks': ['service_' + name for name in service_names], 'done_steps': []}
+        checkpoint.save() # the quadrants are spoken for from here on, even if this cycle dies
+        reader_plate = quadrants[0].plate
+        reads = {}
+        bleach_during_read = [] # (rack to pick the tips back up from or None if mounted, rack to bleach them into)
+        def cycle_step_done(step_name):
+            sys_state.cycle['done_steps'].append(step_name)
+            checkpoint.save()
+        graph = StepGraph(('' if deck_name is None else deck_name + ': ') + ' and '.join(service_names))
+
+        def sample_step(name, sample, quadrant):
+            def go():
+                reads[name] = sample(ham_int, quadrant)
+            return go
+        last_sample = []
+        if do_lagoons:
+            last_sample = [graph.add('sample_lagoons', sample_step('lagoons', sample_lagoons, quadrants.pop(0)),
+                    ('head96', 'shaker'))]
+            if do_turbidostats: # park the lagoon tips so the turbidostat tips can sample too
+                def park_lagoon_tips():
+                    tip_eject_96(ham_int, lagoon_tip_corral)
+                    tips_at('lagoon', lagoon_tip_corral)
+                last_sample = [graph.add('park_lagoon_tips', park_lagoon_tips, ('head96',), after=last_sample)]
+                bleach_during_read.append((lagoon_tip_corral, lagoon_tips))
+            else:
+                bleach_during_read.append((None, lagoon_tips))
+        if do_turbidostats:
+            last_sample = [graph.add('sample_turbidostats', sample_step('turbidostats', sample_turbidostats, quadrants.pop(0)),
+                    ('head96', 'shaker'), after=last_sample)]
+            bleach_during_read.insert(0, (None, turb_tips))
+            graph.add('refresh_media', lambda: pump_int.bleach_clean().then(pump_int.refill, media_supply_vol).result(),
+                    ('pumps',))
+
+        def plate_to_reader():
+            reader_int.plate_out(block=False)
+            move_plate(ham_int, reader_plate, reader_tray)
+        graph.add('plate_to_reader', plate_to_reader, deck_arms + ('reader',), after=last_sample)
+
+        read_names = [name for name in ('lagoons', 'turbidostats') if name in service_names]
+        def read():
+            requests = [reads[name] for name in read_names]
+            protocols = combined_protocols(requests)
+            logging.info('Running plate protocols ' + ', '.join(protocols) + ' on plate ' + reader_plate.layout_name())
+            with span('run_protocols', 'reader', protocols=', '.join(protocols)), \
+                    reader_protocol_seconds.time(deck=deck_name or '', protocols=', '.join(protocols)):
+                platedatas = reader_int.run_protocols(protocols, plate_id_1=reader_plate_id(reader_plate))
+            reader_int.plate_out(block=False)
+            if simulation_on:
+                platedatas = [PlateData(os.path.join(reader_results_dir, '17_8_12_abs_180426_1910.csv'))]*len(protocols) # sim dummies
+            demultiplex(requests, protocols, platedatas)
+            entries, slots = [], []
+            for request in requests:
+                for data_type, platedata in request.results.items():
+                    entries.append((platedata, data_type, reader_plate, request.vessels, request.wells, request.vessel_type))
+                    slots.append((request, data_type))
+            for (request, data_type), parsed in zip(slots, ingestion.submit_read(entries)):
+                request.parsed[data_type] = parsed # only the turbidostat absorbances are ever waited on
+        graph.add('read', read, ('reader',), after=['plate_to_reader'])
+
+        def bleach_tips():
+            for pick_up_from, destination in bleach_during_read:
+                if pick_up_from is not None:
+                    tip_pick_up_96(ham_int, pick_up_from)
+                    tips_at(tip_set_homed_at[destination])
+                bleach_mounted_tips(ham_int, destination=destination)
+        washes = len(bleach_during_read) + do_turbidostats # the turbidostat tips get bleached again after discarding
+        cycle_wash_load = {'bleach': (washes, excess_vol*96*(do_turbidostats + do_lagoons)), 'rinse': (washes, 0.0)}
+        bleach_after = ['plate_to_reader']
+        if wash.needs_refill(cycle_wash_load): # refill while the reader is busy rather than mid-bleach
+            bleach_after = [graph.add('refill_wash', lambda: refill_wash(ham_int), ('head96',), after=['plate_to_reader'])]
+        graph.add('bleach_tips', bleach_tips, ('head96',), after=bleach_after)
+        graph.add('plate_from_reader', lambda: move_plate(ham_int, reader_tray, reader_plate), deck_arms,
+                after=['read', 'bleach_tips'])
+
+        if do_turbidostats:
+            graph.add('dilute_turbidostats', lambda: dilute_turbidostats(ham_int, reads['turbidostats']),
+                    ('channels', 'shaker'), after=['read', 'refresh_media', 'bleach_tips']) # needs the re-racked tips
+            graph.add('remove_turbidostat_excess', lambda: remove_turbidostat_excess(ham_int), ('head96', 'shaker'),
+                    after=['dilute_turbidostats'])
+            graph.add('vortex_turbidostats', vortex_turbidostats, ('shaker',), after=['remove_turbidostat_excess'])
+            graph.add('discard_turbidostat_excess', lambda: discard_turbidostat_excess(ham_int), ('head96',),
+                    after=['remove_turbidostat_excess'])
+        if do_lagoons:
+            graph.add('reader_plate_in', lambda: reader_int.plate_in(block=False), ('reader',),
+                    after=['read', 'plate_from_reader'])
+
+        try:
+            graph.run(deck_executor, clock=clock, set_thread_time=twin.clock.set_thread_time if twin_on else None,
+                    on_step_done=cycle_step_done)
+        finally:
+            log_graph_report(graph.report())
+        logging.info('\n##### ------------- Done servicing ' + ' and '.join(service_names) + ' -------------\n')
+
+    def service_turbidostats(ham_int, pump_int, reader_int):
+        service_reader_cycle(ham_int, pump_int, reader_int, do_turbidostats=True)
+
+    def service_lagoons(ham_int, pump_int, reader_int):
+        service_reader_cycle(ham_int, pump_int, reader_int, do_turbidostats=False, do_lagoons=True)
+
+    def service_due(task_names, ham_int, pump_int, reader_int):
+        service_reader_cycle(ham_int, pump_int, reader_int, do_turbidostats='service_turbidostats' in task_names,
+                do_lagoons='service_lagoons' in task_names)
+
+    def schedule_interval(interval):
+        return 1 if simulation_on else interval
+
+    service_steps = {'service_turbidostats': 'dilute_turbidostats', 'service_lagoons': 'sample_lagoons'} # the step that does each task's work
+
+    def resume(scheduler, ham_int):
+        '''Put the schedule and the tips back the way the last checkpoint left them.'''
+        deadlines = dict(saved['scheduler']['deadlines'])
+        cycle = saved['cycle']
+        if cycle is not None:
+            logging.info('Resuming after a cycle for ' + ', '.join(cycle['tasks']) + ' that got through ' +
+                    (', '.join(cycle['done_steps']) or 'no steps'))
+            for task_name in cycle['tasks']:
+                if service_steps[task_name] in cycle['done_steps']: # don't do it twice
+                    deadlines[task_name] += scheduler.tasks[task_name].interval
+        scheduler.restore({'deadlines': deadlines})
+        for tip_set, location in sorted(sys_state.tips.items(), key=lambda item: item[1] != 'mounted'):
+            home = home_racks[tip_set]
+            if location == home.layout_name():
+                continue
+            logging.info('\n##### Returning ' + tip_set + ' tips from ' + location + ' to ' + home.layout_name())
+            if location != 'mounted':
+                tip_pick_up_96(ham_int, tip_racks[location])
+            bleach_mounted_tips(ham_int, destination=home)
+
+    if twin_on:
+        devices = twin.hamilton(), twin.pumps(), twin.reader()
+    else:
+        devices = (HamiltonInterface(simulate=simulation_on, **(hamilton_config or {})), LBPumps(**(pumps_config or {})),
+                   ClarioStar(**(reader_config or {})))
+
+    with devices[0] as ham_int, devices[1] as pump_int, devices[2] as reader_int:
+        bind_device_locks(ham_int, deck_locks)
+        instrument(pump_int, ['bleach_clean', 'refill', 'prime'], 'pump')
+        time_calls(pump_int, ['bleach_clean', 'refill', 'prime'], 'pump')
+        hold_calls(pump_int, ['bleach_clean', 'refill', 'prime', 'empty', 'refill_rinse'], deck_locks, 'pumps')
         if disable_pumps or simulation_on:
             pump_int.disable()
         if simulation_on:
             reader_int.disable()
             turb_shaker.disable()
-        ham_int.set_log_dir(os.path.join(local_log_dir, 'hamilton.log'))
-        init_cmd = initialize(ham_int, async=True)
-        turb_shaker.start(400)
+        ham_int.set_log_dir(os.path.join(log_dir, 'hamilton.log' if deck_name is None else deck_name + '_hamilton.log'))
+        init_cmd = initialize(ham_int, async_=True)
+        turb_shaker.start(shaker_normal_shake_rpm)
         logging.info('\n##### Priming pump lines.')
-        pump_int.prime()
+        prime_job = pump_int.prime()
         ham_int.wait_on_response(init_cmd, raise_first_exception=True)
+        prime_job.result()
         hepa_on(ham_int, simulate=int(simulation_on))
 
-        start_time = time.time()
-        next_times = {}
-        while True:
-            for task_num, (scheduled_func, interval_gen) in enumerate(schedule_items):
-                if task_num not in next_times:
-                    next_times[task_num] = next(interval_gen)
-                next_time = next_times[task_num]
-                if time.time() - next_time >= 0:
-                    scheduled_func(ham_int, pump_int, reader_int)
-                    try:
-                        next_times[task_num] = next(interval_gen)
-                    except StopIteration:
-                        break
-            else:
-                time.sleep(.2)
-                continue
-            break
+        scheduler = Scheduler(clock, sleep, deck=deck_name)
+        service_args = (ham_int, pump_int, reader_int)
+        scheduler.add('service_lagoons', service_lagoons, schedule_interval(generation_time), COALESCE, args=service_args)
+        scheduler.add('service_turbidostats', service_turbidostats, schedule_interval(3600/turb_cycles_per_hour),
+                COALESCE, args=service_args)
+        if not separate_reads:
+            scheduler.combine('reader_cycle', ['service_turbidostats', 'service_lagoons'], service_due,
+                    window=schedule_interval(3600/turb_cycles_per_hour)/2) # lagoons ride along with a turbidostat read
+        checkpoint.track('scheduler', scheduler.state)
+        if saved is not None:
+            resume(scheduler, ham_int)
+        checkpoint.save()
+        try:
+            scheduler.run(until=clock() + twin_hours*3600 if twin_on else None)
+        finally:
+            for task_name, task_stats in scheduler.stats().items():
+                logging.info('Schedule stats for ' + deck_label + ' ' + task_name + ': ' + str(task_stats))
+            report = {'deck': deck_label, 'tasks': scheduler.stats()}
+            if twin_on:
+                report = twin.report(scheduler)
+                report['deck'] = deck_label
+            report['wash'] = wash.stats()
+            report['shaker'] = turb_shaker.stats()
+            logging.info('Wash station for ' + deck_label + ': ' + str(report['wash']))
+            if twin_on:
+                log_twin_report(report)
+            ingestion.close() # let the ingestion worker drain before returning
+            turb_shaker.close()
+    return report
+
+if __name__ == '__main__':
+    opts = deck_options(sys.argv)
+    local_log_dir = opts.log_dir
+    if not os.path.exists(local_log_dir):
+        os.mkdir(local_log_dir)
+    main_logfile = os.path.join(local_log_dir, 'main.log')
+    start_logging(main_logfile) # also main.jsonl; both rotate and are written on their own thread
+    for banner_line in log_banner('Begin execution of ' + __file__):
+        logging.info(banner_line)
+
+    if opts.metrics_port is not None:
+        registry.serve(opts.metrics_port)
+    store = open_meas_store(meas_db_path(opts))
+    try:
+        report = run_deck(opts, store, local_log_dir)
+    finally:
+        store.close()
+        if opts.trace_on:
+            tracer.write_chrome_trace(os.path.join(local_log_dir, 'trace.json'))
+            tracer.write_sqlite(os.path.join(local_log_dir, 'trace.db'))
+    if opts.twin_on:
+        print(json.dumps(report, indent=2))
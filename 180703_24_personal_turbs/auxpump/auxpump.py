@@ -1,27 +1,54 @@
 import os, logging
 from auxpump import PACKAGE_PATH, CONFIG
-from .remote import remote_exec
-_REMOTE_SCRIPT_DIR = CONFIG['remote_script_dir']
-_REMOTE_RUN_SCRIPT = os.path.join(_REMOTE_SCRIPT_DIR, CONFIG['run_script'])
-_REMOTE_ABORT_SCRIPT = os.path.join(_REMOTE_SCRIPT_DIR, CONFIG['abort_script'])
+from .remote import remote_exec, RemoteSession
+from .jobs import PumpJobQueue, finished_job
+
+default_job_timeout = 900 # s; no pump action takes near this long, so a job that does has hung
 
 class NetworkDeckPumps:
-    def __init__(self, disable=False):
+    '''
+    Pump actions are queued and run in order over one persistent remote session. Every
+    action returns a PumpJob future immediately, so callers only wait (job.result()) at
+    the point where the pumped liquid is actually needed. putty_session and remote_script_dir
+    pick the pump host, for decks that each have their own; both default to config.json.
+    '''
+
+    def __init__(self, disable=False, job_timeout=None, putty_session=None, remote_script_dir=None):
         self.pump_bat_path = os.path.join(os.path.dirname(PACKAGE_PATH), 'auxpump_bat')
         self.disabled = disable
+        self.job_timeout = job_timeout if job_timeout is not None else CONFIG.get('job_timeout', default_job_timeout)
+        self.putty_session = putty_session or CONFIG['putty_session']
+        script_dir = remote_script_dir or CONFIG['remote_script_dir']
+        self.run_script = os.path.join(script_dir, CONFIG['run_script'])
+        self.abort_script = os.path.join(script_dir, CONFIG['abort_script'])
+        self._session = None
+        self._jobs = PumpJobQueue()
+
+    def _exec(self, remote_cmd_tup, timeout):
+        if self._session is None:
+            self._session = RemoteSession(self.putty_session)
+        self._session.run(*remote_cmd_tup, timeout=timeout)
 
-    def _run(self, run_cmd, *run_args):
-        remote_cmd_tup = ('python', _REMOTE_RUN_SCRIPT, run_cmd, *run_args)
+    def _run(self, run_cmd, *run_args, after=None, timeout=None):
+        remote_cmd_tup = ('python', self.run_script, run_cmd, *run_args)
+        description = run_cmd + (' ' + ' '.join(run_args) if run_args else '')
         if self.disabled: 
             logging.info(str(remote_cmd_tup) + ' would be executed remotely here')
-            return
-        logging.info('Running deck pump action "' + run_cmd + '" with ' + 
+            return finished_job(description)
+        logging.info('Queueing deck pump action "' + run_cmd + '" with ' + 
                 ('args ' + ', '.join(run_args) if run_args else 'no args'))
-        remote_exec(*remote_cmd_tup)
+        timeout = self.job_timeout if timeout is None else timeout
+        return self._jobs.submit(description, self._exec, remote_cmd_tup, timeout, after=after)
 
-    def _run_direct(self, pump_ids_to_vols):
+    def _run_direct(self, pump_ids_to_vols, **job_opts):
         # make sure is wrapped in quotes so that it will be interpreted as one string argument
-        self._run('direct_cmd', repr(str(pump_ids_to_vols)))
+        return self._run('direct_cmd', repr(str(pump_ids_to_vols)), **job_opts)
+
+    def pending_jobs(self):
+        return self._jobs.jobs()
+
+    def cancel_pending(self):
+        return self._jobs.cancel_pending()
 
     def disable(self):
         self.disabled = True
@@ -33,4 +60,8 @@ class NetworkDeckPumps:
         return self
 
     def __exit__(self, *args):
-        remote_exec('.', _REMOTE_ABORT_SCRIPT) # '.' for source
+        self._jobs.cancel_pending()
+        remote_exec('.', self.abort_script, putty_session=self.putty_session) # '.' for source
+        self._jobs.shutdown(timeout=10)
+        if self._session is not None:
+            self._session.close()
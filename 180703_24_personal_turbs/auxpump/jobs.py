@@ -0,0 +1,100 @@
+import logging
+from collections import deque
+from concurrent.futures import Future, CancelledError
+from threading import Thread, Condition
+
+class PumpJob(Future):
+    '''
+    Future for one queued pump action. result() waits for it (optionally with a timeout)
+    and re-raises whatever the action raised.
+    '''
+
+    def __init__(self, description, queue=None):
+        super().__init__()
+        self.description = description
+        self._queue = queue
+
+    def status(self):
+        if self.cancelled():
+            return 'cancelled'
+        if self.running():
+            return 'running'
+        if not self.done():
+            return 'queued'
+        return 'failed' if self.exception() is not None else 'done'
+
+    def then(self, pump_method, *args, **kwargs):
+        '''Queue pump_method to run only once this job has succeeded, e.g. job.then(pumps.refill, 5.0)'''
+        return pump_method(*args, after=self, **kwargs)
+
+    def __repr__(self):
+        return '<PumpJob ' + self.description + ' ' + self.status() + '>'
+
+def finished_job(description, result=None):
+    job = PumpJob(description)
+    job.set_running_or_notify_cancel()
+    job.set_result(result)
+    return job
+
+class PumpJobQueue:
+    '''
+    Runs pump actions one at a time, in submission order, on a worker thread. A job
+    submitted with after=<job> fails without running if that job failed or was cancelled.
+    '''
+
+    def __init__(self):
+        self._pending = deque()
+        self._cond = Condition()
+        self._worker = None
+        self._shutdown = False
+
+    def submit(self, description, func, *args, after=None):
+        job = PumpJob(description, self)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('Pump job queue has been shut down')
+            self._pending.append((job, func, args, after))
+            if self._worker is None:
+                self._worker = Thread(target=self._work, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._shutdown:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                job, func, args, after = self._pending.popleft()
+            if not job.set_running_or_notify_cancel():
+                continue
+            try:
+                if after is not None:
+                    if after.cancelled():
+                        raise CancelledError('Prerequisite ' + after.description + ' was cancelled')
+                    after.result() # re-raises the prerequisite's failure
+                job.set_result(func(*args))
+            except BaseException as e:
+                logging.error('Pump job ' + job.description + ' failed: ' + repr(e))
+                job.set_exception(e)
+
+    def cancel_pending(self):
+        with self._cond:
+            pending = list(self._pending)
+        return [job for job, _, _, _ in pending if job.cancel()]
+
+    def jobs(self):
+        with self._cond:
+            return [job for job, _, _, _ in self._pending]
+
+    def shutdown(self, cancel_pending=True, timeout=None):
+        if cancel_pending:
+            self.cancel_pending()
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
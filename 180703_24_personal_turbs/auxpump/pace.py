@@ -2,34 +2,34 @@ from .auxpump import NetworkDeckPumps
 
 class OffDeckCulturePumps(NetworkDeckPumps):
 
-    def clean_reservoir(self):
-        self._run('clean')
+    def clean_reservoir(self, **job_opts):
+        return self._run('clean', **job_opts)
 
-    def prime_reservoir(self):
-        self._run('prime')
+    def prime_reservoir(self, **job_opts):
+        return self._run('prime', **job_opts)
 
-    def fresh_reservoir(self):
-        self._run('fresh')
+    def fresh_reservoir(self, **job_opts):
+        return self._run('fresh', **job_opts)
 
-    def refill_water_rinse(self):
-        self._run('refill_rinse')
+    def refill_water_rinse(self, **job_opts):
+        return self._run('refill_rinse', **job_opts)
 
 class PACEDeckPumps(OffDeckCulturePumps):
     pass # Backward compatibility
 
 class LBPumps(NetworkDeckPumps):
 
-    def bleach_clean(self):
-        self._run('clean')
+    def bleach_clean(self, **job_opts):
+        return self._run('clean', **job_opts)
 
-    def prime(self):
-        self._run('prime')
+    def prime(self, **job_opts):
+        return self._run('prime', **job_opts)
 
-    def refill(self, vol=4.0): # mL
-        self._run('fresh', str(vol))
+    def refill(self, vol=4.0, **job_opts): # mL
+        return self._run('fresh', str(vol), **job_opts)
 
-    def empty(self, vol=6.0):
-        self._run('empty', str(vol))
+    def empty(self, vol=6.0, **job_opts):
+        return self._run('empty', str(vol), **job_opts)
 
-    def refill_rinse(self): # TODO: Probably remove
-        self._run('refill_rinse')
+    def refill_rinse(self, **job_opts): # TODO: Probably remove
+        return self._run('refill_rinse', **job_opts)
@@ -1,7 +1,9 @@
-import os
+import os, time, itertools, subprocess
+from threading import Thread, Lock
+from queue import Queue, Empty
 from auxpump import TEMP_PATH, CONFIG
 
-def remote_exec(cmd, *args):
+def remote_exec(cmd, *args, putty_session=None):
     temp_ver = 0
     fname = None
     while fname is None or fname in os.listdir(TEMP_PATH):
@@ -12,10 +14,90 @@ def remote_exec(cmd, *args):
         cmd = ' '.join([cmd] + [str(a) for a in args])
         with open(fname, 'w+') as temp_sh:
             temp_sh.write(cmd)
-        os.system('plink ' + CONFIG['putty_session'] + ' -m ' + fname)
+        os.system('plink ' + (putty_session or CONFIG['putty_session']) + ' -m ' + fname)
     finally:
         try:
             os.remove(fname)
         except FileNotFoundError:
             pass
 
+
+class RemoteCommandError(IOError):
+    pass
+
+class RemoteSession:
+    '''
+    One plink SSH session kept open and reused for every remote command, instead of a
+    plink process and temp script per command. Each command is followed by an echo of a
+    unique marker and the command's exit status, on a line of its own even when the
+    command's output doesn't end in a newline, which is how completion is detected.
+    '''
+
+    def __init__(self, putty_session=None):
+        self.putty_session = putty_session or CONFIG['putty_session']
+        self._proc = None
+        self._lines = None
+        self._lock = Lock()
+        self._markers = itertools.count()
+
+    def _open(self):
+        self._proc = subprocess.Popen(['plink', '-batch', '-T', self.putty_session],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, bufsize=1)
+        self._lines = Queue()
+        def pump_lines(stdout, lines):
+            for line in stdout:
+                lines.put(line)
+            lines.put(None) # EOF
+        Thread(target=pump_lines, args=(self._proc.stdout, self._lines), daemon=True).start()
+
+    def is_open(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def run(self, cmd, *args, timeout=None):
+        with self._lock:
+            if not self.is_open():
+                self._open()
+            marker = '__auxpump_done_' + str(next(self._markers)) + '__'
+            cmd = ' '.join([cmd] + [str(a) for a in args])
+            self._proc.stdin.write(cmd + '; status=$?; echo; echo ' + marker + ' $status\n')
+            self._proc.stdin.flush()
+            deadline = None if timeout is None else time.time() + timeout
+            output = []
+            while True:
+                try:
+                    line = self._lines.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+                except Empty:
+                    self._close()
+                    raise TimeoutError('Remote command timed out after ' + str(timeout) + ' s: ' + cmd)
+                if line is None:
+                    self._close()
+                    raise RemoteCommandError('Remote session closed while running: ' + cmd)
+                if line.startswith(marker):
+                    status = int(line.split()[1])
+                    break
+                output.append(line)
+            if output and output[-1] == '\n':
+                output.pop() # the newline echoed ahead of the marker
+            if status != 0:
+                raise RemoteCommandError('Remote command exited with status ' + str(status) + ': ' + cmd +
+                        '\n' + ''.join(output))
+            return ''.join(output)
+
+    def _close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+        self._proc = None
+
+    def close(self):
+        with self._lock:
+            self._close()
@@ -8,3 +8,5 @@ with open(join(PACKAGE_PATH, 'config.json')) as f:
     CONFIG = json.loads(f.read())
 
 from .bigbear import *
+from .transport import *
+from .controller import *
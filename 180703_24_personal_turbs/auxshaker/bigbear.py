@@ -1,22 +1,28 @@
 import os, json
 from auxshaker import CONFIG
-from .serial import send_serial
+from .transport import make_transport
 
 class Shaker:
     #TODO: Expose advanced features if needed.
-    
-    def __init__(self):
+
+    def __init__(self, transport=None):
         self.disabled = False
+        self.transport = transport # opened lazily so a disabled shaker never connects
+
+    def _send(self, cmd_str):
+        if self.transport is None:
+            self.transport = make_transport()
+        return self.transport.send(cmd_str)
 
     def start(self, rpm=350):
         if not 60 <= rpm <= 3570:
             raise ValueError('Speed setting for Big Bear HT-91108 Orbital Shaker not between 60 and 3570 RPM: ' + str(rpm))
         if not self.disabled:
-            send_serial(CONFIG['start_cmd'].format(str(int(rpm))))
+            self._send(CONFIG['start_cmd'].format(str(int(rpm))))
 
     def stop(self):
         if not self.disabled:
-            send_serial(CONFIG['stop_cmd'])
+            self._send(CONFIG['stop_cmd'])
 
     def disable(self):
         self.disabled = True
@@ -24,3 +30,6 @@ class Shaker:
     def enable(self):
         self.disabled = False
 
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
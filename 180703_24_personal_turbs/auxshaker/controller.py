@@ -0,0 +1,89 @@
+import logging
+from threading import RLock
+from contextlib import contextmanager
+
+class ShakerController:
+    '''
+    Keeps track of what the shaker is doing so only commands that change something get
+    sent. start() and stop() take the same arguments as Shaker's, but a start at the speed
+    it is already shaking at, or a stop while it is stopped, sends nothing. Pipetting holds
+    the shaker still with a still() lease, which may be held across several steps and by
+    several threads at once: the shaker stops when the first lease is taken and starts
+    again once the last is released, and start() calls made meanwhile only change the speed
+    it comes back at. One lock serializes every request, so threads never interleave
+    commands; pass lock to share one with others guarding the shaker, such as its deck
+    device lock.
+    '''
+
+    def __init__(self, shaker, rpm=400, lock=None):
+        self.shaker = shaker
+        self.default_rpm = rpm
+        self.wanted_rpm = 0 # what the shaker should do when nothing holds it still
+        self._rpm = None # what it was last told; None until the first command, so that one always goes
+        self._leases = 0
+        self._lock = RLock() if lock is None else lock
+        self.sent = 0
+        self.dropped = 0 # commands that would have changed nothing
+        self.deferred = 0 # starts made while held still, which only set the speed it comes back at
+
+    def _set(self, rpm):
+        if rpm == self._rpm:
+            self.dropped += 1
+            return
+        self._rpm = None # unknown if the command fails
+        if rpm:
+            self.shaker.start(rpm)
+        else:
+            self.shaker.stop()
+        self._rpm = rpm
+        self.sent += 1
+
+    def start(self, rpm=None):
+        with self._lock:
+            self.wanted_rpm = self.default_rpm if rpm is None else rpm
+            if self._leases:
+                self.deferred += 1 # comes back at this speed once the shaker is released
+            else:
+                self._set(self.wanted_rpm)
+
+    def stop(self):
+        with self._lock:
+            self.wanted_rpm = 0
+            self._set(0)
+
+    @contextmanager
+    def still(self, then=None):
+        '''
+        Hold the shaker still for the duration. then, if given, is the speed to come back
+        at instead of the last one asked for, e.g. going straight into a vortex.
+        '''
+        with self._lock:
+            self._set(0)
+            self._leases += 1 # only once it has stopped, so a failed stop leaves no lease behind
+        try:
+            yield
+        finally:
+            with self._lock:
+                if then is not None:
+                    self.wanted_rpm = then
+                self._leases -= 1
+                if not self._leases:
+                    self._set(self.wanted_rpm)
+
+    def rpm(self):
+        '''Speed the shaker was last told to run at; 0 when stopped, None before any command.'''
+        return self._rpm
+
+    def stats(self):
+        return {'sent': self.sent, 'dropped': self.dropped, 'deferred': self.deferred}
+
+    def disable(self):
+        self.shaker.disable()
+
+    def enable(self):
+        self.shaker.enable()
+
+    def close(self):
+        logging.info('Shaker controller sent ' + str(self.sent) + ' commands, dropped ' + str(self.dropped) +
+                ', deferred ' + str(self.deferred))
+        self.shaker.close()
@@ -0,0 +1,172 @@
+import time, logging, subprocess
+from collections import deque
+from threading import Lock
+from auxshaker import CONFIG
+from .serial import send_serial
+
+class PlinkBackend:
+    '''
+    One long-running plink attached to a saved PuTTY session (serial or SSH), with
+    commands streamed into its stdin instead of a new plink per command.
+    '''
+
+    def __init__(self, session):
+        self.session = session
+        self._proc = None
+
+    def open(self):
+        self._proc = subprocess.Popen(['plink', self.session], stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def is_open(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def write(self, data):
+        self._proc.stdin.write(data.encode())
+        self._proc.stdin.flush()
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+        self._proc = None
+
+class SerialDeviceBackend:
+    '''Local serial device or pty, opened directly with pyserial.'''
+
+    def __init__(self, port, baudrate=9600, timeout=1):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._dev = None
+
+    def open(self):
+        import serial # pyserial, only needed for this backend
+        self._dev = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+
+    def is_open(self):
+        return self._dev is not None and self._dev.is_open
+
+    def write(self, data):
+        self._dev.write(data.encode())
+        self._dev.flush()
+
+    def close(self):
+        if self._dev is not None:
+            self._dev.close()
+            self._dev = None
+
+class BatBackend:
+    '''The old temp file + plink_start_and_kill.bat route, one process per command.'''
+
+    def open(self):
+        pass
+
+    def is_open(self):
+        return True
+
+    def write(self, data):
+        send_serial(data)
+
+    def close(self):
+        pass
+
+class FakeBackend:
+    '''In-process stand-in for testing and simulation. Records everything written.'''
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+        self.opened = 0
+        self.fail_writes = 0 # fail this many upcoming writes, to exercise reconnection
+        self._open = False
+
+    def open(self):
+        self.opened += 1
+        self._open = True
+
+    def is_open(self):
+        return self._open
+
+    def write(self, data):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            self._open = False
+            raise OSError('FakeBackend: simulated broken connection')
+        if self.delay:
+            time.sleep(self.delay)
+        self.sent.append(data)
+
+    def close(self):
+        self._open = False
+
+class SerialTransport:
+    '''
+    Persistent command channel to a device. Connects on first use, reconnects and retries
+    when a write fails, and keeps how long recent commands took to write and flush. The
+    shaker sends nothing back, so that is not a round trip: a command counts as sent once
+    the backend has taken it.
+    '''
+
+    def __init__(self, backend, retries=2, history=100):
+        self.backend = backend
+        self.retries = retries
+        self.write_times = deque(maxlen=history)
+        self.reconnects = 0
+        self._lock = Lock()
+
+    def send(self, cmd_str):
+        with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    if not self.backend.is_open():
+                        if attempt:
+                            self.reconnects += 1
+                        self.backend.open()
+                    start_time = time.perf_counter()
+                    self.backend.write(cmd_str)
+                    write_time = time.perf_counter() - start_time
+                    self.write_times.append(write_time)
+                    return write_time
+                except OSError:
+                    logging.exception('SerialTransport: write failed on attempt ' + str(attempt + 1) + ', reconnecting')
+                    self.backend.close()
+            raise IOError('SerialTransport: could not send command after ' + str(self.retries + 1) + ' attempts')
+
+    def write_time_stats(self):
+        times = list(self.write_times)
+        if not times:
+            return {'count': 0, 'mean': None, 'max': None, 'last': None}
+        return {'count': len(times), 'mean': sum(times)/len(times), 'max': max(times), 'last': times[-1]}
+
+    def close(self):
+        with self._lock:
+            self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def make_transport(config=CONFIG):
+    backend_name = config.get('transport', 'plink')
+    if backend_name == 'plink':
+        backend = PlinkBackend(config['putty_session'])
+    elif backend_name == 'serial':
+        backend = SerialDeviceBackend(config['serial_port'], config.get('baudrate', 9600))
+    elif backend_name == 'bat':
+        backend = BatBackend()
+    elif backend_name == 'fake':
+        backend = FakeBackend()
+    else:
+        raise ValueError('Unknown shaker transport ' + repr(backend_name))
+    return SerialTransport(backend)
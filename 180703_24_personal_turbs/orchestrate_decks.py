@@ -0,0 +1,129 @@
+#!python3
+'''
+Run several decks from one process. Each deck gets its own layout, device handles, device
+locks and schedule; all of them write to one shared measurement database, tagged with the
+deck's name, and their schedule and device reports are gathered into one fleet report.
+
+    py orchestrate_decks.py --decks=decks.json [--processes] [deck flags, e.g. --twin --trace]
+    py orchestrate_decks.py --num_decks=4 --twin --twin_hours=24
+
+decks.json is a list of decks, each a name plus optional "layfile", "ingest_watch_dir",
+"shaker" (an auxshaker transport config), "hamilton" (HamiltonInterface arguments, e.g.
+address and port), "pumps" (LBPumps arguments: putty_session, remote_script_dir) and
+"reader" (ClarioStar arguments) entries. --num_decks=N runs N copies of the default layout
+instead, which only makes sense with --twin. Several real decks each need their own
+"hamilton", "pumps" and "reader" entries, or they would all drive the same instruments; the
+orchestrator refuses to start them otherwise. Decks run as threads by default; with
+--processes each runs in its own worker process, still sharing the database file.
+'''
+import sys, os, json, logging, importlib.util
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+this_file_dir = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(this_file_dir, '180703_24_personal_turbs.py')
+
+def load_turb_script():
+    spec = importlib.util.spec_from_file_location('personal_turbs', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module) # top level only; nothing under __main__ runs
+    return module
+
+def deck_configs(argv):
+    for arg in argv:
+        if arg.startswith('--decks='):
+            with open(arg.split('=', 1)[1]) as decks_file:
+                return json.load(decks_file)
+    num_decks = 1
+    for arg in argv:
+        if arg.startswith('--num_decks='):
+            num_decks = int(arg.split('=', 1)[1])
+    return [{'name': 'deck_' + str(i)} for i in range(num_decks)]
+
+def check_device_configs(configs, opts):
+    '''Real decks run together must each name their own robot, pump host and reader.'''
+    if opts.twin_on or len(configs) < 2:
+        return
+    for device in ('hamilton', 'pumps', 'reader'):
+        entries = [json.dumps(config.get(device), sort_keys=True) for config in configs]
+        if any(config.get(device) is None for config in configs) or len(set(entries)) != len(entries):
+            raise ValueError('Several decks without --twin need a different "' + device + '" entry for every deck ' +
+                    'in decks.json, or they would share one ' + device)
+
+def _run_one(turbs, opts, store, log_dir, deck_idx, config):
+    return turbs.run_deck(opts, store, log_dir, deck_name=config['name'],
+            layfile=config.get('layfile', turbs.default_layfile),
+            ingest_watch_dir=config.get('ingest_watch_dir', turbs.reader_results_dir),
+            shaker_config=config.get('shaker'), hamilton_config=config.get('hamilton'),
+            pumps_config=config.get('pumps'), reader_config=config.get('reader'), seed=deck_idx)
+
+def _run_in_process(argv, log_dir, deck_idx, config):
+    # worker process: its own copy of the script, its own handle on the shared database
+    turbs = load_turb_script()
+    turbs.start_logging(os.path.join(log_dir, config['name'] + '.log'))
+    opts = turbs.deck_options(argv)
+    if opts.metrics_port is not None:
+        turbs.registry.serve(opts.metrics_port + deck_idx) # each process has its own registry
+    store = turbs.open_meas_store(turbs.meas_db_path(opts))
+    try:
+        return _run_one(turbs, opts, store, log_dir, deck_idx, config)
+    finally:
+        store.close()
+        if opts.trace_on:
+            turbs.tracer.write_chrome_trace(os.path.join(log_dir, config['name'] + '_trace.json'))
+        turbs.registry.stop_serving()
+        turbs.stop_logging() # pool workers exit without running atexit hooks
+
+def fleet_report(reports):
+    '''Per-deck reports plus totals across the fleet.'''
+    totals = {'decks': len(reports), 'runs': 0, 'missed': 0}
+    device_hours = {}
+    for report in reports:
+        for task_stats in report['tasks'].values():
+            totals['runs'] += task_stats['runs']
+            totals['missed'] += task_stats['missed']
+        for device, device_stats in report.get('devices', {}).items():
+            device_hours[device] = device_hours.get(device, 0.0) + device_stats['busy_hours']
+    if device_hours:
+        totals['device_busy_hours'] = device_hours
+    return {'totals': totals, 'decks': {report['deck']: report for report in reports}}
+
+if __name__ == '__main__':
+    log_dir = os.path.join(this_file_dir, 'log')
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    turbs = load_turb_script()
+    turbs.start_logging(os.path.join(log_dir, 'orchestrator.log'),
+            fmt='[%(asctime)s] %(threadName)s %(levelname)s %(message)s')
+    opts = turbs.deck_options(sys.argv)
+    configs = deck_configs(sys.argv)
+    names = [config['name'] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError('Deck names must be unique: ' + ', '.join(names))
+    check_device_configs(configs, opts)
+    logging.info('Orchestrating decks ' + ', '.join(names))
+    if opts.metrics_port is not None and '--processes' not in sys.argv:
+        turbs.registry.serve(opts.metrics_port) # every deck's metrics, labelled by deck
+
+    if '--processes' in sys.argv:
+        with ProcessPoolExecutor(len(configs)) as pool:
+            futures = [pool.submit(_run_in_process, sys.argv, log_dir, i, config) for i, config in enumerate(configs)]
+            reports = [f.result() for f in futures]
+    else:
+        if opts.trace_on:
+            turbs.tracer.enable() # one wall clock for every deck's spans
+        store = turbs.open_meas_store(turbs.meas_db_path(opts))
+        try:
+            with ThreadPoolExecutor(len(configs), thread_name_prefix='deck') as pool:
+                futures = [pool.submit(_run_one, turbs, opts, store, log_dir, i, config) for i, config in enumerate(configs)]
+                reports = [f.result() for f in futures]
+        finally:
+            store.close()
+            if opts.trace_on:
+                turbs.tracer.write_chrome_trace(os.path.join(log_dir, 'fleet_trace.json'))
+                turbs.tracer.write_sqlite(os.path.join(log_dir, 'fleet_trace.db'))
+
+    report = fleet_report(reports)
+    logging.info('Fleet totals: ' + str(report['totals']))
+    with open(os.path.join(log_dir, 'fleet_report.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(json.dumps(report['totals'], indent=2))
@@ -0,0 +1,75 @@
+#!python3
+'''
+Replay recorded turbidostat ODs through a grid of flow-rate controller settings and
+OD calibrations, and rank them by how closely they would have held the target OD and
+how much media they would have used.
+
+    py replay_controllers.py --db 180703_24_personal_turbs.db --strategy bangbang
+            --grid target_od=.4,.45,.5 --grid margin=.03,.05,.08
+            --grid increase_rate=1,1.5,2 --grid decrease_rate=3,3.8 --slopes 4,4.17,4.35
+
+Growth rates come from the readings and the dilutions the recording controller would
+have asked for (--recorded_with, bangbang with its defaults unless told otherwise), so
+replays only say how cultures like the recorded ones would have fared.
+'''
+import os, sys, json, time, argparse
+
+basic_pace_mod_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'basic_pace')
+if basic_pace_mod_path not in sys.path:
+    sys.path.append(basic_pace_mod_path)
+from meas_store import MeasurementStore
+from controller_replay import (Dilution, load_trajectories, parameter_grid, replay_grid,
+    reference_slope, reference_intercept)
+
+def float_list(text):
+    return [float(value) for value in text.split(',')]
+
+def grid_arg(text):
+    name, values = text.split('=', 1)
+    return name, float_list(values)
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank turbidostat controller settings by replaying recorded ODs')
+    parser.add_argument('--db', default='180703_24_personal_turbs.db')
+    parser.add_argument('--deck', help='only this deck, for databases several decks share')
+    parser.add_argument('--start', type=float, help='epoch seconds; only readings from then on')
+    parser.add_argument('--end', type=float, help='epoch seconds; only readings before then')
+    parser.add_argument('--strategy', default='bangbang', help="controller to tune: 'bangbang', 'pi' or 'model'")
+    parser.add_argument('--grid', type=grid_arg, action='append', default=[],
+            help='name=v1,v2,... for one controller parameter; repeat for more')
+    parser.add_argument('--slopes', type=float_list, default=[reference_slope], help='abs_to_od slopes to try')
+    parser.add_argument('--intercepts', type=float_list, default=[reference_intercept], help='abs_to_od intercepts to try')
+    parser.add_argument('--recorded_with', default='bangbang', help='controller running when the data was recorded')
+    parser.add_argument('--desired_od', type=float, default=.45, help='OD the cultures should be held at')
+    parser.add_argument('--working_vol', type=float, default=1000, help='turbidostat volume, uL')
+    parser.add_argument('--cycles_per_hour', type=float, default=6, help='turbidostat readings per hour')
+    parser.add_argument('--min_add_vol', type=float, default=200,
+            help='least media added per reading, uL: twice the read sample volume in the service loop')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--top', type=int, default=20, help='how many of the best to print')
+    parser.add_argument('--out', help='write every ranked result here as JSON')
+    args = parser.parse_args()
+
+    dilution = Dilution(args.working_vol, args.cycles_per_hour, args.min_add_vol)
+    store = MeasurementStore(args.db)
+    try:
+        trajectories = load_trajectories(store, args.deck, start=args.start, end=args.end,
+                recorded_with=args.recorded_with, dilution=dilution)
+    finally:
+        store.close()
+    candidates = list(parameter_grid(args.strategy, args.slopes, args.intercepts, **dict(args.grid)))
+    print('Replaying', len(candidates), 'candidates over', len(trajectories.vessels), 'turbidostats,',
+            '{:.0f}'.format(trajectories.hours()), 'culture-hours')
+    start_time = time.time()
+    results = replay_grid(trajectories, candidates, args.workers, desired_od=args.desired_od, dilution=dilution)
+    print('Done in', '{:.1f}'.format(time.time() - start_time), 's')
+    print('{:>10} {:>12}  {}'.format('OD RMSE', 'mL/vessel/h', 'candidate'))
+    for result in results[:args.top]:
+        print('{:10.4f} {:12.3f}  {}{}'.format(result['tracking_error'], result['media_ml_per_vessel_hour'],
+                result['candidate'], '' if result['pareto'] else '  (dominated)'))
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 #!python3
 
 import sys, os, time, logging
-from threading import Thread
+from threading import local
+from collections import deque
+from contextlib import contextmanager
 
 package_dir = os.path.dirname(os.path.dirname(__file__))
 global_log_dir = os.path.join(package_dir, 'Monitoring', 'log')
+user_dir = os.path.expanduser('~') # holds .roboid, this robot's name
 
 from pyhamilton import (HamiltonInterface, LayoutManager, ResourceType, Plate24, Plate96, Tip96,
     INITIALIZE, PICKUP, EJECT, ASPIRATE, DISPENSE, ISWAP_GET, ISWAP_PLACE, HEPA,
@@ -13,67 +16,238 @@ from pyhamilton import (HamiltonInterface, LayoutManager, ResourceType, Plate24,
 from platereader.clariostar import ClarioStar, PlateData
 from auxpump.pace import OffDeckCulturePumps, LBPumps
 from auxshaker.bigbear import Shaker
+from tracing import traced, span
+from executor import executor, locks_for, uses
+from layout_index import layout_index
+from log_pipeline import Lazy, add_log_file
+from metrics import registry, command_seconds, reader_protocol_seconds, current_deck
 
 def resource_list_with_prefix(layout_manager, prefix, res_class, num_ress):
-    def name_from_line(line):
-        field = LayoutManager.layline_objid(line)
-        if field:
-            return field
-        return LayoutManager.layline_first_field(line)
-    layline_test = lambda line: LayoutManager.field_starts_with(name_from_line(line), prefix)
-    res_type = ResourceType(res_class, layline_test, name_from_line)
-    res_list = [layout_manager.assign_unused_resource(res_type) for _ in range(num_ress)]
+    res_list = layout_index(layout_manager).assign_with_prefix(prefix, res_class, num_ress)
     res_list.sort(key=lambda r: r.layout_name())
     return res_list
 
 def labware_pos_str(labware, idx):
     return labware.layout_name() + ', ' + labware.position_id(idx)
 
+# Position strings are rebuilt for the same plates and channel batches every service cycle,
+# so they are memoized. Keys include the layout name, so a renamed labware misses the cache;
+# call clear_position_cache() after loading a different layout.
+_pos_str_cache = {}
+
+def clear_position_cache():
+    _pos_str_cache.clear()
+
+def _memoized(key, build):
+    try:
+        return _pos_str_cache[key]
+    except KeyError:
+        value = _pos_str_cache[key] = build()
+        return value
+
 def compound_pos_str(pos_tuples):
     present_pos_tups = [pt for pt in pos_tuples if pt is not None]
-    return ';'.join((labware_pos_str(labware, idx) for labware, idx in present_pos_tups))
+    key = ('compound',) + tuple((labware, labware.layout_name(), idx) for labware, idx in present_pos_tups)
+    return _memoized(key, lambda: ';'.join((labware_pos_str(labware, idx) for labware, idx in present_pos_tups)))
 
 def compound_pos_str_96(labware96):
-    return ';'.join((labware_pos_str(labware96, idx) for idx in range(96)))
+    key = ('96', labware96, labware96.layout_name())
+    return _memoized(key, lambda: ';'.join((labware_pos_str(labware96, idx) for idx in range(96))))
+
+# The wrappers below log with Lazy arguments, which log_pipeline's writer thread formats,
+# so position strings are only built for records that get written, and not on the robot
+# thread. Each record also carries structured fields for the .jsonl log.
+def _positions_str(pos_tuples):
+    return '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples))
+
+def _positions_list(pos_tuples):
+    return [labware_pos_str(*pt) if pt else None for pt in pos_tuples]
+
+def _options_str(more_options):
+    return '' if not more_options else ' with extra options ' + str(more_options)
+
+def _fields(command, labware, volumes=None, options=None):
+    return {'fields': {'command': command, 'labware': labware, 'volumes': volumes, 'options': options or None}}
+
+def _channel_fields(command, pos_tuples, vols=None, more_options=None):
+    return _fields(command, Lazy(_positions_list, tuple(pos_tuples)), None if vols is None else list(vols), more_options)
+
+def command_name(template):
+    # pyhamilton command templates may be plain names or carry the name inside
+    if isinstance(template, str):
+        return template
+    if isinstance(template, dict):
+        return template.get('command', str(template))
+    if isinstance(template, (tuple, list)):
+        return str(template[0])
+    return str(template)
+
+def _record_response(cmd_template, sent_at):
+    duration = registry.clock() - sent_at
+    command_seconds.observe(duration, deck=current_deck(), command=command_name(cmd_template))
+    logging.debug('%s: response after %.2f s', Lazy(command_name, cmd_template), duration,
+            extra={'fields': {'command': Lazy(command_name, cmd_template), 'duration': duration}})
+
+class CommandHandle:
+    '''A command that has been sent to the robot but whose response may not have been collected yet.'''
+
+    def __init__(self, ham_int, cmd_id, wait_kwargs, cmd_template=None, sent_at=None):
+        self.ham_int = ham_int
+        self.cmd_id = cmd_id
+        self.wait_kwargs = wait_kwargs
+        self.cmd_template = cmd_template
+        self.sent_at = sent_at
+        self.done = False
+        self.response = None
+        self.exception = None
+
+    def wait(self):
+        if not self.done:
+            try:
+                self.response = self.ham_int.wait_on_response(self.cmd_id, raise_first_exception=True, **self.wait_kwargs)
+            except Exception as e:
+                self.exception = e
+            self.done = True
+            if self.sent_at is not None:
+                _record_response(self.cmd_template, self.sent_at)
+        if self.exception is not None:
+            raise self.exception
+        return self.response
 
-def initialize(ham, async=False):
+class CommandPipeline:
+    '''
+    Keeps up to window commands in flight at once. Responses are collected oldest first,
+    so a failure surfaces in the order the commands were submitted.
+    '''
+
+    def __init__(self, ham_int, window=3):
+        if window < 1:
+            raise ValueError('Pipeline window must be at least 1')
+        self.ham_int = ham_int
+        self.window = window
+        self._in_flight = deque()
+
+    def submit(self, cmd_id, cmd_template=None, sent_at=None, **wait_kwargs):
+        handle = CommandHandle(self.ham_int, cmd_id, wait_kwargs, cmd_template, sent_at)
+        self._in_flight.append(handle)
+        while len(self._in_flight) > self.window:
+            self._in_flight.popleft().wait()
+        return handle
+
+    def sync(self):
+        while self._in_flight:
+            self._in_flight.popleft().wait()
+
+    def drain(self):
+        '''Wait for every command in flight, logging rather than raising their failures.'''
+        while self._in_flight:
+            handle = self._in_flight.popleft()
+            try:
+                handle.wait()
+            except Exception as e:
+                logging.error('Pipelined command ' + str(handle.cmd_id) + ' failed while draining: ' + repr(e))
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+_pipelines = local() # pipelined mode is per thread, so async helper threads are unaffected
+
+def _active_pipeline(ham_int):
+    return getattr(_pipelines, 'by_interface', {}).get(id(ham_int))
+
+@contextmanager
+def pipelined(ham_int, window=3):
+    '''
+    Within this context, the liquid-handling wrappers called from this thread return
+    CommandHandles instead of blocking on each response, so host-side work overlaps with
+    robot motion. Everything still in flight is waited on at exit, even when the body
+    raises, so recovery never starts while the robot is still moving; failures of those
+    commands are then logged, and the body's exception is the one that propagates.
+    '''
+    if not hasattr(_pipelines, 'by_interface'):
+        _pipelines.by_interface = {}
+    if id(ham_int) in _pipelines.by_interface:
+        yield _pipelines.by_interface[id(ham_int)] # already pipelined; nest transparently
+        return
+    pipeline = CommandPipeline(ham_int, window)
+    _pipelines.by_interface[id(ham_int)] = pipeline
+    try:
+        yield pipeline
+        pipeline.sync()
+    except BaseException:
+        pipeline.drain()
+        raise
+    finally:
+        del _pipelines.by_interface[id(ham_int)]
+
+def sync(ham_int):
+    '''Wait for every pipelined command on this thread to finish. No-op outside pipelined mode.'''
+    pipeline = _active_pipeline(ham_int)
+    if pipeline is not None:
+        pipeline.sync()
+
+def send_and_wait(ham_int, cmd_template, wait_kwargs=None, **cmd_fields):
+    # an interface that only records commands, like a CommandRecorder, has no responses to time
+    sent_at = registry.clock() if getattr(ham_int, 'sends_commands', True) else None
+    cmd_id = ham_int.send_command(cmd_template, **cmd_fields)
+    pipeline = _active_pipeline(ham_int)
+    if pipeline is not None:
+        return pipeline.submit(cmd_id, cmd_template, sent_at, **(wait_kwargs or {}))
+    response = ham_int.wait_on_response(cmd_id, raise_first_exception=True, **(wait_kwargs or {}))
+    if sent_at is not None:
+        _record_response(cmd_template, sent_at) # time from sending to the response, queueing included when pipelined
+    return response
+
+@traced('robot')
+def initialize(ham, async_=False):
     cmd = ham.send_command(INITIALIZE)
-    if not async:
+    if not async_:
         ham.wait_on_response(cmd, raise_first_exception=True)
     return cmd
 
-def hepa_on(ham, speed=15, async=False, **more_options):
+@traced('robot')
+def hepa_on(ham, speed=15, async_=False, **more_options):
     cmd = ham.send_command(HEPA, fanSpeed=speed, **more_options)
-    if not async:
+    if not async_:
         ham.wait_on_response(cmd, raise_first_exception=True)
     return cmd
 
-def wash_empty_refill(ham, async=False, **more_options):
+@traced('robot')
+@uses('head96') # the wash station serves the 96 head
+def wash_empty_refill(ham, async_=False, **more_options):
     cmd = ham.send_command(WASH96_EMPTY, **more_options)
-    if not async:
+    if not async_:
         ham.wait_on_response(cmd, raise_first_exception=True)
     return cmd
 
+@traced('iswap')
+@uses('iswap')
 def move_plate(ham, source_plate, target_plate, try_inversions=None):
-    logging.info('move_plate: Moving plate ' + source_plate.layout_name() + ' to ' + target_plate.layout_name())
+    logging.info('move_plate: Moving plate %s to %s', source_plate.layout_name(), target_plate.layout_name(),
+            extra=_fields('move_plate', [source_plate.layout_name(), target_plate.layout_name()]))
+    sync(ham) # grip retries below depend on each response, so nothing else may be in flight
     src_pos = labware_pos_str(source_plate, 0)
     trgt_pos = labware_pos_str(target_plate, 0)
     if try_inversions is None:
         try_inversions = (0, 1)
     for inv in try_inversions:
+        sent_at = registry.clock()
         cid = ham.send_command(ISWAP_GET, plateLabwarePositions=src_pos, gripHeight=6, inverseGrip=inv)
         try:
             ham.wait_on_response(cid, raise_first_exception=True, timeout=120)
+            _record_response(ISWAP_GET, sent_at)
             break
         except PositionError:
             pass
     else:
         raise IOError
+    sent_at = registry.clock()
     cid = ham.send_command(ISWAP_PLACE, plateLabwarePositions=trgt_pos)
     try:
         ham.wait_on_response(cid, raise_first_exception=True, timeout=120)
     except PositionError:
         raise IOError
+    _record_response(ISWAP_PLACE, sent_at)
 
 def lagoon_pos_for_lagoon(lagoon_idx):
     return lagoon_plate, lagoon_idx
@@ -91,14 +265,19 @@ def offset_equal_spaced_idxs(start_idx, increment):
         yield idx
         idx += increment
 
-def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id=None, async_task=None):
-    logging.info('read_plate: Running plate protocols ' + ', '.join(protocol_names) +
-            ' on plate ' + plate.layout_name() + ('' if plate_id is None else ' with id ' + plate_id))
+@traced('reader')
+def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id=None, async_task=None,
+        async_devices=('head96',)):
+    logging.info('read_plate: Running plate protocols %s on plate %s%s', ', '.join(protocol_names),
+            plate.layout_name(), '' if plate_id is None else ' with id ' + plate_id,
+            extra=_fields('read_plate', plate.layout_name(), options={'protocols': list(protocol_names), 'plate_id': plate_id}))
     reader_int.plate_out(block=False)
     move_plate(ham_int, plate, reader_site)
     if async_task:
-        t = run_async(async_task)
-    plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
+        t = run_async(async_task, devices=async_devices, locks=locks_for(ham_int))
+    with span('run_protocols', 'reader', protocols=', '.join(protocol_names)), locks_for(ham_int).hold('reader'), \
+            reader_protocol_seconds.time(deck=current_deck(), protocols=', '.join(protocol_names)):
+        plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
     reader_int.plate_out(block=False)
     if async_task:
         t.join()
@@ -106,37 +285,43 @@ def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id
     return plate_datas
 
 def channel_var(pos_tuples):
-    ch_var = ['0']*16
-    for i, pos_tup in enumerate(pos_tuples):
-        if pos_tup is not None:
-            ch_var[i] = '1'
-    return ''.join(ch_var)
+    def build():
+        ch_var = ['0']*16
+        for i, pos_tup in enumerate(pos_tuples):
+            if pos_tup is not None:
+                ch_var[i] = '1'
+        return ''.join(ch_var)
+    return _memoized(('channels',) + tuple(pt is not None for pt in pos_tuples), build)
 
+@traced('robot')
+@uses('channels')
 def tip_pick_up(ham_int, pos_tuples, **more_options):
-    logging.info('tip_pick_up: Pick up tips at ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+    logging.info('tip_pick_up: Pick up tips at %s%s', Lazy(_positions_str, tuple(pos_tuples)), Lazy(_options_str, more_options),
+            extra=_channel_fields('tip_pick_up', pos_tuples, more_options=more_options))
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only pick up 8 tips at a time')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP,
+    return send_and_wait(ham_int, PICKUP,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
+@traced('robot')
+@uses('channels')
 def tip_eject(ham_int, pos_tuples, **more_options):
-    logging.info('tip_eject: Eject tips to ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+    logging.info('tip_eject: Eject tips to %s%s', Lazy(_positions_str, tuple(pos_tuples)), Lazy(_options_str, more_options),
+            extra=_channel_fields('tip_eject', pos_tuples, more_options=more_options))
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only pick up 8 tips at a time')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(EJECT,
+    return send_and_wait(ham_int, EJECT,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
 default_liq_class = 'HighVolumeFilter_Water_DispenseJet_Empty_with_transport_vol'
 
@@ -144,93 +329,103 @@ def assert_parallel_nones(list1, list2):
     if not (len(list1) == len(list2) and all([(i1 is None) == (i2 is None) for i1, i2 in zip(list1, list2)])):
         raise ValueError('Lists must have parallel None entries')
 
-def aspirate(ham_int, pos_tuples, vols, **more_options):
+@traced('robot')
+@uses('channels')
+def aspirate(ham_int, pos_tuples, vols, liquid_class=default_liq_class, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('aspirate: Aspirate volumes ' + str(vols) + ' from positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    logging.info('aspirate: Aspirate volumes %s from positions [%s]%s', list(vols), Lazy(_positions_str, tuple(pos_tuples)),
+            Lazy(_options_str, more_options), extra=_channel_fields('aspirate', pos_tuples, vols, more_options))
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE,
+    return send_and_wait(ham_int, ASPIRATE,
         channelVariable=channel_var(pos_tuples),
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        liquidClass=default_liq_class,
-        **more_options), raise_first_exception=True)
+        liquidClass=liquid_class,
+        **more_options)
 
-def dispense(ham_int, pos_tuples, vols, **more_options):
+@traced('robot')
+@uses('channels')
+def dispense(ham_int, pos_tuples, vols, liquid_class=default_liq_class, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('dispense: Dispense volumes ' + str(vols) + ' into positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    logging.info('dispense: Dispense volumes %s into positions [%s]%s', list(vols), Lazy(_positions_str, tuple(pos_tuples)),
+            Lazy(_options_str, more_options), extra=_channel_fields('dispense', pos_tuples, vols, more_options))
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE,
+    return send_and_wait(ham_int, DISPENSE,
         channelVariable=channel_var(pos_tuples),
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        liquidClass=default_liq_class,
-        **more_options), raise_first_exception=True)
+        liquidClass=liquid_class,
+        **more_options)
 
+@traced('robot')
+@uses('head96')
 def tip_pick_up_96(ham_int, tip96, **more_options):
-    logging.info('tip_pick_up_96: Pick up tips at ' + tip96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+    logging.info('tip_pick_up_96: Pick up tips at %s%s', tip96.layout_name(), Lazy(_options_str, more_options),
+            extra=_fields('tip_pick_up_96', tip96.layout_name(), options=more_options))
     labware_poss = compound_pos_str_96(tip96)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP96,
+    return send_and_wait(ham_int, PICKUP96,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
+@traced('robot')
+@uses('head96')
 def tip_eject_96(ham_int, tip96, **more_options):
-    logging.info('tip_eject_96: Eject tips to ' + tip96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+    logging.info('tip_eject_96: Eject tips to %s%s', tip96.layout_name(), Lazy(_options_str, more_options),
+            extra=_fields('tip_eject_96', tip96.layout_name(), options=more_options))
     labware_poss = compound_pos_str_96(tip96)
-    print('EJECTING TIPS TO' + tip96.layout_name())
-    ham_int.wait_on_response(ham_int.send_command(EJECT96,
+    return send_and_wait(ham_int, EJECT96,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
-    print('DONE EJECTING TIPS TO' + tip96.layout_name())
+        **more_options)
 
+@traced('robot')
+@uses('head96')
 def aspirate_96(ham_int, plate96, vol, **more_options):
-    logging.info('aspirate_96: Aspirate volume ' + str(vol) + ' from ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE96,
+    logging.info('aspirate_96: Aspirate volume %s from %s%s', vol, plate96.layout_name(), Lazy(_options_str, more_options),
+            extra=_fields('aspirate_96', plate96.layout_name(), vol, more_options))
+    return send_and_wait(ham_int, ASPIRATE96,
         labwarePositions=compound_pos_str_96(plate96),
         aspirateVolume=vol,
         liquidClass=default_liq_class,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
+@traced('robot')
+@uses('head96')
 def dispense_96(ham_int, plate96, vol, **more_options):
-    logging.info('dispense_96: Dispense volume ' + str(vol) + ' into ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE96,
+    logging.info('dispense_96: Dispense volume %s into %s%s', vol, plate96.layout_name(), Lazy(_options_str, more_options),
+            extra=_fields('dispense_96', plate96.layout_name(), vol, more_options))
+    return send_and_wait(ham_int, DISPENSE96,
         labwarePositions=compound_pos_str_96(plate96),
         dispenseVolume=vol,
         liquidClass=default_liq_class,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
 def add_robot_level_log(logger_name=None):
-    logger = logging.getLogger(logger_name) # root logger if None
-    logger.setLevel(logging.DEBUG)
+    '''
+    Also write the log of logger_name (every logger if None) to this robot's own file in
+    the global log directory, from the same writer thread.
+    '''
     with open(os.path.join(user_dir, '.roboid')) as roboid_f:
-        robot_id = roboid_f.read()
+        robot_id = roboid_f.read().strip()
     robot_log_dir = os.path.join(global_log_dir, robot_id, robot_id + '.log')
-    hdlr = logging.FileHandler(robot_log_dir)
-    formatter = logging.Formatter('[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    hdlr.setFormatter(formatter)
-    logger.addHandler(hdlr)
+    add_log_file(robot_log_dir, logger_name=logger_name)
 
-def run_async(funcs):
+def run_async(funcs, devices=(), timeout=None, locks=None):
+    '''
+    Run a function, or a sequence of them in order, on another thread while holding the
+    named device locks. Returns a TaskHandle; its join() re-raises any failure, and gives
+    up after timeout seconds if one is set.
+    '''
     def go():
         try:
             iter(funcs)
         except TypeError:
-            funcs()
-            return
+            return funcs()
         for func in funcs:
             func()
-    func_thread = Thread(target=go, daemon=True)
-    func_thread.start()
-    return func_thread
+    name = getattr(funcs, '__name__', 'async_task')
+    return executor.submit(go, devices=devices, name=name, timeout=timeout, locks=locks)
 
 def yield_in_chunks(sliceable, n):
     sliceable = list(sliceable)
@@ -0,0 +1,43 @@
+import os, json, time, logging
+from threading import Lock
+
+class Checkpoint:
+    '''
+    Experiment state that has to outlive the process, as one JSON file. Each part of the
+    state is tracked by name with a function returning it, and save() writes all of them
+    together: to a temporary file, synced to disk, then renamed over the last checkpoint,
+    so a crash part way through a save leaves the previous checkpoint whole.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._sources = {}
+        self._lock = Lock()
+        self.saves = 0
+
+    def track(self, name, get_state):
+        self._sources[name] = get_state
+
+    def state(self):
+        return {name: get_state() for name, get_state in self._sources.items()}
+
+    def save(self):
+        with self._lock:
+            state = self.state()
+            state['saved_at'] = time.time()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as checkpoint_file:
+                json.dump(state, checkpoint_file, indent=1)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.replace(tmp_path, self.path)
+            self.saves += 1
+
+    def load(self):
+        '''The last saved state, or None if nothing has been saved yet.'''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        logging.info('Loaded checkpoint ' + self.path + ' saved at ' + time.ctime(state.get('saved_at', 0)))
+        return state
@@ -0,0 +1,112 @@
+import logging
+from threading import get_ident
+from basic_pace_180705x import send_and_wait, pipelined
+from executor import DeviceLocks, bind_device_locks, locks_for
+from tracing import span
+
+class CommandRecorder:
+    '''
+    Stands in for a HamiltonInterface while a routine is compiled: commands are recorded
+    instead of sent, and every response comes back as None.
+    '''
+    sends_commands = False # so no response times are recorded for it
+
+    def __init__(self):
+        self.commands = []
+
+    def send_command(self, template, **fields):
+        self.commands.append((template, fields))
+        return len(self.commands) - 1
+
+    def wait_on_response(self, cmd_id, **wait_kwargs):
+        return None
+
+class DeviceRecorder(DeviceLocks):
+    '''Device locks for a CommandRecorder, noting every device the routine's wrappers hold.'''
+
+    def __init__(self):
+        super().__init__()
+        self.devices = set()
+
+    def hold(self, *devices, timeout=None):
+        self.devices.update(devices)
+        return super().hold(*devices, timeout=timeout)
+
+class LogCapture(logging.Filter):
+    '''
+    Root logger filter that takes the records one thread logs out of the log while a
+    routine is compiled, keeping each with how many commands had been recorded before it,
+    so a replay can log them again alongside the commands they describe.
+    '''
+
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder = recorder
+        self.thread = get_ident()
+        self.records = []
+
+    def filter(self, record):
+        if record.thread != self.thread:
+            return True
+        self.records.append((len(self.recorder.commands), record))
+        return False
+
+def _log_again(record):
+    # a fresh record, so it carries the replay's time and thread; Lazy arguments are still unformatted
+    logger = logging.getLogger(record.name)
+    if logger.isEnabledFor(record.levelno):
+        extra = {'fields': record.fields} if hasattr(record, 'fields') else None
+        logger.handle(logger.makeRecord(record.name, record.levelno, record.pathname, record.lineno, record.msg,
+                record.args, None, record.funcName, extra, record.stack_info))
+
+class CompiledPlan:
+    '''
+    A fixed command sequence generated once and replayed as-is, with no per-call string
+    building. log_records are (command index, record) pairs, logged again as the replay
+    reaches each command. The replay holds the devices the compiled routine used, as the
+    wrappers that sent its commands would have, and is traced as one span.
+    '''
+
+    def __init__(self, name, commands, log_records=(), devices=()):
+        self.name = name
+        self.commands = commands
+        self.log_records = list(log_records)
+        self.devices = tuple(devices)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def replay(self, ham_int, window=3):
+        logging.info('Replaying compiled plan "' + self.name + '" (' + str(len(self)) + ' commands)')
+        records = iter(self.log_records)
+        next_record = next(records, None)
+        with locks_for(ham_int).hold(*self.devices), span('replay ' + self.name, 'robot'):
+            with pipelined(ham_int, window):
+                for i, (template, fields) in enumerate(self.commands):
+                    while next_record is not None and next_record[0] <= i:
+                        _log_again(next_record[1])
+                        next_record = next(records, None)
+                    send_and_wait(ham_int, template, **fields)
+            while next_record is not None:
+                _log_again(next_record[1])
+                next_record = next(records, None)
+
+def compile_plan(name, routine, *args, **kwargs):
+    '''
+    Run routine(recorder, *args, **kwargs) against a CommandRecorder and keep the commands
+    it sent. Only valid for routines whose commands do not depend on robot responses,
+    reader data or other run-time state. What the routine logs to the root logger, as the
+    liquid-handling wrappers do, is kept out of the log and logged at each replay instead.
+    '''
+    recorder = CommandRecorder()
+    devices = DeviceRecorder()
+    bind_device_locks(recorder, devices)
+    logging.info('Compiling command plan "' + name + '"')
+    capture = LogCapture(recorder)
+    root = logging.getLogger()
+    root.addFilter(capture)
+    try:
+        routine(recorder, *args, **kwargs)
+    finally:
+        root.removeFilter(capture)
+    return CompiledPlan(name, recorder.commands, capture.records, devices.devices)
@@ -0,0 +1,181 @@
+import math, itertools, logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from turb_control import controller_strategies, abs_to_od
+
+# abs_to_od's own calibration, the one recorded ODs are taken to be true in
+reference_slope, reference_intercept = 4.171943074, -.1075750317
+
+class Dilution:
+    '''
+    How the service loop turns a controller's flow rate into the volume added at each
+    reading: rate*working_vol/cycles_per_hour, but never less than min_add_vol, so there is
+    always enough culture to sample next time. Volumes in uL. fraction() is the added
+    volume over working_vol, by which the culture is diluted once the excess is drawn off.
+    '''
+
+    def __init__(self, working_vol=1000, cycles_per_hour=6, min_add_vol=200):
+        self.working_vol = working_vol
+        self.cycles_per_hour = cycles_per_hour
+        self.min_add_vol = min_add_vol
+
+    def add_vols(self, rates):
+        return np.maximum(self.min_add_vol, np.asarray(rates)*self.working_vol/self.cycles_per_hour)
+
+    def fraction(self, rates):
+        return self.add_vols(rates)/self.working_vol
+
+class Trajectories:
+    '''
+    Recorded turbidostat cultures turned into what a replay needs, as (steps, vessels)
+    arrays: the OD each culture started at, the hours between readings, and the growth
+    rate each culture showed over each interval. The growth rate is what the readings
+    imply once the dilution applied after each reading is taken out:
+    ln(od[k+1]/od[k]) + ln(1 + fraction[k]), per dt[k]. Vessels with fewer readings are
+    padded at the end, where live is False.
+    '''
+
+    def __init__(self, vessels, start_ods, dts, growth_rates, live):
+        self.vessels = vessels
+        self.start_ods = start_ods
+        self.dts = dts
+        self.growth_rates = growth_rates
+        self.live = live
+
+    def steps(self):
+        return self.dts.shape[0]
+
+    def hours(self):
+        return float((self.dts*self.live).sum())
+
+def estimate_growth(times, ods, strategy, dilution=None, min_interval=60.0, max_growth_rate=3.0):
+    '''
+    Per-interval growth rates of one culture from its readings (epoch seconds, ODs), with
+    strategy the controller that was running and dilution how its rates were applied
+    (a default Dilution if None). Readings less than min_interval seconds
+    after the last kept one are dropped as repeats. Rates are clipped to between zero and
+    max_growth_rate per hour, since readings of near-empty or overgrown wells say little.
+    Returns (ods, dts in hours, growth rates), one shorter than ods for the last two.
+    '''
+    keep = [0]
+    for i in range(1, len(times)):
+        if times[i] - times[keep[-1]] >= min_interval:
+            keep.append(i)
+    times, ods = np.asarray(times)[keep], np.clip(np.asarray(ods, dtype=float)[keep], 1e-3, None)
+    dilution = dilution or Dilution()
+    dts = np.diff(times)/3600
+    rates = np.array([float(strategy.flow_rates(np.array([od]), 1/dilution.cycles_per_hour)[0]) for od in ods[:-1]])
+    growth = (np.log(ods[1:]/ods[:-1]) + np.log1p(dilution.fraction(rates)))/dts
+    return ods, dts, np.clip(growth, 0, max_growth_rate)
+
+def load_trajectories(store, deck=None, vessels=None, start=None, end=None, recorded_with='bangbang',
+        recorded_params=None, dilution=None, od_from_abs=abs_to_od, min_readings=3):
+    '''
+    Trajectories for the turbidostats in a MeasurementStore, from their absorbance
+    readings. recorded_with and recorded_params name the controller strategy that was
+    running while they were recorded, e.g. 'bangbang' with its defaults.
+    '''
+    if vessels is None:
+        vessels = store.vessels('turbidostat', 'abs', deck)
+    recorded = []
+    for vessel in vessels:
+        times, readings = store.series('turbidostat', vessel, 'abs', start, end, deck)
+        if len(times) < min_readings:
+            logging.info('Replay: skipping turbidostat ' + str(vessel) + ' with only ' + str(len(times)) + ' readings')
+            continue
+        strategy = controller_strategies[recorded_with](**(recorded_params or {}))
+        recorded.append((vessel,) + estimate_growth(times, od_from_abs(readings), strategy, dilution))
+    if not recorded:
+        raise ValueError('No turbidostat has enough readings to replay')
+    steps = max(len(dts) for _, _, dts, _ in recorded)
+    shape = (steps, len(recorded))
+    dts = np.full(shape, 1/6) # padding keeps every controller's arithmetic finite
+    growth_rates = np.zeros(shape)
+    live = np.zeros(shape, dtype=bool)
+    for i, (_, _, vessel_dts, vessel_growth) in enumerate(recorded):
+        dts[:len(vessel_dts), i] = vessel_dts
+        growth_rates[:len(vessel_dts), i] = vessel_growth
+        live[:len(vessel_dts), i] = True
+    return Trajectories([r[0] for r in recorded], np.array([ods[0] for _, ods, _, _ in recorded]), dts, growth_rates, live)
+
+class Candidate:
+    '''A controller strategy with its parameters, and the abs_to_od calibration it reads ODs through.'''
+
+    def __init__(self, strategy, params=None, slope=reference_slope, intercept=reference_intercept):
+        self.strategy = strategy
+        self.params = params or {}
+        self.slope = slope
+        self.intercept = intercept
+
+    def describe(self):
+        settings = dict(self.params, slope=self.slope, intercept=self.intercept)
+        return self.strategy + ' ' + ', '.join(k + '=' + '{:.4g}'.format(v) for k, v in sorted(settings.items()))
+
+def parameter_grid(strategy, slopes=(reference_slope,), intercepts=(reference_intercept,), **param_values):
+    '''Every combination of the given parameter values and calibrations, e.g. margin=(.03, .05, .08).'''
+    names = sorted(param_values)
+    for values in itertools.product(*(param_values[name] for name in names)):
+        for slope, intercept in itertools.product(slopes, intercepts):
+            yield Candidate(strategy, dict(zip(names, values)), slope, intercept)
+
+def replay(trajectories, candidate, desired_od=.45, dilution=None, min_od=.2):
+    '''
+    Run every recorded culture through one candidate at once. Each step the culture
+    grows at its recorded rate and is diluted as the service loop would dilute it at the
+    candidate's flow rate: od*exp(growth*dt)/(1 + dilution.fraction(rate)). The candidate
+    sees the true OD as its calibration reads it. Tracking error is the RMS distance from
+    desired_od in true OD, over each culture's steps from when it first reaches min_od;
+    media is in mL per vessel-hour, minimum additions included.
+    '''
+    strategy = controller_strategies[candidate.strategy](**candidate.params)
+    dilution = dilution or Dilution()
+    t = trajectories
+    od = t.start_ods.copy()
+    started = od >= min_od
+    squared_error, scored, media = 0.0, 0, 0.0
+    for k in range(t.steps()):
+        live = t.live[k]
+        absorbance = (od - reference_intercept)/reference_slope
+        rates = strategy.flow_rates(candidate.slope*absorbance + candidate.intercept, 1/dilution.cycles_per_hour)
+        fractions = np.where(live, dilution.fraction(rates), 0)
+        media += float(fractions.sum())*dilution.working_vol/1000
+        od = np.where(live, od*np.exp(t.growth_rates[k]*t.dts[k])/(1 + fractions), od)
+        started |= live & (od >= min_od)
+        counted = live & started
+        squared_error += float(((od[counted] - desired_od)**2).sum())
+        scored += int(counted.sum())
+    return {'candidate': candidate.describe(), 'strategy': candidate.strategy, 'params': candidate.params,
+            'slope': candidate.slope, 'intercept': candidate.intercept,
+            'tracking_error': math.sqrt(squared_error/scored) if scored else float('inf'),
+            'media_ml_per_vessel_hour': media/t.hours()}
+
+def _replay_chunk(trajectories, candidates, kwargs):
+    return [replay(trajectories, candidate, **kwargs) for candidate in candidates]
+
+def replay_grid(trajectories, candidates, workers=None, chunk_size=50, **replay_kwargs):
+    '''
+    replay() every candidate, in chunks spread over a process pool, and return the
+    results ranked by rank(). workers=1 runs them all in this process.
+    '''
+    candidates = list(candidates)
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    if workers == 1:
+        results = [result for chunk in chunks for result in _replay_chunk(trajectories, chunk, replay_kwargs)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(_replay_chunk, trajectories, chunk, replay_kwargs) for chunk in chunks]
+            results = [result for job in jobs for result in job.result()]
+    return rank(results)
+
+def rank(results):
+    '''
+    Results on the Pareto front of tracking error and media use first, since no other
+    candidate beats them on both, then the rest; each group by tracking error. Marks
+    each result's 'pareto'.
+    '''
+    by_error = sorted(results, key=lambda r: (r['tracking_error'], r['media_ml_per_vessel_hour']))
+    least_media = float('inf')
+    for result in by_error:
+        result['pareto'] = result['media_ml_per_vessel_hour'] < least_media
+        least_media = min(least_media, result['media_ml_per_vessel_hour'])
+    return [r for r in by_error if r['pareto']] + [r for r in by_error if not r['pareto']]
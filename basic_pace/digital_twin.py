@@ -0,0 +1,359 @@
+import time, math, logging, random, types
+from datetime import datetime
+from threading import Lock, local
+import numpy as np
+
+from basic_pace_180705x import (LBPumps, Shaker,
+    INITIALIZE, PICKUP, EJECT, ASPIRATE, DISPENSE, ISWAP_GET, ISWAP_PLACE, HEPA,
+    WASH96_EMPTY, PICKUP96, EJECT96, ASPIRATE96, DISPENSE96, command_name)
+from auxpump.jobs import PumpJob
+
+# Per-command durations in seconds. Override any of them by command name with DeckTwin(durations={...}).
+default_robot_durations = [
+    (INITIALIZE, 90), (HEPA, 1), (WASH96_EMPTY, 40),
+    (PICKUP, 10), (EJECT, 8), (ASPIRATE, 12), (DISPENSE, 8),
+    (PICKUP96, 15), (EJECT96, 12), (ASPIRATE96, 18), (DISPENSE96, 12),
+    (ISWAP_GET, 20), (ISWAP_PLACE, 18)]
+default_aux_durations = {
+    'reader_protocol': 75, 'reader_tray': 4,
+    'pump_clean': 150, 'pump_prime': 60, 'pump_fresh': 90, 'pump_empty': 60, 'pump_refill_rinse': 90,
+    'shaker_cmd': .3}
+
+class VirtualClock:
+    '''
+    Discrete-event clock. Each thread keeps its own notion of "now", which only moves
+    forward when that thread sleeps or waits on a simulated device, so work that overlaps
+    in separate threads also overlaps in virtual time. time() on a thread that has not
+    waited yet starts from the latest time seen on any thread.
+    '''
+
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self._latest = self.start
+        self._local = local()
+        self._lock = Lock()
+
+    def time(self):
+        now = getattr(self._local, 'now', None)
+        if now is None:
+            with self._lock:
+                now = self._local.now = self._latest
+        return now
+
+    def advance_to(self, t):
+        now = max(self.time(), t)
+        self._local.now = now
+        with self._lock:
+            self._latest = max(self._latest, now)
+        return now
+
+    def set_thread_time(self, t):
+        '''Set the calling thread's "now", e.g. to when the work it is picking up could first start.'''
+        self._local.now = t
+        with self._lock:
+            self._latest = max(self._latest, t)
+
+    def sleep(self, seconds):
+        self.advance_to(self.time() + max(0, seconds))
+
+    def latest(self):
+        with self._lock:
+            return self._latest
+
+class DeviceTimeline:
+    '''One simulated device: commands queue up on it one after another in virtual time.'''
+
+    def __init__(self, name, clock):
+        self.name = name
+        self.clock = clock
+        self.busy_until = clock.time()
+        self.busy_time = 0.0
+        self.commands = 0
+        self._lock = Lock()
+
+    def occupy(self, duration, not_before=None):
+        with self._lock:
+            start_time = max(self.clock.time(), self.busy_until, not_before or 0)
+            self.busy_until = start_time + duration
+            self.busy_time += duration
+            self.commands += 1
+            return self.busy_until
+
+class CultureModel:
+    '''
+    Logistic growth for each turbidostat, diluted by whatever media the robot dispenses
+    into it, with lagoon luminescence slowly rising once the lagoons are fed.
+    '''
+
+    def __init__(self, num_vessels, working_vol, doubling_time=60*25, carrying_od=1.6, initial_od=.05,
+            seed=0):
+        rng = random.Random(seed)
+        self.num_vessels = num_vessels
+        self.working_vol = working_vol
+        self.growth_rates = np.array([math.log(2)/(doubling_time*rng.uniform(.85, 1.15)) for _ in range(num_vessels)])
+        self.carrying_od = carrying_od
+        self.ods = np.array([initial_od*rng.uniform(.8, 1.2) for _ in range(num_vessels)])
+        self.lums = np.full(num_vessels, 5.0)
+        self.lum_rates = np.array([rng.uniform(.5, 2.0)/3600 for _ in range(num_vessels)])
+        self.noise = rng
+        self.t = None
+
+    def advance(self, t):
+        if self.t is not None and t > self.t:
+            dt = t - self.t
+            k = self.carrying_od
+            self.ods = k/(1 + (k/self.ods - 1)*np.exp(-self.growth_rates*dt))
+            self.lums = np.minimum(250.0, self.lums*np.exp(self.lum_rates*dt))
+        self.t = t if self.t is None else max(self.t, t)
+
+    def dilute(self, vessel, add_vol):
+        self.ods[vessel] *= self.working_vol/(self.working_vol + add_vol)
+
+class SimPlateData:
+    '''Quacks like platereader's PlateData for the fields this package reads.'''
+
+    def __init__(self, path, plate_id, timestamp, values):
+        self.path = path
+        self.header = types.SimpleNamespace(plate_ids=[plate_id], time=timestamp)
+        self.values = values # indexed [col][row]
+
+    def value_at(self, col, row):
+        return float(self.values[col][row])
+
+    def wait_for_file(self):
+        return self
+
+def _labware_positions(pos_str):
+    # 'plate, A1;plate, B1' -> [('plate', 'A1'), ('plate', 'B1')]
+    pairs = []
+    for pos in pos_str.split(';'):
+        name, _, pos_id = pos.partition(',')
+        pairs.append((name.strip(), pos_id.strip()))
+    return pairs
+
+def _well_idx(pos_id):
+    row = ord(pos_id[0].upper()) - ord('A')
+    col = int(pos_id[1:]) - 1
+    return col*8 + row
+
+class DeckTwin:
+    '''
+    Simulated deck on a virtual clock: fake Hamilton, plate reader, LB pumps and shaker
+    with per-command durations, plus a CultureModel that produces the plate data. Reader
+    plate contents are followed through 96-head transfers and iSWAP moves, so each read
+    reports the samples that were actually pipetted into that plate.
+
+    vessel_plates maps layout names of vessel plates to 'turbidostat' or 'lagoon'.
+    vessel_wells[v] is the 96-well index holding vessel v on those plates.
+    reader_sites maps each reader site layout name to (reader plate layout name, well offset).
+    '''
+
+    def __init__(self, vessel_plates, vessel_wells, reader_sites, reader_tray_name, working_vol,
+            abs_from_od=lambda od: od, durations=None, start_time=None, seed=0):
+        self.clock = VirtualClock(start_time)
+        self.durations = {command_name(k): v for k, v in default_robot_durations}
+        self.durations.update(default_aux_durations)
+        self.durations.update(durations or {})
+        self.timelines = {name: DeviceTimeline(name, self.clock) for name in ('hamilton', 'reader', 'pumps', 'shaker')}
+        self.culture = CultureModel(len(vessel_wells), working_vol, seed=seed)
+        self.vessel_plates = vessel_plates
+        self.vessel_wells = list(vessel_wells)
+        self.vessel_for_well = {w: v for v, w in enumerate(self.vessel_wells)}
+        self.reader_sites = reader_sites
+        self.reader_tray_name = reader_tray_name
+        self.abs_from_od = abs_from_od
+        self.blank_abs = abs_from_od(0)
+        self.samples = {} # (reader plate name, well idx) -> (kind, vessel, od snapshot, lum snapshot)
+        self.plate_locations = {} # site name -> plate name currently sitting there
+        self._head_sample = None
+        self._gripped = None
+        self._lock = Lock()
+        self._wall_start = time.time()
+
+    def duration(self, name):
+        return self.durations.get(name, 5)
+
+    def _now_culture(self):
+        self.culture.advance(self.clock.time())
+        return self.culture
+
+    def observe_command(self, name, fields):
+        with self._lock:
+            if name == command_name(ASPIRATE96):
+                plate_name = _labware_positions(fields['labwarePositions'])[0][0]
+                kind = self.vessel_plates.get(plate_name)
+                if kind is not None:
+                    culture = self._now_culture()
+                    self._head_sample = (kind, culture.ods.copy(), culture.lums.copy())
+            elif name == command_name(DISPENSE96):
+                site_name = _labware_positions(fields['labwarePositions'])[0][0]
+                if site_name in self.reader_sites and self._head_sample:
+                    plate_name, offset = self.reader_sites[site_name]
+                    kind, ods, lums = self._head_sample
+                    for vessel, well in enumerate(self.vessel_wells):
+                        self.samples[plate_name, well + offset] = (kind, vessel, ods[vessel], lums[vessel])
+                self._head_sample = None
+            elif name == command_name(DISPENSE):
+                culture = self._now_culture()
+                for (plate_name, pos_id), vol in zip(_labware_positions(fields['labwarePositions']), fields['volumes']):
+                    if self.vessel_plates.get(plate_name) == 'turbidostat':
+                        vessel = self.vessel_for_well.get(_well_idx(pos_id))
+                        if vessel is not None:
+                            culture.dilute(vessel, vol)
+            elif name == command_name(ISWAP_GET):
+                site_name = _labware_positions(fields['plateLabwarePositions'])[0][0]
+                self._gripped = self.plate_locations.pop(site_name, site_name)
+            elif name == command_name(ISWAP_PLACE):
+                site_name = _labware_positions(fields['plateLabwarePositions'])[0][0]
+                self.plate_locations[site_name] = self._gripped
+                self._gripped = None
+
+    def read(self, protocol_name, plate_id):
+        plate_name = self.plate_locations.get(self.reader_tray_name)
+        data_type = 'lum' if 'lum' in protocol_name else 'abs'
+        values = np.zeros((12, 8))
+        for idx in range(96):
+            sample = self.samples.get((plate_name, idx))
+            if sample is None:
+                value = 0.0 if data_type == 'lum' else self.blank_abs
+            else:
+                kind, vessel, od, lum = sample
+                value = lum if data_type == 'lum' else self.abs_from_od(od)
+                value *= 1 + self.culture.noise.gauss(0, .01)
+            values[idx//8][idx%8] = value
+        t = self.clock.time()
+        path = protocol_name + '_' + datetime.fromtimestamp(t).strftime('%y%m%d_%H%M') + '.csv'
+        return SimPlateData(path, plate_id, t, values)
+
+    def hamilton(self):
+        return TwinHamiltonInterface(self)
+
+    def reader(self):
+        return TwinReader(self)
+
+    def pumps(self):
+        return TwinPumps(self)
+
+    def shaker(self):
+        return TwinShaker(self)
+
+    def report(self, scheduler=None):
+        elapsed = self.clock.latest() - self.clock.start
+        report = {'virtual_hours': elapsed/3600,
+                  'wall_seconds': time.time() - self._wall_start,
+                  'devices': {name: {'commands': tl.commands, 'busy_hours': tl.busy_time/3600,
+                                     'utilization': tl.busy_time/elapsed if elapsed else 0.0}
+                              for name, tl in self.timelines.items()}}
+        if scheduler is not None:
+            report['tasks'] = scheduler.stats()
+        return report
+
+class TwinHamiltonInterface:
+
+    def __init__(self, twin):
+        self.twin = twin
+        self.timeline = twin.timelines['hamilton']
+        self._finish_times = {}
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set_log_dir(self, path):
+        pass
+
+    def send_command(self, template, **fields):
+        name = command_name(template)
+        finish_time = self.timeline.occupy(self.twin.duration(name))
+        self.twin.observe_command(name, fields)
+        cmd_id = self._next_id
+        self._next_id += 1
+        self._finish_times[cmd_id] = finish_time
+        return cmd_id
+
+    def wait_on_response(self, cmd_id, raise_first_exception=False, timeout=None, **kwargs):
+        self.twin.clock.advance_to(self._finish_times.pop(cmd_id))
+        return None
+
+class TwinReader:
+
+    def __init__(self, twin):
+        self.twin = twin
+        self.timeline = twin.timelines['reader']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def disable(self):
+        pass
+
+    def plate_out(self, block=True):
+        finish_time = self.timeline.occupy(self.twin.duration('reader_tray'))
+        if block:
+            self.twin.clock.advance_to(finish_time)
+
+    def plate_in(self, block=True):
+        self.plate_out(block)
+
+    def run_protocols(self, protocol_names, plate_id_1=None, **kwargs):
+        plate_datas = []
+        for protocol_name in protocol_names:
+            self.twin.clock.advance_to(self.timeline.occupy(self.twin.duration('reader_protocol')))
+            plate_datas.append(self.twin.read(protocol_name, plate_id_1))
+        return plate_datas
+
+class TwinPumpJob(PumpJob):
+    '''Already resolved, but waiting on it moves the caller's virtual time to when the pumps finish.'''
+
+    def __init__(self, description, clock, finish_time):
+        super().__init__(description)
+        self.clock = clock
+        self.finish_time = finish_time
+        self.set_running_or_notify_cancel()
+        self.set_result(None)
+
+    def result(self, timeout=None):
+        self.clock.advance_to(self.finish_time)
+        return super().result(timeout)
+
+class TwinPumps(LBPumps):
+
+    def __init__(self, twin):
+        super().__init__()
+        self.twin = twin
+        self.timeline = twin.timelines['pumps']
+
+    def _run(self, run_cmd, *run_args, after=None, timeout=None):
+        not_before = after.finish_time if isinstance(after, TwinPumpJob) else None
+        finish_time = self.timeline.occupy(self.twin.duration('pump_' + run_cmd), not_before)
+        return TwinPumpJob(run_cmd, self.twin.clock, finish_time)
+
+    def __exit__(self, *args):
+        pass
+
+class TwinShaker(Shaker):
+
+    def __init__(self, twin):
+        super().__init__()
+        self.twin = twin
+        self.timeline = twin.timelines['shaker']
+
+    def _send(self, cmd_str):
+        self.twin.clock.advance_to(self.timeline.occupy(self.twin.duration('shaker_cmd')))
+
+def log_twin_report(report):
+    logging.info('Digital twin: simulated ' + '{:.2f}'.format(report['virtual_hours']) + ' h in ' +
+            '{:.1f}'.format(report['wall_seconds']) + ' s of wall time')
+    for name, dev in report['devices'].items():
+        logging.info('Digital twin: ' + name + ' ran ' + str(dev['commands']) + ' commands, utilization ' +
+                '{:.1%}'.format(dev['utilization']))
+    for name, stats in report.get('tasks', {}).items():
+        logging.info('Digital twin: ' + name + ' ran ' + str(stats['runs']) + ' cycles, mean cycle time ' +
+                '{:.0f}'.format(stats['mean_duration']) + ' s, max ' + '{:.0f}'.format(stats['max_duration']) +
+                ' s, max lateness ' + '{:.0f}'.format(stats['max_lateness']) + ' s')
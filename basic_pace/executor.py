@@ -0,0 +1,150 @@
+import logging, functools, itertools
+from weakref import WeakKeyDictionary
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
+from threading import Thread, RLock, Lock
+from metrics import current_deck, set_deck
+
+# Every lock is always taken in this order, so two tasks needing overlapping devices can't deadlock
+DEVICES = ('iswap', 'head96', 'channels', 'reader', 'pumps', 'shaker')
+
+class DeviceBusyError(TimeoutError):
+    pass
+
+class DeviceLocks:
+    '''One re-entrant lock per deck device, so a thread can nest calls that use the same device.'''
+
+    def __init__(self, devices=DEVICES):
+        self.order = tuple(devices)
+        self._locks = {device: RLock() for device in self.order}
+
+    def _ordered(self, devices):
+        for device in devices:
+            if device not in self._locks:
+                raise ValueError('Unknown device ' + repr(device) + '; expected one of ' + ', '.join(self.order))
+        return sorted(set(devices), key=self.order.index)
+
+    def lock(self, device):
+        '''One device's lock itself, for a driver that serializes its own commands on it.'''
+        return self._locks[self._ordered((device,))[0]]
+
+    @contextmanager
+    def hold(self, *devices, timeout=None):
+        held = []
+        try:
+            for device in self._ordered(devices):
+                if not self._locks[device].acquire(timeout=-1 if timeout is None else timeout):
+                    raise DeviceBusyError('Timed out after ' + str(timeout) + ' s waiting for ' + device)
+                held.append(device)
+            yield
+        finally:
+            for device in reversed(held):
+                self._locks[device].release()
+
+device_locks = DeviceLocks() # for any robot interface without locks of its own
+_interface_locks = WeakKeyDictionary()
+
+def bind_device_locks(interface, locks):
+    '''Give one robot interface its own device locks, when several decks share a process.'''
+    _interface_locks[interface] = locks
+
+def locks_for(interface):
+    try:
+        return _interface_locks.get(interface, device_locks)
+    except TypeError: # not weak-referenceable, so never bound
+        return device_locks
+
+def uses(*devices):
+    '''Decorator: hold the named device locks of the interface passed first for the duration of each call.'''
+    def decorate(func):
+        @functools.wraps(func)
+        def locked_func(interface, *args, **kwargs):
+            with locks_for(interface).hold(*devices):
+                return func(interface, *args, **kwargs)
+        return locked_func
+    return decorate
+
+def hold_calls(obj, method_names, locks, device):
+    '''
+    Wrap the named methods of one device driver instance to hold its lock in locks for
+    each call, so a call from a task that didn't declare the device still waits its turn.
+    A call that returns a future, like a queued pump job, holds the lock only while the job
+    is queued, not while it runs; the driver's own job queue runs jobs one at a time, and
+    that is what keeps them from overlapping.
+    '''
+    for method_name in method_names:
+        method = getattr(obj, method_name)
+        def locked(*args, _method=method, **kwargs):
+            with locks.hold(device):
+                return _method(*args, **kwargs)
+        setattr(obj, method_name, functools.wraps(method)(locked))
+    return obj
+
+class TaskHandle(Future):
+    '''
+    Future for a task run by a DeckExecutor. join() is result() under the name thread
+    callers already use: it waits (by default up to the executor's timeout) and re-raises
+    whatever the task raised.
+    '''
+
+    def __init__(self, name, default_timeout=None):
+        super().__init__()
+        self.name = name
+        self.default_timeout = default_timeout
+
+    def join(self, timeout=None):
+        return self.result(self.default_timeout if timeout is None else timeout)
+
+    def __repr__(self):
+        return '<TaskHandle ' + self.name + (' done' if self.done() else ' pending') + '>'
+
+class DeckExecutor:
+    '''
+    Runs functions on worker threads while the caller carries on, each holding the deck
+    devices it declares. Failures are logged as they happen and re-raised at join().
+    Every task gets its own thread, which keeps per-thread state such as the digital twin's
+    virtual clock starting fresh for each task; the submitting thread's metrics deck label
+    is carried over.
+    '''
+
+    def __init__(self, locks=None, default_timeout=None, lock_timeout=None):
+        self.locks = device_locks if locks is None else locks
+        self.default_timeout = default_timeout
+        self.lock_timeout = lock_timeout
+        self._count = itertools.count()
+        self._outstanding = set()
+        self._lock = Lock()
+
+    def submit(self, func, *args, devices=(), name=None, timeout=None, locks=None, **kwargs):
+        name = name or getattr(func, '__name__', 'task')
+        locks = self.locks if locks is None else locks
+        handle = TaskHandle(name, self.default_timeout if timeout is None else timeout)
+        deck = current_deck()
+        def go():
+            if not handle.set_running_or_notify_cancel():
+                return
+            set_deck(deck)
+            try:
+                with locks.hold(*devices, timeout=self.lock_timeout):
+                    handle.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                logging.error('Async task ' + name + ' failed: ' + repr(e))
+                handle.set_exception(e)
+            finally:
+                with self._lock:
+                    self._outstanding.discard(handle)
+        with self._lock:
+            self._outstanding.add(handle)
+        Thread(target=go, name=name + '-' + str(next(self._count)), daemon=True).start()
+        return handle
+
+    def outstanding(self):
+        with self._lock:
+            return list(self._outstanding)
+
+    def join_all(self, timeout=None):
+        '''Wait for every outstanding task; re-raises the first failure.'''
+        for handle in self.outstanding():
+            handle.join(timeout)
+
+executor = DeckExecutor() # process-wide
@@ -0,0 +1,165 @@
+import os, time, logging
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread, Condition
+from meas_store import plate_data_rows
+from metrics import set_deck
+
+def wait_for_path(path, timeout=None, poll_interval=.5):
+    '''Poll until path exists. False if it still doesn't after timeout seconds.'''
+    deadline = None if timeout is None else time.time() + timeout
+    while not os.path.exists(path):
+        if deadline is not None and time.time() >= deadline:
+            return False
+        time.sleep(poll_interval if deadline is None else max(0, min(poll_interval, deadline - time.time())))
+    return True
+
+class DirectoryWatcher:
+    '''
+    Wakes up waiters as files turn up in a directory, so waiting for a reader result file
+    is a wakeup rather than a poll loop. Uses inotify (or the platform equivalent) via
+    watchdog when it is installed; waiters also recheck every poll_interval, which is all
+    there is without watchdog and covers any event it misses.
+    '''
+
+    def __init__(self, directory, poll_interval=.5):
+        self.directory = os.path.abspath(directory)
+        self.poll_interval = poll_interval
+        self._cond = Condition()
+        self._observer = None
+        try:
+            from watchdog.observers import Observer # optional
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_created(self, event):
+                watcher._saw(event.src_path)
+            def on_moved(self, event):
+                watcher._saw(event.dest_path)
+        self._observer = Observer()
+        self._observer.schedule(Handler(), directory)
+        self._observer.start()
+
+    def _saw(self, *paths):
+        with self._cond:
+            self._cond.notify_all()
+
+    def covers(self, path):
+        '''Whether path is directly in the watched directory; the watch is not recursive.'''
+        return os.path.dirname(os.path.abspath(path)) == self.directory
+
+    def wait_for(self, path, timeout=None):
+        '''Wait until path exists. False if it still doesn't after timeout seconds.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not os.path.exists(path):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+        return True
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+class IngestionWorker:
+    '''
+    Takes reader results off the robot's critical path. submit_read() returns at once with a
+    future per plate data, which resolves as soon as that file has appeared and been parsed;
+    only callers that need the values for a control decision ever wait on one. All the
+    rows from one read then go to the measurement store in a single transaction. With a
+    watch_dir, a result file that hasn't appeared after file_timeout seconds fails its
+    futures instead of holding up every later read; files elsewhere than watch_dir are
+    polled for. Without one, plate data is trusted to turn up (the twin's never touch disk).
+    '''
+
+    def __init__(self, store, watch_dir=None, file_timeout=None, deck=None):
+        self.store = store
+        self.deck = deck # recorded with every row, for stores several decks share
+        self.watch_dir = watch_dir
+        self.watcher = DirectoryWatcher(watch_dir) if watch_dir and os.path.isdir(watch_dir) else None
+        self.file_timeout = file_timeout
+        self._queue = Queue()
+        self._worker = Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def submit_read(self, entries):
+        '''
+        entries: (plate_data, data_type, plate, vessel_numbers, read_wells, vessel_type) for
+        each set of vessels read; the same plate data may appear in several entries. Returns
+        one future per entry, resolving to its parsed plate data.
+        '''
+        entries = list(entries)
+        futures = [Future() for _ in entries]
+        self._queue.put((entries, futures))
+        return futures
+
+    def _parse(self, plate_data):
+        if self.watch_dir is not None:
+            if self.watcher is not None and self.watcher.covers(plate_data.path):
+                found = self.watcher.wait_for(plate_data.path, self.file_timeout)
+            else:
+                found = wait_for_path(plate_data.path, self.file_timeout)
+            if not found:
+                raise IOError('Timed out waiting for reader result file ' + plate_data.path)
+        plate_data.wait_for_file()
+        return plate_data
+
+    def _work(self):
+        set_deck(self.deck) # database write timings
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._ingest(*item)
+            except Exception:
+                logging.exception('Ingestion: read failed') # keep the worker going for later reads
+                for future in item[1]:
+                    if not future.done():
+                        future.set_exception(IOError('Ingestion failed before this plate data was read'))
+            finally:
+                self._queue.task_done()
+
+    def _ingest(self, entries, futures):
+        parsed = {} # id(plate_data) -> parsed plate data or the exception parsing raised
+        rows = []
+        for entry, future in zip(entries, futures):
+            plate_data = entry[0]
+            if id(plate_data) not in parsed:
+                try:
+                    parsed[id(plate_data)] = self._parse(plate_data)
+                except Exception as e:
+                    logging.error('Ingestion: could not read ' + str(plate_data.path) + ': ' + repr(e))
+                    parsed[id(plate_data)] = e
+            result = parsed[id(plate_data)]
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                continue
+            try:
+                entry_rows = plate_data_rows(*entry, deck=self.deck)
+            except Exception as e:
+                logging.exception('Ingestion: could not build rows from ' + str(plate_data.path))
+                future.set_exception(e)
+                continue
+            rows.extend(entry_rows)
+            future.set_result(result)
+        try:
+            self.store.add_rows(rows) # the whole read in one transaction
+        except Exception:
+            logging.exception('Ingestion: writing ' + str(len(rows)) + ' rows failed')
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        if self.watcher is not None:
+            self.watcher.close()
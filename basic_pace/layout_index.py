@@ -0,0 +1,116 @@
+import os, json, hashlib, logging
+from bisect import bisect_left
+from weakref import WeakKeyDictionary
+from pyhamilton import LayoutManager, ResourceUnavailableError
+
+def layline_name(line):
+    '''Resource name for one layout line: its object ID if it has one, else its first field.'''
+    field = LayoutManager.layline_objid(line)
+    if field:
+        return field
+    return LayoutManager.layline_first_field(line)
+
+def layfile_hash(layfile):
+    with open(layfile, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def index_cache_path(layfile):
+    return os.path.splitext(layfile)[0] + '.layindex.json'
+
+class LayoutIndex:
+    '''
+    Every resource name in a layout, in layout order, found with one pass over its lines
+    rather than one pass per lookup. Exact names resolve through a dict and prefixes by
+    bisecting the sorted names. Resources are assigned into the layout manager's own table,
+    so lookups through the index and through assign_unused_resource never hand out the
+    same resource twice.
+    '''
+
+    def __init__(self, layout_manager, names):
+        self.layout_manager = layout_manager
+        self.names = names # layout order, no repeats
+        self._order = {name: i for i, name in enumerate(names)}
+        self._sorted = sorted(names)
+
+    @staticmethod
+    def names_from_lines(lines):
+        names, seen = [], set()
+        for line in lines:
+            name = layline_name(line)
+            if name and name not in seen:
+                seen.add(name)
+                names.append(name)
+        return names
+
+    def _assigned(self):
+        return self.layout_manager.resources
+
+    def with_prefix(self, prefix):
+        '''Names starting with prefix, in layout order.'''
+        start = bisect_left(self._sorted, prefix)
+        matches = []
+        for name in self._sorted[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(name)
+        matches.sort(key=self._order.__getitem__)
+        return matches
+
+    def assign(self, res_class, name):
+        '''The named resource, the same as assign_unused_resource(ResourceType(res_class, name)).'''
+        if name not in self._order or name in self._assigned():
+            raise ResourceUnavailableError('No unused resource named ' + name + ' in layout')
+        resource = self._assigned()[name] = res_class(name)
+        return resource
+
+    def assign_with_prefix(self, prefix, res_class, count):
+        '''The first count unused resources whose names start with prefix, in layout order.'''
+        free = [name for name in self.with_prefix(prefix) if name not in self._assigned()]
+        if len(free) < count:
+            raise ResourceUnavailableError('Layout has ' + str(len(free)) + ' unused resources named '
+                    + prefix + '*, ' + str(count) + ' needed')
+        return [self.assign(res_class, name) for name in free[:count]]
+
+_names_by_hash = {} # layouts already indexed in this process, e.g. by another deck
+_indexes = WeakKeyDictionary()
+
+def _load_names(layout_manager, layfile):
+    digest = layfile_hash(layfile)
+    if digest in _names_by_hash:
+        return _names_by_hash[digest]
+    cache_path = index_cache_path(layfile)
+    names = None
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('hash') == digest:
+            names = cached['names']
+    except (IOError, OSError, ValueError, KeyError):
+        pass # no cache, or an unreadable one; rebuild it
+    if names is None:
+        logging.info('Indexing layout ' + layfile)
+        names = LayoutIndex.names_from_lines(layout_manager.lines)
+        try:
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'hash': digest, 'names': names}, cache_file)
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write layout index cache ' + cache_path + ': ' + repr(e))
+    _names_by_hash[digest] = names
+    return names
+
+def layout_index(layout_manager, layfile=None):
+    '''
+    The index for a layout manager. The first call for a manager builds it, from the on-disk
+    cache beside layfile if that was made from the same file contents, otherwise by scanning
+    the manager's lines and rewriting the cache. Later calls return the same index.
+    '''
+    index = _indexes.get(layout_manager)
+    if index is None:
+        if layfile is None:
+            names = LayoutIndex.names_from_lines(layout_manager.lines)
+        else:
+            names = _load_names(layout_manager, layfile)
+        index = _indexes[layout_manager] = LayoutIndex(layout_manager, names)
+    return index
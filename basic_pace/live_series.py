@@ -0,0 +1,80 @@
+import numpy as np
+
+def lttb(x, y, threshold):
+    '''
+    Largest-Triangle-Three-Buckets downsampling: threshold points out of x, y (x sorted)
+    that keep the visual shape of the curve, spikes included, unlike plain decimation.
+    Returns the index array of the points kept.
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    kept = np.empty(threshold, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    edges = (1 + np.arange(threshold - 1)*(n - 2)/(threshold - 2)).astype(int) # threshold - 2 buckets between the ends
+    edges[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean() # the next bucket, or the last point
+        areas = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) - (x[a] - x[start:end])*(avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+    return kept
+
+class SeriesCache:
+    '''
+    One data type's readings for every vessel of a type, kept between refreshes of a live
+    view. refresh() fetches only rows added since the last one, by rowid, and appends them
+    to each vessel's series. With window set (seconds), points older than that before the
+    newest reading are dropped; otherwise history beyond max_points*4 per vessel is
+    compacted with LTTB, so memory stays bounded however long the run goes.
+    '''
+
+    def __init__(self, store, vessel_type, data_type, deck=None, window=None, max_points=2000):
+        self.store = store
+        self.vessel_type = vessel_type
+        self.data_type = data_type
+        self.deck = deck
+        self.window = window
+        self.max_points = max_points
+        self.last_rowid = 0
+        self.series = {} # vessel number -> (timestamps, readings)
+
+    def refresh(self):
+        '''Pull in new rows. Returns the vessel numbers that got new points.'''
+        self.last_rowid, vessels, times, readings = self.store.rows_since(
+                self.last_rowid, self.vessel_type, self.data_type, self.deck)
+        updated = set()
+        for vessel in np.unique(vessels):
+            mine = vessels == vessel
+            vessel = int(vessel)
+            old_times, old_readings = self.series.get(vessel, (np.empty(0), np.empty(0)))
+            new_times, new_readings = times[mine], readings[mine]
+            if len(old_times) and new_times.min() < old_times[-1]: # late rows, e.g. from a slow ingestion
+                all_times = np.concatenate([old_times, new_times])
+                order = np.argsort(all_times, kind='stable')
+                series = all_times[order], np.concatenate([old_readings, new_readings])[order]
+            else:
+                series = np.concatenate([old_times, new_times]), np.concatenate([old_readings, new_readings])
+            self.series[vessel] = self._bounded(*series)
+            updated.add(vessel)
+        return updated
+
+    def _bounded(self, times, readings):
+        if self.window is not None:
+            keep = times >= times[-1] - self.window
+            return times[keep], readings[keep]
+        if len(times) > self.max_points*4:
+            recent = self.max_points*2 # full resolution for the latest points
+            kept = lttb(times[:-recent], readings[:-recent], self.max_points)
+            return (np.concatenate([times[:-recent][kept], times[-recent:]]),
+                    np.concatenate([readings[:-recent][kept], readings[-recent:]]))
+        return times, readings
+
+    def visible(self, vessel, num_points=None):
+        '''One vessel's series downsampled to num_points (default max_points) for drawing.'''
+        times, readings = self.series.get(vessel, (np.empty(0), np.empty(0)))
+        kept = lttb(times, readings, num_points or self.max_points)
+        return times[kept], readings[kept]
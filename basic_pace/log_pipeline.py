@@ -0,0 +1,132 @@
+import os, gzip, json, time, shutil, atexit, logging, logging.handlers
+from queue import Queue
+
+default_format = '[%(asctime)s] %(name)s %(levelname)s %(message)s'
+
+class Lazy:
+    '''
+    A log message argument or structured field computed only when the record is written,
+    on the writer thread, so building long position strings never costs the robot thread.
+    Arguments are captured when the Lazy is made, so pass copies of anything mutable.
+    '''
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def value(self):
+        return self.func(*self.args)
+
+    def __str__(self):
+        return str(self.value())
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''Puts records on the queue as they are; the stock QueueHandler formats them first, on the caller's thread.'''
+
+    def prepare(self, record):
+        return record
+
+def _gzip_rotate(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Rolls the file over once it reaches max_bytes or interval seconds after it was started,
+    whichever comes first, and gzips each rolled-over file; the oldest beyond backup_count
+    are deleted.
+    '''
+
+    def __init__(self, filename, max_bytes=50*2**20, interval=24*3600, backup_count=60):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.namer = lambda name: name + '.gz'
+        self.rotator = _gzip_rotate
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return 1
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class StructuredFormatter(logging.Formatter):
+    '''One JSON object per record: time, level, logger, thread, message and the record's fields.'''
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key] = value.value() if isinstance(value, Lazy) else value
+        return json.dumps(entry, default=str)
+
+def has_fields(record):
+    return hasattr(record, 'fields')
+
+_listeners = [] # (listener, the root logger's handler feeding it)
+
+def start_logging(log_path, level=logging.DEBUG, fmt=default_format, max_bytes=50*2**20, interval=24*3600,
+        backup_count=60, structured=True):
+    '''
+    Send every record through a queue to a writer thread, which formats it and writes it to
+    log_path, and with structured=True writes the records that carry fields (log calls
+    with extra={'fields': {...}}) to a .jsonl file beside it as well. Both files rotate and
+    compress as CompressedRotatingFileHandler. Logging calls only ever enqueue. Returns the
+    listener; stop_logging(), also run at exit, drains the queue and takes the handler off
+    the root logger. To write to more files, add_log_file() rather than start again.
+    '''
+    log_queue = Queue()
+    text_handler = CompressedRotatingFileHandler(log_path, max_bytes, interval, backup_count)
+    text_handler.setFormatter(logging.Formatter(fmt))
+    handlers = [text_handler]
+    if structured:
+        fields_handler = CompressedRotatingFileHandler(os.path.splitext(log_path)[0] + '.jsonl',
+                max_bytes, interval, backup_count)
+        fields_handler.setFormatter(StructuredFormatter())
+        fields_handler.addFilter(has_fields)
+        handlers.append(fields_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    queue_handler = DeferredQueueHandler(log_queue)
+    root.addHandler(queue_handler)
+    listener.start()
+    if not _listeners:
+        atexit.register(stop_logging)
+    _listeners.append((listener, queue_handler))
+    return listener
+
+def add_log_file(log_path, fmt=default_format, max_bytes=50*2**20, interval=24*3600, backup_count=60,
+        logger_name=None):
+    '''
+    Also write every record to log_path, from the writer thread of the last start_logging(),
+    so a record is queued once however many files it goes to. With logger_name, only that
+    logger's records (and its children's) go to log_path. Starts logging to log_path alone
+    if logging hasn't been started.
+    '''
+    if not _listeners:
+        listener = start_logging(log_path, fmt=fmt, max_bytes=max_bytes, interval=interval,
+                backup_count=backup_count, structured=False)
+        if logger_name:
+            listener.handlers[0].addFilter(logging.Filter(logger_name))
+        return listener
+    handler = CompressedRotatingFileHandler(log_path, max_bytes, interval, backup_count)
+    handler.setFormatter(logging.Formatter(fmt))
+    if logger_name:
+        handler.addFilter(logging.Filter(logger_name))
+    listener = _listeners[-1][0]
+    listener.handlers += (handler,) # the writer thread picks the new tuple up with the next record
+    return listener
+
+def stop_logging():
+    while _listeners:
+        listener, queue_handler = _listeners.pop()
+        logging.getLogger().removeHandler(queue_handler)
+        listener.stop() # writes out whatever is still queued
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,272 @@
+import sqlite3, logging
+from datetime import datetime
+from threading import Thread, Lock
+from queue import Queue
+import numpy as np
+
+SCHEMA_VERSION = 3
+
+_vessel_columns = {'turbidostat': 'turb_number', 'lagoon': 'lagoon_number'}
+
+_create_table_sql = '''CREATE TABLE if not exists measurements
+            (lagoon_number INTEGER, turb_number INTEGER, filename TEXT, plate_id TEXT, timestamp REAL,
+            well TEXT, measurement_delay_time REAL, reading REAL, data_type TEXT, deck TEXT)'''
+
+_create_index_sqls = [
+    'CREATE INDEX if not exists meas_turb_idx ON measurements (turb_number, data_type, timestamp)',
+    'CREATE INDEX if not exists meas_lagoon_idx ON measurements (lagoon_number, data_type, timestamp)']
+
+_time_formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S',
+                 '%d/%m/%Y %H:%M:%S', '%d.%m.%Y %H:%M:%S']
+
+def epoch_seconds(timestamp, filename=None):
+    '''
+    Best-effort conversion of a plate reader timestamp to seconds since the epoch. Falls
+    back on the _yymmdd_HHMM suffix that reader result files are saved with.
+    '''
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    if isinstance(timestamp, str):
+        try:
+            return float(timestamp)
+        except ValueError:
+            pass
+        for fmt in _time_formats:
+            try:
+                return datetime.strptime(timestamp.strip(), fmt).timestamp()
+            except ValueError:
+                pass
+    if filename:
+        try:
+            return datetime.strptime(filename[-15:-4], '%y%m%d_%H%M').timestamp()
+        except ValueError:
+            pass
+    return None
+
+def _migrate_v1(db_conn):
+    # v1 tables had untyped columns and whatever the reader header held as a timestamp
+    db_conn.create_function('epoch_seconds', 2, epoch_seconds)
+    db_conn.execute('ALTER TABLE measurements RENAME TO measurements_v1')
+    db_conn.execute(_create_table_sql)
+    db_conn.execute('''INSERT INTO measurements SELECT lagoon_number, turb_number, filename, plate_id,
+            epoch_seconds(timestamp, filename), well, measurement_delay_time, reading, data_type, NULL
+            FROM measurements_v1''')
+    untimed, = db_conn.execute('SELECT count(*) FROM measurements WHERE timestamp IS NULL').fetchone()
+    if untimed:
+        examples = db_conn.execute('''SELECT DISTINCT timestamp, filename FROM measurements_v1
+                WHERE epoch_seconds(timestamp, filename) IS NULL LIMIT 3''').fetchall()
+        logging.warning('Migration could not read a timestamp for ' + str(untimed) + ' of ' +
+                str(db_conn.execute('SELECT count(*) FROM measurements').fetchone()[0]) + ' rows; they are kept ' +
+                'with a NULL timestamp, which time-based queries skip. E.g. (timestamp, filename): ' +
+                ', '.join(repr(tuple(example)) for example in examples))
+    db_conn.execute('DROP TABLE measurements_v1')
+
+def _migrate_v2(db_conn):
+    # v2 tables predate several decks sharing one database
+    db_conn.execute('ALTER TABLE measurements ADD COLUMN deck TEXT')
+
+def ensure_meas_table_exists(db_conn):
+    '''
+    Definitions of the fields in this table:
+    Exactly one of the following should have a value:
+        lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
+        turb_number - the number of a turbidostat, uniquely identifying the culture contained
+    filename - absolute path to the file in which this data is housed
+    plate_id - ID field given when measurement was requested, should match ID in data file
+    timestamp - time at which the measurement was taken, in seconds since the epoch
+    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
+    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
+                            measurement was taken. For migration, we consider this to be 0
+                            minutes in the absense of pipetting time values
+    reading - the raw measured value from the plate reader
+    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
+    deck - name of the deck the vessel is on, when several decks share one database; NULL
+            for single-deck runs and for data migrated from before decks were recorded
+
+    The schema version is kept in PRAGMA user_version. Version 1 databases (untyped
+    columns, no indexes, raw reader timestamps) and version 2 databases (no deck column)
+    are migrated in place.
+    '''
+    version, = db_conn.execute('PRAGMA user_version').fetchone()
+    if version >= SCHEMA_VERSION:
+        return
+    db_conn.execute('BEGIN IMMEDIATE') # another process sharing the database may be migrating it too
+    try:
+        version, = db_conn.execute('PRAGMA user_version').fetchone()
+        if version >= SCHEMA_VERSION:
+            db_conn.rollback()
+            return
+        table_exists = db_conn.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='measurements'").fetchone()[0]
+        if table_exists and version < 2:
+            logging.info('Migrating measurements table in place to schema version ' + str(SCHEMA_VERSION))
+            _migrate_v1(db_conn)
+        elif table_exists and version < 3:
+            logging.info('Migrating measurements table in place to schema version ' + str(SCHEMA_VERSION))
+            _migrate_v2(db_conn)
+        else:
+            db_conn.execute(_create_table_sql)
+        for index_sql in _create_index_sqls:
+            db_conn.execute(index_sql)
+        db_conn.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+
+def plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells, vessel_type, deck=None):
+    if vessel_type not in ('turbidostat', 'lagoon'):
+        raise ValueError("Only vessel types are 'turbidostat' and 'lagoon'")
+    filename = plate_data.path
+    plate_id = plate_data.header.plate_ids[0]
+    timestamp = epoch_seconds(plate_data.header.time, filename)
+    if timestamp is None:
+        logging.warning('No timestamp could be read for plate ' + str(plate_id) + ' from ' + repr(plate_data.header.time) +
+                ' or ' + str(filename) + '; its ' + data_type + ' rows are stored with a NULL timestamp')
+    measurement_delay_time = 0.0
+    rows = []
+    for vessel_number, read_well in zip(vessel_numbers, read_wells):
+        well = plate.position_id(read_well)
+        reading = plate_data.value_at(*plate.well_coords(read_well))
+        if vessel_type == 'turbidostat':
+            turb_number, lagoon_number = vessel_number, None
+        else:
+            turb_number, lagoon_number = None, vessel_number
+        rows.append((lagoon_number, turb_number, filename, plate_id, timestamp, well, measurement_delay_time,
+                reading, data_type, deck))
+    return rows
+
+class MeasurementStore:
+    '''
+    Long-lived handle on the measurements database. One connection is held open for the
+    life of the store, the database is put in WAL mode, and each plate's rows go in as a
+    single executemany transaction. With background=True, writes are handed to a writer
+    thread so the caller never waits on disk; call flush() to wait for them to land.
+    '''
+
+    _insert_sql = 'INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?,?,?)'
+
+    def __init__(self, db_path, background=False):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False) # decks in other processes may share the file
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        ensure_meas_table_exists(self._conn)
+        self._lock = Lock()
+        self._queue = None
+        self._writer = None
+        if background:
+            self._queue = Queue()
+            self._writer = Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_rows(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(self._insert_sql, rows)
+
+    def _write_loop(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                self._write_rows(rows)
+            except Exception:
+                logging.exception('MeasurementStore: background write of ' + str(len(rows)) + ' rows failed')
+            finally:
+                self._queue.task_done()
+
+    def add_rows(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        if self._queue is not None:
+            self._queue.put(rows)
+        else:
+            self._write_rows(rows)
+
+    def add_plate_data(self, plate_data, data_type, plate, vessel_numbers, read_wells, vessel_type, deck=None):
+        self.add_rows(plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells, vessel_type, deck))
+
+    def series(self, vessel_type, vessel_number, data_type, start=None, end=None, deck=None):
+        '''
+        Readings for one vessel between epoch times start (inclusive) and end (exclusive),
+        as a pair of float arrays (timestamps, readings) sorted by time. Served from the
+        (vessel, data_type, timestamp) index rather than a table scan. Pass deck to pick
+        one deck's vessel out of a database several decks share.
+        '''
+        try:
+            vessel_col = _vessel_columns[vessel_type]
+        except KeyError:
+            raise ValueError("Only vessel types are 'turbidostat' and 'lagoon'")
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        deck_clause, deck_args = ('', ()) if deck is None else (' AND deck=?', (deck,))
+        with self._lock:
+            rows = self._conn.execute('SELECT timestamp, reading FROM measurements WHERE ' + vessel_col +
+                    '=? AND data_type=? AND timestamp>=? AND timestamp<?' + deck_clause + ' ORDER BY timestamp',
+                    (vessel_number, data_type, start, end) + deck_args).fetchall()
+        data = np.array(rows, dtype=float).reshape(-1, 2)
+        return data[:, 0], data[:, 1]
+
+    def vessels(self, vessel_type, data_type, deck=None):
+        '''Sorted numbers of the vessels of this type with at least one reading of data_type.'''
+        try:
+            vessel_col = _vessel_columns[vessel_type]
+        except KeyError:
+            raise ValueError("Only vessel types are 'turbidostat' and 'lagoon'")
+        deck_clause, deck_args = ('', ()) if deck is None else (' AND deck=?', (deck,))
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT ' + vessel_col + ' FROM measurements WHERE ' + vessel_col +
+                    ' IS NOT NULL AND data_type=?' + deck_clause + ' ORDER BY ' + vessel_col,
+                    (data_type,) + deck_args).fetchall()
+        return [row[0] for row in rows]
+
+    def decks(self):
+        '''Sorted names of the decks with readings in the database, None for rows with no deck.'''
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT deck FROM measurements').fetchall()
+        return sorted((row[0] for row in rows), key=lambda deck: (deck is not None, deck or ''))
+
+    def rows_since(self, rowid, vessel_type, data_type, deck=None):
+        '''
+        Every vessel's readings added after rowid, in one query on the rowid rather than one
+        per vessel, for readers that poll for new data. Readings with no timestamp are left
+        out. Returns the last rowid seen (rowid again if nothing is new) and float arrays
+        (vessel_numbers, timestamps, readings).
+        '''
+        try:
+            vessel_col = _vessel_columns[vessel_type]
+        except KeyError:
+            raise ValueError("Only vessel types are 'turbidostat' and 'lagoon'")
+        deck_clause, deck_args = ('', ()) if deck is None else (' AND deck=?', (deck,))
+        with self._lock:
+            rows = self._conn.execute('SELECT rowid, ' + vessel_col + ', timestamp, reading FROM measurements ' +
+                    'WHERE rowid>? AND ' + vessel_col + ' IS NOT NULL AND timestamp IS NOT NULL AND data_type=?' +
+                    deck_clause + ' ORDER BY rowid',
+                    (rowid, data_type) + deck_args).fetchall()
+        if not rows:
+            return rowid, np.empty(0), np.empty(0), np.empty(0)
+        data = np.array(rows, dtype=float)
+        return rows[-1][0], data[:, 1], data[:, 2], data[:, 3]
+
+    def flush(self):
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._queue = None
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
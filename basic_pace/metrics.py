@@ -0,0 +1,247 @@
+import time, bisect, functools, logging
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Lock, Thread, local
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Seconds, spanning single robot and pump commands up to whole service cycles
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600)
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _label_str(pairs):
+    return '{' + ','.join(name + '="' + _escape(value) + '"' for name, value in pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+_context = local()
+
+def set_deck(deck):
+    '''Label the robot, reader and device metrics this thread records with deck.'''
+    _context.deck = deck or ''
+
+def current_deck():
+    '''This thread's deck label, '' if none was set, as for single-deck runs.'''
+    return getattr(_context, 'deck', '')
+
+class Metric:
+    '''One named metric and a value per combination of label values, passed as keyword arguments.'''
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names) or any(name not in labels for name in self.label_names):
+            raise ValueError('Metric ' + self.name + ' takes labels ' + ', '.join(self.label_names) +
+                    ', got ' + ', '.join(sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        '''(suffix, label pairs, value) for every sample, for the exposition format.'''
+        with self._lock:
+            return [('', list(zip(self.label_names, key)), value) for key, value in sorted(self._values.items())]
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters only go up')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    '''Counts of observations at or below each bucket bound, with their sum and count.'''
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0]*(len(self.buckets) + 1), 0.0, 0]
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, clock=None, **labels):
+        clock = clock or registry.clock
+        start_time = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start_time, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                pairs = list(zip(self.label_names, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', pairs + [('le', _format_value(bound))], cumulative))
+                samples.append(('_sum', pairs, total))
+                samples.append(('_count', pairs, count))
+        return samples
+
+    def value(self, **labels):
+        '''(sum, count) of the observations with these labels, or None.'''
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return None if entry is None else (entry[1], entry[2])
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Registry:
+    '''
+    Counters, gauges and histograms, created once by name and updated from any thread,
+    and served in the Prometheus text format by serve(). clock times durations measured
+    through the registry; set it to a virtual clock in simulation, as with the tracer.
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.clock = time.time
+        self.server = None
+        self._lock = Lock()
+
+    def _get(self, metric_class, name, help_text, label_names, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, help_text, label_names, **kwargs)
+            elif type(metric) is not metric_class or metric.label_names != tuple(label_names):
+                raise ValueError('Metric ' + name + ' already registered as a ' + metric.kind +
+                        ' with labels ' + ', '.join(metric.label_names))
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._get(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._get(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=default_buckets):
+        return self._get(Histogram, name, help_text, label_names, buckets=buckets)
+
+    def exposition(self):
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP ' + metric.name + ' ' + metric.help_text.replace('\\', r'\\').replace('\n', r'\n'))
+            lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+            for suffix, pairs, value in metric.samples():
+                lines.append(metric.name + suffix + _label_str(pairs) + ' ' + _format_value(value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        '''
+        Serve the exposition at http://host:port/metrics from a daemon thread. Localhost
+        only unless told otherwise. Serving again while already serving does nothing.
+        '''
+        if self.server is not None:
+            return self.server
+        registry = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass # scrapes every few seconds would drown the log
+        self.server = _ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=self.server.serve_forever, name='metrics_server', daemon=True).start()
+        logging.info('Serving metrics at http://' + host + ':' + str(self.server.server_address[1]) + '/metrics')
+        return self.server
+
+    def stop_serving(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def time_calls(self, obj, method_names, device):
+        '''
+        Wrap the named methods of one object instance to observe how long each call takes.
+        A call that returns a future, like a queued pump job, is timed until the future is done.
+        Each call is labelled with the deck of the thread making it.
+        '''
+        for method_name in method_names:
+            method = getattr(obj, method_name)
+            def timed(*args, _method=method, _call=type(obj).__name__ + '.' + method_name, **kwargs):
+                start_time, deck = self.clock(), current_deck()
+                result = _method(*args, **kwargs)
+                def observe(_=None):
+                    device_call_seconds.observe(self.clock() - start_time, deck=deck, device=device, call=_call)
+                if isinstance(result, Future):
+                    result.add_done_callback(observe)
+                else:
+                    observe()
+                return result
+            setattr(obj, method_name, functools.wraps(method)(timed))
+        return obj
+
+registry = Registry() # process-wide
+time_calls = registry.time_calls
+
+# Shared by the modules that record them
+task_duration_seconds = registry.histogram('pace_task_duration_seconds',
+        'How long each run of a scheduled service task took', ('deck', 'task'))
+task_lateness_seconds = registry.histogram('pace_task_lateness_seconds',
+        'How long after its deadline each run of a scheduled task started', ('deck', 'task'))
+task_interval_seconds = registry.gauge('pace_task_interval_seconds',
+        'Interval a scheduled task is meant to run at; compare with its durations for headroom', ('deck', 'task'))
+task_missed_deadlines = registry.counter('pace_task_missed_deadlines_total',
+        'Deadlines a scheduled task overran', ('deck', 'task'))
+command_seconds = registry.histogram('pace_command_seconds',
+        'Time from sending a robot command to its response, queueing included when pipelined', ('deck', 'command'))
+reader_protocol_seconds = registry.histogram('pace_reader_protocol_seconds',
+        'How long each plate reader run took', ('deck', 'protocols'))
+device_call_seconds = registry.histogram('pace_device_call_seconds',
+        'How long each pump, shaker and database call took', ('deck', 'device', 'call'))
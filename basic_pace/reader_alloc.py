@@ -0,0 +1,96 @@
+class ReaderQuadrant:
+    '''
+    One quarter of a reader plate: the site to dispense a 24-vessel sample into with the 96
+    head, and the well offset that site adds to each vessel's 96-well index.
+    '''
+
+    def __init__(self, plate, site, offset, plate_idx, quadrant_idx):
+        self.plate = plate
+        self.site = site
+        self.offset = offset
+        self.plate_idx = plate_idx
+        self.quadrant_idx = quadrant_idx
+
+    def wells(self, vessel_wells):
+        return [w + self.offset for w in vessel_wells]
+
+    def __repr__(self):
+        return '<ReaderQuadrant ' + self.site.layout_name() + ' (+' + str(self.offset) + ')>'
+
+class ReaderPlateAllocator:
+    '''
+    Hands out free reader plate quadrants to whichever services need to sample. A request
+    for several quadrants is always filled from a single plate so the samples can share one
+    trip to the reader; quadrants skipped over that way stay free for later requests.
+    reader_plates is a list of per-plate quadrant site tuples, first entry the plate itself.
+    With recycle=True, running out starts over from the first plate, e.g. when used plates
+    get swapped for fresh ones.
+    '''
+
+    def __init__(self, reader_plates, offsets=(0, 8, 1, 9), recycle=False):
+        self.reader_plates = [tuple(quadrants) for quadrants in reader_plates]
+        self.offsets = tuple(offsets) # 96-indexed offsets to get cell and cells to right, bottom, and bottom-right
+        self.recycle = recycle
+        self.used = set() # (plate_idx, quadrant_idx)
+
+    def _free_in(self, plate_idx):
+        return [q for q in range(len(self.offsets)) if (plate_idx, q) not in self.used]
+
+    def free_quadrants(self):
+        return sum(len(self._free_in(p)) for p in range(len(self.reader_plates)))
+
+    def allocate(self, count=1):
+        if not 1 <= count <= len(self.offsets):
+            raise ValueError('Can only allocate 1 to ' + str(len(self.offsets)) + ' quadrants on one reader plate')
+        for plate_idx in range(len(self.reader_plates)):
+            free = self._free_in(plate_idx)
+            if len(free) >= count:
+                taken = free[:count]
+                self.used.update((plate_idx, q) for q in taken)
+                quadrants = self.reader_plates[plate_idx]
+                return [ReaderQuadrant(quadrants[0], quadrants[q], self.offsets[q], plate_idx, q) for q in taken]
+        if self.recycle:
+            self.used = set()
+            return self.allocate(count)
+        raise RuntimeError('Out of reader plates: no plate has ' + str(count) + ' free quadrant(s)')
+
+    def state(self):
+        return {'used': sorted([p, q] for p, q in self.used)}
+
+    def restore(self, state):
+        self.used = set((p, q) for p, q in state.get('used', []))
+
+class ReadRequest:
+    '''
+    Samples one service put in a reader quadrant, and the data types it wants back. After a
+    combined read, results maps each data type to the plate data it came from, and once
+    handed to ingestion, parsed maps each data type to a future for the parsed plate data.
+    '''
+
+    def __init__(self, name, quadrant, protocols, data_types, vessel_type, vessels, wells):
+        self.name = name
+        self.quadrant = quadrant
+        self.protocols = list(protocols)
+        self.data_types = list(data_types)
+        self.vessel_type = vessel_type
+        self.vessels = list(vessels)
+        self.wells = list(wells)
+        self.results = {}
+        self.parsed = {}
+
+def combined_protocols(requests):
+    '''Every protocol any of the requests needs, each run once, in first-requested order.'''
+    protocols = []
+    for request in requests:
+        for protocol in request.protocols:
+            if protocol not in protocols:
+                protocols.append(protocol)
+    return protocols
+
+def demultiplex(requests, protocols, plate_datas):
+    '''Hand each request the plate data for its own protocols out of one combined read.'''
+    by_protocol = dict(zip(protocols, plate_datas))
+    for request in requests:
+        request.results = {data_type: by_protocol[protocol]
+                for protocol, data_type in zip(request.protocols, request.data_types)}
+    return requests
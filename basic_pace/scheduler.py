@@ -0,0 +1,208 @@
+import time, heapq, itertools, logging
+from metrics import task_duration_seconds, task_lateness_seconds, task_interval_seconds, task_missed_deadlines
+
+# What to do with the deadlines a task missed while something else (or it) ran long
+SKIP = 'skip' # drop the missed slots and wait for the next one on the original grid
+CATCH_UP = 'catch_up' # run once for every missed slot, back to back
+COALESCE = 'coalesce' # run once right away for all the missed slots, then keep the interval from there
+
+class TaskStats:
+
+    def __init__(self):
+        self.runs = 0
+        self.missed = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def record(self, lateness, duration):
+        self.runs += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+
+    def mean_lateness(self):
+        return self.total_lateness/self.runs if self.runs else 0.0
+
+    def mean_duration(self):
+        return self.total_duration/self.runs if self.runs else 0.0
+
+    def as_dict(self):
+        return {'runs': self.runs, 'missed': self.missed,
+                'last_lateness': self.last_lateness, 'max_lateness': self.max_lateness,
+                'mean_lateness': self.mean_lateness(),
+                'last_duration': self.last_duration, 'max_duration': self.max_duration,
+                'mean_duration': self.mean_duration()}
+
+class ScheduledTask:
+
+    def __init__(self, name, func, interval, policy=SKIP, args=()):
+        if policy not in (SKIP, CATCH_UP, COALESCE):
+            raise ValueError('Unknown missed-deadline policy ' + repr(policy))
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.policy = policy
+        self.args = args
+        self.deadline = None
+        self.group = None
+        self.stats = TaskStats()
+        self.overdue = 0 # CATCH_UP slots already counted as missed, the one it is running included
+
+class TaskGroup:
+
+    def __init__(self, name, func, members, window):
+        self.name = name
+        self.func = func
+        self.members = members
+        self.window = window
+
+class Scheduler:
+    '''
+    Runs periodic tasks from a heap of deadlines, sleeping exactly until the next one
+    instead of polling. Tasks run one at a time on the calling thread; how late each run
+    started and how long it took are kept in per-task TaskStats so drift can be bounded.
+    clock and sleep can be swapped out, e.g. for a virtual clock in simulation. The same
+    figures go to the metrics registry, labelled with deck.
+    '''
+
+    def __init__(self, clock=time.time, sleep=time.sleep, deck=None):
+        self.clock = clock
+        self.sleep = sleep
+        self.deck = deck or ''
+        self.tasks = {}
+        self.groups = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._stopped = False
+
+    def add(self, name, func, interval, policy=SKIP, first_time=None, args=()):
+        if name in self.tasks:
+            raise ValueError('Task ' + name + ' already scheduled')
+        task = ScheduledTask(name, func, interval, policy, args)
+        self.tasks[name] = task
+        task_interval_seconds.set(interval, deck=self.deck, task=name)
+        self._push(task, self.clock() if first_time is None else first_time)
+        return task
+
+    def combine(self, name, members, func, window=0.0):
+        '''
+        When a member task comes due, also run any other members due within window seconds
+        of now, all in one call: func(due_member_names, *args) with the first member's args.
+        Each member keeps its own interval, deadline and stats.
+        '''
+        if name in self.groups:
+            raise ValueError('Group ' + name + ' already defined')
+        tasks = [self.tasks[m] for m in members]
+        for task in tasks:
+            if task.group is not None:
+                raise ValueError('Task ' + task.name + ' is already in group ' + task.group.name)
+        group = TaskGroup(name, func, tasks, window)
+        for task in tasks:
+            task.group = group
+        self.groups[name] = group
+        return group
+
+    def _push(self, task, deadline):
+        task.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), task))
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def _next_deadline_after_run(self, task, deadline, end_time):
+        next_time = deadline + task.interval
+        overdue = int((end_time - next_time)//task.interval) + 1 if next_time <= end_time else 0
+        missed = overdue
+        if task.policy == CATCH_UP:
+            # missed slots still run, back to back, so count each only the first time a run ends past it
+            missed = max(0, overdue - max(0, task.overdue - 1))
+            task.overdue = overdue
+        if missed:
+            task.stats.missed += missed
+            task_missed_deadlines.inc(missed, deck=self.deck, task=task.name)
+            logging.warning('Scheduler: task ' + task.name + ' overran ' + str(missed) + ' deadline(s), policy ' + task.policy)
+        if task.policy == CATCH_UP or not overdue:
+            return next_time
+        if task.policy == SKIP:
+            return next_time + overdue*task.interval
+        return end_time # COALESCE
+
+    def _pop_group_members(self, group, now):
+        due = [entry for entry in self._heap if entry[2].group is group and entry[0] <= now + group.window]
+        if due:
+            self._heap = [entry for entry in self._heap if entry not in due]
+            heapq.heapify(self._heap)
+        return [(deadline, task) for deadline, _, task in sorted(due)]
+
+    def _run_task(self, task, deadline):
+        due = [(deadline, task)]
+        if task.group is not None:
+            due += self._pop_group_members(task.group, self.clock())
+        start_time = self.clock()
+        try:
+            if task.group is None:
+                task.func(*task.args)
+            else:
+                task.group.func([t.name for _, t in due], *task.args)
+        finally:
+            end_time = self.clock()
+            for member_deadline, member in due:
+                lateness = start_time - member_deadline
+                member.stats.record(lateness, end_time - start_time)
+                task_duration_seconds.observe(end_time - start_time, deck=self.deck, task=member.name)
+                task_lateness_seconds.observe(lateness, deck=self.deck, task=member.name)
+                logging.info('Scheduler: task ' + member.name + ' started ' + '{:.3f}'.format(lateness) +
+                        ' s late and ran for ' + '{:.3f}'.format(end_time - start_time) + ' s' +
+                        ('' if member.group is None else ' in group ' + member.group.name + ' with ' + str(len(due)) + ' due'))
+                self._push(member, self._next_deadline_after_run(member, member_deadline, end_time))
+
+    def run_pending(self):
+        '''Run every task whose deadline has passed, in deadline order. Returns how many ran.'''
+        now = self.clock()
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, task = heapq.heappop(self._heap)
+            self._run_task(task, deadline)
+            ran += 1
+        return ran
+
+    def run(self, until=None):
+        '''Run tasks as they come due until stop() is called or the clock passes until.'''
+        self._stopped = False
+        while self._heap and not self._stopped:
+            deadline = self._heap[0][0]
+            if until is not None and deadline > until:
+                break
+            wait = deadline - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+                continue
+            deadline, _, task = heapq.heappop(self._heap)
+            self._run_task(task, deadline)
+
+    def stop(self):
+        self._stopped = True
+
+    def state(self):
+        '''Each task's deadline; a task that is running still has the deadline it is running for.'''
+        return {'deadlines': {name: task.deadline for name, task in self.tasks.items()}}
+
+    def restore(self, state):
+        '''Put tasks back on the deadlines saved by state(). Tasks not in the saved state keep theirs.'''
+        deadlines = state.get('deadlines', {})
+        self._heap = [entry for entry in self._heap if entry[2].name not in deadlines]
+        heapq.heapify(self._heap)
+        for name, deadline in deadlines.items():
+            if name in self.tasks:
+                self.tasks[name].overdue = 0
+                self._push(self.tasks[name], deadline)
+
+    def stats(self):
+        return {name: task.stats.as_dict() for name, task in self.tasks.items()}
@@ -0,0 +1,137 @@
+import time, logging
+from threading import Condition
+from executor import executor as default_executor
+
+class Step:
+
+    def __init__(self, name, func, devices, after):
+        self.name = name
+        self.func = func
+        self.devices = tuple(devices)
+        self.after = list(after)
+        self.handle = None
+        self.start = None
+        self.end = None
+
+    def duration(self):
+        return 0.0 if self.start is None or self.end is None else self.end - self.start
+
+class StepGraph:
+    '''
+    A service cycle as a dependency graph of steps, each tagged with the deck devices it
+    uses. run() starts every step whose prerequisites are done and whose devices no running
+    step holds, each on its own executor thread holding its device locks, so independent
+    work overlaps without hand-written async choreography. A step must name every device
+    the code inside it touches; the device locks keep undeclared use safe, but not fast.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = {}
+
+    def add(self, name, func, devices=(), after=()):
+        if name in self.steps:
+            raise ValueError('Step ' + name + ' already in graph ' + self.name)
+        for dep in after:
+            if dep not in self.steps:
+                raise ValueError('Step ' + name + ' depends on unknown step ' + dep)
+        self.steps[name] = Step(name, func, devices, after) # deps must already exist, so no cycles
+        return name
+
+    def run(self, executor=None, clock=time.time, set_thread_time=None, on_step_done=None):
+        '''
+        Run the graph to completion. On the first failure no new steps start; the running
+        ones are waited for and the failure is re-raised. set_thread_time(t), if given, is
+        called at the start of each step thread with the time its last prerequisite ended or
+        its devices came free, and on the calling thread at the end, for clocks that keep
+        per-thread time. on_step_done(name), if given, is called on the calling thread as each
+        step succeeds, e.g. to checkpoint progress.
+        '''
+        executor = executor or default_executor
+        cond = Condition()
+        pending = list(self.steps.values())
+        running = []
+        busy = set()
+        free_at = {} # device -> when the last step holding it ended
+        done = set()
+        failure = None
+        graph_start = clock()
+        def launch(step):
+            not_before = max([self.steps[dep].end for dep in step.after] +
+                    [free_at[d] for d in step.devices if d in free_at] + [graph_start])
+            def go():
+                if set_thread_time is not None:
+                    set_thread_time(not_before)
+                step.start = clock()
+                try:
+                    return step.func()
+                finally:
+                    step.end = clock()
+            def notify(handle):
+                with cond:
+                    cond.notify_all()
+            step.handle = executor.submit(go, devices=step.devices, name=self.name + '.' + step.name)
+            step.handle.add_done_callback(notify)
+        with cond:
+            while pending or running:
+                if failure is None:
+                    for step in list(pending):
+                        if all(dep in done for dep in step.after) and not busy.intersection(step.devices):
+                            pending.remove(step)
+                            running.append(step)
+                            busy.update(step.devices)
+                            launch(step)
+                elif pending:
+                    logging.warning('Step graph ' + self.name + ': not starting ' +
+                            ', '.join(s.name for s in pending) + ' after a failure')
+                    pending = []
+                finished = [s for s in running if s.handle.done()]
+                if not finished:
+                    if not running:
+                        raise RuntimeError('Step graph ' + self.name + ' is stuck with ' +
+                                ', '.join(s.name for s in pending) + ' unable to start')
+                    cond.wait()
+                    continue
+                for step in finished:
+                    running.remove(step)
+                    busy.difference_update(step.devices)
+                    free_at.update((d, step.end) for d in step.devices)
+                    if step.handle.exception() is not None:
+                        failure = failure or step.handle.exception()
+                    else:
+                        done.add(step.name)
+                        if on_step_done is not None:
+                            on_step_done(step.name)
+        if set_thread_time is not None:
+            set_thread_time(max([s.end for s in self.steps.values() if s.end is not None] or [graph_start]))
+        if failure is not None:
+            raise failure
+        return {name: step.handle.result() for name, step in self.steps.items()}
+
+    def critical_path(self):
+        '''The chain of dependent steps with the largest total duration, and that total.'''
+        longest = {}
+        for name, step in self.steps.items(): # insertion order is a topological order
+            best_dep = max(step.after, key=lambda dep: longest[dep][0], default=None)
+            before, path = longest[best_dep] if best_dep is not None else (0.0, [])
+            longest[name] = (before + step.duration(), path + [name])
+        if not longest:
+            return [], 0.0
+        total, path = max(longest.values(), key=lambda entry: entry[0])
+        return path, total
+
+    def report(self):
+        started = [s for s in self.steps.values() if s.start is not None]
+        t0 = min((s.start for s in started), default=0.0)
+        makespan = max((s.end for s in started if s.end is not None), default=t0) - t0
+        path, path_time = self.critical_path()
+        return {'graph': self.name, 'makespan': makespan,
+                'serial_time': sum(s.duration() for s in started),
+                'critical_path': path, 'critical_path_time': path_time,
+                'steps': {s.name: {'start': s.start - t0, 'duration': s.duration(), 'devices': list(s.devices)}
+                          for s in started}}
+
+def log_graph_report(report):
+    logging.info('Step graph ' + report['graph'] + ': makespan ' + '{:.1f}'.format(report['makespan']) +
+            ' s vs ' + '{:.1f}'.format(report['serial_time']) + ' s if run serially; critical path ' +
+            ' -> '.join(report['critical_path']) + ' (' + '{:.1f}'.format(report['critical_path_time']) + ' s)')
@@ -0,0 +1,148 @@
+import time, json, uuid, sqlite3, functools, logging
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock, local, current_thread
+
+class Span:
+
+    def __init__(self, name, category, start, thread, depth, parent, fields):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = None
+        self.thread_id, self.thread_name = thread
+        self.depth = depth
+        self.parent = parent
+        self.fields = fields
+
+    def duration(self):
+        return self.end - self.start
+
+class Tracer:
+    '''
+    Nested, per-thread timing spans around robot commands, plate moves, reads, pump and
+    shaker calls and DB writes. Does nothing until enable() is called. Finished spans can
+    be written out as a Chrome trace (chrome://tracing or ui.perfetto.dev) and as a table
+    of step durations in SQLite. Each enable() after being disabled starts a new run_id,
+    so runs written to the same database can be told apart. Only the latest max_spans
+    finished spans are kept, so a deck traced for days doesn't grow without bound; the
+    number dropped is logged when they're written out.
+    '''
+
+    def __init__(self, max_spans=200000):
+        self.enabled = False
+        self.clock = time.time
+        self.run_id = uuid.uuid4().hex
+        self.spans = deque(maxlen=max_spans)
+        self.dropped = 0
+        self._lock = Lock()
+        self._local = local()
+
+    def enable(self, clock=None):
+        if clock is not None:
+            self.clock = clock
+        if not self.enabled:
+            self.run_id = uuid.uuid4().hex
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self.dropped = 0
+
+    @contextmanager
+    def span(self, name, category='step', **fields):
+        if not self.enabled:
+            yield None
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        thread = current_thread()
+        parent = stack[-1].name if stack else None
+        span = Span(name, category, self.clock(), (thread.ident, thread.name), len(stack), parent, fields)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = self.clock()
+            stack.pop()
+            with self._lock:
+                if len(self.spans) == self.spans.maxlen:
+                    self.dropped += 1
+                self.spans.append(span)
+
+    def traced(self, category, name=None):
+        def decorate(func):
+            span_name = name or func.__name__
+            @functools.wraps(func)
+            def traced_func(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(span_name, category):
+                    return func(*args, **kwargs)
+            return traced_func
+        return decorate
+
+    def instrument(self, obj, method_names, category):
+        '''Wrap the named methods of one object instance in spans.'''
+        for method_name in method_names:
+            method = getattr(obj, method_name)
+            setattr(obj, method_name, self.traced(category, type(obj).__name__ + '.' + method_name)(method))
+        return obj
+
+    def finished_spans(self):
+        with self._lock:
+            if self.dropped:
+                logging.warning('Trace is missing its ' + str(self.dropped) + ' earliest spans; only the latest '
+                        + str(self.spans.maxlen) + ' are kept')
+            return sorted(self.spans, key=lambda s: s.start)
+
+    def write_chrome_trace(self, path):
+        spans = self.finished_spans()
+        t0 = spans[0].start if spans else 0
+        events = []
+        thread_names = {}
+        for span in spans:
+            thread_names[span.thread_id] = span.thread_name
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': 0, 'tid': span.thread_id,
+                           'ts': (span.start - t0)*1e6, 'dur': span.duration()*1e6,
+                           'args': {k: str(v) for k, v in span.fields.items()}})
+        for thread_id, thread_name in thread_names.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread_id, 'args': {'name': thread_name}})
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+    def write_sqlite(self, path):
+        '''
+        Add the finished spans to the spans table in path, tagged with this run's run_id;
+        the step_durations view sums them up per run. Tables written before runs were
+        tagged get a run_id column, NULL for their spans.
+        '''
+        spans = self.finished_spans()
+        db_conn = sqlite3.connect(path)
+        try:
+            with db_conn:
+                db_conn.execute('''CREATE TABLE if not exists spans
+                        (name TEXT, category TEXT, thread TEXT, start REAL, duration REAL, depth INTEGER, parent TEXT,
+                        run_id TEXT)''')
+                if 'run_id' not in [row[1] for row in db_conn.execute('PRAGMA table_info(spans)')]:
+                    db_conn.execute('ALTER TABLE spans ADD COLUMN run_id TEXT')
+                db_conn.execute('DROP VIEW if exists step_durations') # the old view summed every run together
+                db_conn.execute('''CREATE VIEW step_durations AS
+                        SELECT run_id, category, name, count(*) AS n, sum(duration) AS total, avg(duration) AS mean,
+                        max(duration) AS max FROM spans GROUP BY run_id, category, name ORDER BY run_id, total DESC''')
+                db_conn.executemany('''INSERT INTO spans (name, category, thread, start, duration, depth, parent, run_id)
+                        VALUES (?,?,?,?,?,?,?,?)''',
+                        [(s.name, s.category, s.thread_name, s.start, s.duration(), s.depth, s.parent, self.run_id)
+                         for s in spans])
+        finally:
+            db_conn.close()
+
+tracer = Tracer() # process-wide
+span = tracer.span
+traced = tracer.traced
+instrument = tracer.instrument
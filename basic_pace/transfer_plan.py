@@ -0,0 +1,193 @@
+import math, logging
+from contextlib import contextmanager
+
+# For dispensing a tip's contents in several parts; the wrappers' default assumes each dispense empties the tip
+part_liq_class = 'HighVolumeFilter_Water_DispenseJet_Part'
+
+# Predicted seconds per 8-channel command, the digital twin's defaults, plus a move for each
+# X column after the first that one command spans: the channels share one arm.
+default_durations = {'pickup': 10, 'eject': 8, 'aspirate': 12, 'dispense': 8, 'return': 8, 'column': 2}
+
+class Transfer:
+    '''Move volume uL from source to target with the tip at tip, ejected at tip_return afterwards.'''
+
+    def __init__(self, vessel, tip, source, target, tip_return, volume):
+        self.vessel = vessel
+        self.tip = tip
+        self.source = source
+        self.target = target
+        self.tip_return = tip_return
+        self.volume = volume
+
+class TransferPlan:
+    '''
+    A channel-arm command sequence for a set of transfers: (kind, pos_tuples, vols, final)
+    for each command, kind one of 'pickup', 'aspirate', 'dispense', 'return' (a dispense
+    back into the sources), 'eject', and final marking a dispense that empties the tips.
+    tips_returned says whether the tips ended up at their tip_return positions or back
+    where they were picked up. Every aspirate and dispense goes with liquid_class, or the
+    wrappers' default if None.
+    '''
+
+    def __init__(self, strategy, commands, tips_returned, liquid_class=None):
+        self.strategy = strategy
+        self.commands = commands
+        self.tips_returned = tips_returned
+        self.liquid_class = liquid_class
+        self.trips = sum(1 for command in commands if command[0] == 'pickup')
+        self.predicted_duration = None
+
+    def predict(self, durations=default_durations):
+        self.predicted_duration = sum(command_duration(kind, poss, durations) for kind, poss, _, _ in self.commands)
+        return self.predicted_duration
+
+    def valid(self):
+        return all(channels_in_order(poss) for _, poss, _, _ in self.commands)
+
+    def describe(self):
+        return (self.strategy + ': ' + str(self.trips) + ' trips, ' + str(len(self.commands)) +
+                ' commands, predicted ' + '{:.0f}'.format(self.predicted_duration) + ' s')
+
+def arm_columns(pos_tuples):
+    '''The distinct (labware, column) X positions a command's channels go to.'''
+    return {(labware.layout_name(), labware.well_coords(idx)[0]) for labware, idx in filter(None, pos_tuples)}
+
+def command_duration(kind, pos_tuples, durations=default_durations):
+    return durations[kind] + durations['column']*max(0, len(arm_columns(pos_tuples)) - 1)
+
+def channels_in_order(pos_tuples):
+    '''Channels sharing an X column have to go to rows in channel order, front channels to front rows.'''
+    last_row = {}
+    for pos in filter(None, pos_tuples):
+        labware, idx = pos
+        col, row = labware.well_coords(idx)
+        key = (labware.layout_name(), col)
+        if key in last_row and row <= last_row[key]:
+            return False
+        last_row[key] = row
+    return True
+
+def passes_needed(volume, tip_capacity):
+    return max(1, int(math.ceil(volume/tip_capacity)))
+
+def _one_tip_per_transfer(strategy, batches, tip_capacity):
+    # each transfer keeps its own tip; a volume too big for one tip goes in several equal passes
+    commands = []
+    for batch in batches:
+        commands.append(('pickup', [t.tip for t in batch], None, False))
+        passes = [passes_needed(t.volume, tip_capacity) for t in batch]
+        for p in range(max(passes)):
+            vols = [t.volume/n if p < n else None for t, n in zip(batch, passes)]
+            commands.append(('aspirate', [t.source if v is not None else None for t, v in zip(batch, vols)], vols, False))
+            commands.append(('dispense', [t.target if v is not None else None for t, v in zip(batch, vols)], vols, True))
+        commands.append(('eject', [t.tip_return for t in batch], None, False))
+    return TransferPlan(strategy, commands, tips_returned=True)
+
+def _batches(transfers, channels):
+    transfers = list(transfers)
+    return [transfers[i:i + channels] for i in range(0, len(transfers), channels)]
+
+def chunked_plan(transfers, channels=8, tip_capacity=985):
+    '''Transfers in the order given, one batch of channels at a time.'''
+    return _one_tip_per_transfer('chunked', _batches(transfers, channels), tip_capacity)
+
+def grouped_plan(transfers, channels=8, tip_capacity=985):
+    '''Transfers needing the same number of passes batched together, so one big volume doesn't hold up a whole batch.'''
+    order = sorted(range(len(transfers)), key=lambda i: passes_needed(transfers[i].volume, tip_capacity))
+    return _one_tip_per_transfer('grouped', _batches([transfers[i] for i in order], channels), tip_capacity)
+
+def multi_dispense_plan(transfers, channels=8, tip_capacity=985, excess_vol=20):
+    '''
+    One trip: each channel picks up the tip and draws from the source of its transfer in
+    the first batch, then dispenses into the same channel's target in every later batch,
+    drawing as much at a time as the tips hold. Only for transfers that may share tips and
+    sources. Each draw takes excess_vol more than it dispenses, so the last part-volume
+    dispense isn't short; the excess goes back to the source to empty the tips before the
+    next draw. Dispenses use part_liq_class, which is calibrated for part volumes, where
+    the default class assumes each dispense empties the tip. None if some single volume
+    doesn't fit in a tip with the excess.
+    '''
+    batches = _batches(transfers, channels)
+    tip_capacity -= excess_vol
+    if not batches or max(t.volume for t in transfers) > tip_capacity:
+        return None
+    first = batches[0]
+    def pass_vols(batch):
+        return [batch[c].volume if c < len(batch) else None for c in range(len(first))]
+    segments, segment, held = [], [], [0.0]*len(first)
+    for batch in batches:
+        vols = pass_vols(batch)
+        if any(h + (v or 0) > tip_capacity for h, v in zip(held, vols)):
+            segments.append(segment)
+            segment, held = [], [0.0]*len(first)
+        segment.append((batch, vols))
+        held = [h + (v or 0) for h, v in zip(held, vols)]
+    segments.append(segment)
+    commands = [('pickup', [t.tip for t in first], None, False)]
+    for segment in segments:
+        totals = [sum(vols[c] or 0 for _, vols in segment) for c in range(len(first))]
+        sources = [t.source if total else None for t, total in zip(first, totals)]
+        commands.append(('aspirate', sources, [total + excess_vol if total else None for total in totals], False))
+        for batch, vols in segment:
+            commands.append(('dispense', [batch[c].target if vols[c] is not None else None for c in range(len(first))],
+                    vols, False))
+        if excess_vol:
+            commands.append(('return', sources, [excess_vol if total else None for total in totals], True))
+        else:
+            commands[-1] = commands[-1][:3] + (True,) # the last part empties the tips
+    commands.append(('eject', [t.tip for t in first], None, False))
+    return TransferPlan('multi_dispense', commands, tips_returned=False, liquid_class=part_liq_class)
+
+def plan_transfers(transfers, channels=8, tip_capacity=985, shared_tips=False, durations=default_durations,
+        excess_vol=20):
+    '''
+    The plan with the shortest predicted duration among those whose channel geometry is
+    valid: chunked (the transfers as ordered), grouped by passes needed, and, if transfers
+    may share tips and sources, multi-dispense with excess_vol drawn extra per draw. Falls
+    back on the chunked plan if none is valid.
+    '''
+    transfers = list(transfers)
+    candidates = [chunked_plan(transfers, channels, tip_capacity), grouped_plan(transfers, channels, tip_capacity)]
+    if shared_tips:
+        candidates.append(multi_dispense_plan(transfers, channels, tip_capacity, excess_vol))
+    valid = [plan for plan in candidates if plan is not None and plan.valid()]
+    if not valid:
+        logging.warning('No transfer plan has valid channel geometry; falling back on the chunked plan')
+        candidates[0].strategy = 'fallback'
+        valid = candidates[:1]
+    return min(valid, key=lambda plan: plan.predict(durations))
+
+@contextmanager
+def _no_context():
+    yield
+
+def _robot_senders():
+    # the pyhamilton wrappers, imported only when a plan is actually run, so planning needs no hardware stack
+    from basic_pace_180705x import tip_pick_up, tip_eject, aspirate, dispense
+    return {'pickup': tip_pick_up, 'eject': tip_eject, 'aspirate': aspirate, 'dispense': dispense}
+
+def run_plan(ham_int, plan, aspirate_options=None, dispense_options=None, partial_dispense_options=None,
+        return_options=None, around_dispense=_no_context, senders=None):
+    '''
+    Send a plan's commands. dispense_options go with dispenses into targets that empty the
+    tips, partial_dispense_options with the others in a multi-dispense, and return_options
+    with dispenses back into the sources; those default to the aspirate liquid height, not
+    the targets' options. around_dispense, if given, is a context manager factory wrapped
+    around every dispense into a target. The plan's liquid class goes with every aspirate
+    and dispense. senders stands in for the robot wrappers, keyed by command kind.
+    '''
+    senders = senders or _robot_senders()
+    class_option = {} if plan.liquid_class is None else {'liquid_class': plan.liquid_class}
+    if return_options is None: # back where the liquid came from, at the height it was drawn from
+        return_options = {key: value for key, value in (aspirate_options or {}).items() if key == 'liquidHeight'}
+    for kind, poss, vols, final in plan.commands:
+        if kind in ('pickup', 'eject'):
+            senders[kind](ham_int, poss)
+        elif kind == 'aspirate':
+            senders['aspirate'](ham_int, poss, vols, **dict(aspirate_options or {}, **class_option))
+        elif kind == 'return':
+            senders['dispense'](ham_int, poss, vols, **dict(return_options, **class_option))
+        else:
+            with around_dispense():
+                senders['dispense'](ham_int, poss, vols,
+                        **dict((dispense_options if final else partial_dispense_options) or {}, **class_option))
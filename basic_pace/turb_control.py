@@ -0,0 +1,164 @@
+import math
+import numpy as np
+
+def abs_to_od(absorbance, slope=4.171943074, intercept=-.1075750317):
+    return slope*np.asarray(absorbance) + intercept # best fit line
+
+def acceptable_od(od, min_od=.2):
+    return np.asarray(od) > min_od
+
+# Controllers take an array of ODs, one per vessel, and the time since the last reading
+# in hours, and return flow rates in culture volumes per hour. They may keep per-vessel
+# state between calls; state()/restore() round-trip it through plain lists.
+
+class BangBangController:
+    '''The stepped flow-rate rule the turbidostats have always used.'''
+
+    def __init__(self, target_od=.45, margin=.05, max_od=.7, min_od=.2, max_flow_through=3.8,
+            decrease_rate=3.8, increase_rate=1.5):
+        self.target_od = target_od
+        self.margin = margin
+        self.max_od = max_od
+        self.min_od = min_od
+        self.max_flow_through = max_flow_through
+        self.decrease_rate = decrease_rate
+        self.increase_rate = increase_rate
+
+    def flow_rates(self, ods, dt=None):
+        ods = np.asarray(ods, dtype=float)
+        return np.select(
+                [ods > self.max_od, ods > self.target_od + self.margin, ods < self.min_od, ods < self.target_od - self.margin],
+                [self.max_flow_through, self.decrease_rate, 0, self.increase_rate],
+                (self.increase_rate + self.decrease_rate)/2)
+
+    def state(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+class PIController:
+    '''Proportional-integral control on OD error around a base dilution rate.'''
+
+    def __init__(self, target_od=.45, kp=6.0, ki=1.0, base_rate=2.65, max_flow_through=3.8, min_od=.2):
+        self.target_od = target_od
+        self.kp = kp
+        self.ki = ki
+        self.base_rate = base_rate
+        self.max_flow_through = max_flow_through
+        self.min_od = min_od
+        self.integral = None
+
+    def flow_rates(self, ods, dt=1/6):
+        ods = np.asarray(ods, dtype=float)
+        if self.integral is None or self.integral.shape != ods.shape:
+            self.integral = np.zeros_like(ods)
+        error = ods - self.target_od
+        growing = ods >= self.min_od
+        self.integral = np.where(growing, self.integral + error*dt, 0) # no windup while cultures come up
+        rates = self.base_rate + self.kp*error + self.ki*self.integral
+        return np.where(growing, np.clip(rates, 0, self.max_flow_through), 0)
+
+    def state(self):
+        return {'integral': None if self.integral is None else self.integral.tolist()}
+
+    def restore(self, state):
+        integral = state.get('integral')
+        self.integral = None if integral is None else np.array(integral)
+
+class ModelBasedController:
+    '''
+    Estimates each culture's growth rate from consecutive readings and the dilution that
+    was applied in between, then picks the dilution that should land on target_od at the
+    next reading.
+    '''
+
+    def __init__(self, target_od=.45, initial_growth_rate=math.log(2)/.5, smoothing=.3, max_flow_through=3.8,
+            min_od=.2):
+        self.target_od = target_od
+        self.initial_growth_rate = initial_growth_rate # per hour
+        self.smoothing = smoothing
+        self.max_flow_through = max_flow_through
+        self.min_od = min_od
+        self.growth_rates = None
+        self.last_ods = None
+        self.last_rates = None
+
+    def flow_rates(self, ods, dt=1/6):
+        ods = np.clip(np.asarray(ods, dtype=float), 1e-3, None)
+        if self.growth_rates is None or self.growth_rates.shape != ods.shape:
+            self.growth_rates = np.full_like(ods, self.initial_growth_rate)
+        elif self.last_ods is not None:
+            observed = (np.log(ods/self.last_ods) + np.log1p(self.last_rates*dt))/dt
+            self.growth_rates = (1 - self.smoothing)*self.growth_rates + self.smoothing*observed
+        rates = (ods*np.exp(self.growth_rates*dt)/self.target_od - 1)/dt
+        rates = np.where(ods >= self.min_od, np.clip(rates, 0, self.max_flow_through), 0)
+        self.last_ods = ods
+        self.last_rates = rates
+        return rates
+
+    def state(self):
+        return {key: None if value is None else value.tolist() for key, value in
+                (('growth_rates', self.growth_rates), ('last_ods', self.last_ods), ('last_rates', self.last_rates))}
+
+    def restore(self, state):
+        for key in ('growth_rates', 'last_ods', 'last_rates'):
+            value = state.get(key)
+            setattr(self, key, None if value is None else np.array(value))
+
+controller_strategies = {'bangbang': BangBangController, 'pi': PIController, 'model': ModelBasedController}
+
+def flow_rate_controller(od, target_od=.45, margin=.05):
+    return float(BangBangController(target_od, margin).flow_rates(od))
+
+class PlateControl:
+    '''Per-vessel results of one plate evaluation, all as arrays in vessel order.'''
+
+    def __init__(self, vessels, read_wells, absorbances, ods, flow_rates, replace_vols, acceptable):
+        self.vessels = vessels
+        self.read_wells = read_wells
+        self.absorbances = absorbances
+        self.ods = ods
+        self.flow_rates = flow_rates
+        self.replace_vols = replace_vols
+        self.acceptable = acceptable
+
+class PlateController:
+    '''
+    Runs a controller strategy over a whole reader plate at once: the vessel-to-well
+    coordinates are computed once per well layout, each well is read once, and OD, flow
+    rate, replace volume and acceptance come out of one array pass.
+    '''
+
+    def __init__(self, strategy, vessels, working_vol, cycles_per_hour, od_from_abs=abs_to_od, min_acceptable_od=.2):
+        self.strategy = strategy
+        self.vessels = np.array(list(vessels))
+        self.working_vol = working_vol
+        self.cycles_per_hour = cycles_per_hour
+        self.od_from_abs = od_from_abs
+        self.min_acceptable_od = min_acceptable_od
+        self._coords = {}
+
+    def well_coords(self, reader_plate, read_wells):
+        key = (reader_plate.layout_name(), tuple(read_wells))
+        if key not in self._coords:
+            self._coords[key] = [reader_plate.well_coords(w) for w in read_wells]
+        return self._coords[key]
+
+    def evaluate(self, plate_data, reader_plate, read_wells):
+        coords = self.well_coords(reader_plate, read_wells)
+        absorbances = np.array([plate_data.value_at(col, row) for col, row in coords], dtype=float)
+        ods = self.od_from_abs(absorbances)
+        flow_rates = self.strategy.flow_rates(ods, 1/self.cycles_per_hour)
+        replace_vols = flow_rates*self.working_vol/self.cycles_per_hour
+        return PlateControl(self.vessels, list(read_wells), absorbances, ods, flow_rates, replace_vols,
+                acceptable_od(ods, self.min_acceptable_od))
+
+    def state(self):
+        return {'strategy': type(self.strategy).__name__, 'state': self.strategy.state()}
+
+    def restore(self, state):
+        if state.get('strategy') != type(self.strategy).__name__:
+            raise ValueError('Saved controller state is for ' + str(state.get('strategy')) +
+                    ', not ' + type(self.strategy).__name__)
+        self.strategy.restore(state['state'])
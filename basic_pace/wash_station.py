@@ -0,0 +1,107 @@
+import time, logging
+from threading import Lock
+
+class WashChamber:
+    '''
+    One chamber of the 96-head wash station. Waste dispensed into the chamber dilutes what
+    is in it (the chamber overflows to drain, so its volume stays put), every tip wash in it
+    counts as a use, and the liquid ages from when it was last refilled. It is spent when
+    its strength drops below min_strength, it has had more than max_uses washes, or it is
+    older than max_age seconds; a limit of None never applies.
+    '''
+
+    def __init__(self, name, volume, min_strength=0.0, max_uses=None, max_age=None):
+        self.name = name
+        self.volume = volume # uL
+        self.min_strength = min_strength
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.strength = 0.0
+        self.uses = 0
+        self.filled_at = None # never filled as far as we know, so spent
+
+    def refilled(self, now):
+        self.strength = 1.0
+        self.uses = 0
+        self.filled_at = now
+
+    def add_waste(self, vol):
+        self.strength *= self.volume/(self.volume + vol)
+
+    def spent(self, now, uses=0, waste_vol=0.0):
+        '''Whether the chamber is spent now, or will be after uses more washes and waste_vol more waste.'''
+        if self.filled_at is None:
+            return True
+        strength = self.strength*self.volume/(self.volume + waste_vol)
+        return (strength < self.min_strength or
+                (self.max_uses is not None and self.uses + uses > self.max_uses) or
+                (self.max_age is not None and now - self.filled_at > self.max_age))
+
+    def state(self):
+        return {'strength': self.strength, 'uses': self.uses, 'filled_at': self.filled_at}
+
+    def restore(self, state):
+        self.strength = state['strength']
+        self.uses = state['uses']
+        self.filled_at = state['filled_at']
+
+class WashStation:
+    '''
+    Tracks the wash station's chambers so they are emptied and refilled only when one is
+    spent, instead of before every wash. A refill always empties and refills every chamber.
+    needs_refill(load) looks ahead over the washes and waste a service cycle is about to
+    put through the station, so the refill can go where it costs least, such as while the
+    reader is busy, rather than in the middle of a bleach. Refill counts and time spent
+    refilling are kept for the per-cycle wash overhead.
+    '''
+
+    def __init__(self, chambers, clock=time.time):
+        self.chambers = {chamber.name: chamber for chamber in chambers}
+        self.clock = clock
+        self.refills = 0
+        self.refill_seconds = 0.0
+        self.washes = 0
+        self._lock = Lock()
+
+    def needs_refill(self, load=None):
+        '''load: {chamber name: (washes, waste volume in uL)} still to come before the next chance to refill.'''
+        load = load or {}
+        now = self.clock()
+        with self._lock:
+            return any(chamber.spent(now, *load.get(name, (0, 0.0))) for name, chamber in self.chambers.items())
+
+    def refill(self, empty_refill):
+        '''Empty and refill every chamber with empty_refill(), e.g. a wash_empty_refill call.'''
+        start_time = self.clock()
+        empty_refill()
+        end_time = self.clock()
+        with self._lock:
+            for chamber in self.chambers.values():
+                chamber.refilled(end_time)
+            self.refills += 1
+            self.refill_seconds += end_time - start_time
+        logging.info('Wash station refilled (' + str(self.refills) + ' refills for ' + str(self.washes) + ' washes so far)')
+
+    def wash(self, *names):
+        '''Record one wash of the mounted tips through each of the named chambers.'''
+        with self._lock:
+            for name in names:
+                self.chambers[name].uses += 1
+            self.washes += 1
+
+    def add_waste(self, name, vol):
+        with self._lock:
+            self.chambers[name].add_waste(vol)
+
+    def state(self):
+        with self._lock:
+            return {name: chamber.state() for name, chamber in self.chambers.items()}
+
+    def restore(self, state):
+        with self._lock:
+            for name, chamber_state in state.items():
+                if name in self.chambers:
+                    self.chambers[name].restore(chamber_state)
+
+    def stats(self):
+        return {'refills': self.refills, 'refill_seconds': self.refill_seconds, 'washes': self.washes}
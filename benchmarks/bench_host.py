@@ -0,0 +1,220 @@
+#!python3
+'''
+Host-side overhead benchmarks: measurement ingest and queries, position-string building,
+the turbidostat controller path, layout resource resolution, wrapper overhead against a
+recording (mock) interface, and an end-to-end digital twin run, which exercises the full
+service routines per cycle.
+
+    py benchmarks\bench_host.py --out results.json
+    py benchmarks\bench_host.py --baseline benchmarks\baseline.json   # exit status 1 on regression
+    py benchmarks\bench_host.py --save-baseline benchmarks\baseline.json
+'''
+import sys, os, time, json, random, argparse, tempfile, statistics, importlib.util, runpy, platform
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_dir = os.path.join(package_dir, '180703_24_personal_turbs')
+script_path = os.path.join(script_dir, '180703_24_personal_turbs.py')
+for mod_path in (os.path.join(package_dir, 'basic_pace'), script_dir):
+    if mod_path not in sys.path:
+        sys.path.append(mod_path)
+
+import numpy as np
+from meas_store import MeasurementStore
+from digital_twin import SimPlateData
+from command_plan import CommandRecorder
+from turb_control import PlateController, controller_strategies
+import basic_pace_180705x as bp
+import layout_index
+from log_pipeline import stop_logging
+
+VESSEL_COUNTS = (24, 96, 384)
+
+class SyntheticPlate:
+    '''Stand-in labware with the pyhamilton methods the hot paths call.'''
+
+    def __init__(self, name, rows, cols):
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+
+    def layout_name(self):
+        return self.name
+
+    def well_coords(self, idx):
+        return idx//self.rows, idx%self.rows
+
+    def position_id(self, idx):
+        col, row = self.well_coords(idx)
+        return chr(ord('A') + row) + str(col + 1)
+
+def plate_for(num_vessels):
+    return SyntheticPlate('reader_' + str(num_vessels), 16, 24) if num_vessels > 96 else SyntheticPlate('reader_96', 8, 12)
+
+def synthetic_plate_data(plate, t, rng, data_type='abs'):
+    scale = 200.0 if data_type == 'lum' else .3
+    values = [[rng.random()*scale for _ in range(plate.rows)] for _ in range(plate.cols)]
+    return SimPlateData('synthetic_' + data_type + '_' + str(int(t)) + '.csv', 'bench', t, values)
+
+def time_it(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'repeat': repeat}
+
+def load_turb_script():
+    spec = importlib.util.spec_from_file_location('personal_turbs', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module) # top level only; nothing under __main__ runs
+    return module
+
+def bench_db(results, hours, repeat):
+    rng = random.Random(0)
+    cycles = int(hours*6)
+    for num_vessels in VESSEL_COUNTS:
+        plate = plate_for(num_vessels)
+        wells = list(range(num_vessels))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'bench.db')
+            store = MeasurementStore(db_path)
+            plate_datas = iter([synthetic_plate_data(plate, 1.5e9 + 600*c, rng) for c in range(cycles)])
+            results['db_ingest_per_plate[' + str(num_vessels) + ']'] = time_it(
+                    lambda: store.add_plate_data(next(plate_datas), 'abs', plate, wells, wells, 'turbidostat'), cycles)
+            results['db_query_series[' + str(num_vessels) + ']'] = time_it(
+                    lambda: store.series('turbidostat', num_vessels//2, 'abs'), repeat)
+            results['db_query_window[' + str(num_vessels) + ']'] = time_it(
+                    lambda: store.series('turbidostat', num_vessels//2, 'abs', 1.5e9 + 600*cycles/2, 1.5e9 + 600*cycles), repeat)
+            store.close()
+            results['db_size_bytes[' + str(num_vessels) + ']'] = {'value': os.path.getsize(db_path), 'rows': cycles*num_vessels}
+
+def bench_position_strings(results, repeat):
+    plate = SyntheticPlate('turbidostats', 8, 12)
+    batch = [(plate, i) for i in range(0, 16, 2)]
+    def cold_96():
+        bp.clear_position_cache()
+        bp.compound_pos_str_96(plate)
+    results['compound_pos_str_96[cold]'] = time_it(cold_96, repeat)
+    results['compound_pos_str_96[warm]'] = time_it(lambda: bp.compound_pos_str_96(plate), repeat)
+    results['compound_pos_str_8ch[warm]'] = time_it(lambda: (bp.compound_pos_str(batch), bp.channel_var(batch)), repeat)
+    recorder = CommandRecorder()
+    results['aspirate_96_wrapper[mock]'] = time_it(lambda: bp.aspirate_96(recorder, plate, 100, liquidHeight=5), repeat)
+    results['aspirate_8ch_wrapper[mock]'] = time_it(lambda: bp.aspirate(recorder, batch, [200]*8, liquidHeight=1), repeat)
+
+def bench_controller(results, repeat):
+    turbs = load_turb_script()
+    rng = random.Random(1)
+    for num_vessels in VESSEL_COUNTS:
+        plate = plate_for(num_vessels)
+        pd = synthetic_plate_data(plate, 1.5e9, rng)
+        def controller_path():
+            for well in range(num_vessels):
+                od = turbs.abs_to_od(pd.value_at(*plate.well_coords(well)))
+                turbs.flow_rate_controller(od)
+                turbs.acceptable_od(od)
+        results['controller_path[' + str(num_vessels) + ']'] = time_it(controller_path, repeat)
+        wells = list(range(num_vessels))
+        for name, strategy in sorted(controller_strategies.items()):
+            plate_controller = PlateController(strategy(), range(num_vessels), 1000, 6)
+            results['plate_controller_' + name + '[' + str(num_vessels) + ']'] = time_it(
+                    lambda: plate_controller.evaluate(pd, plate, wells), repeat)
+
+def bench_layout(results, repeat):
+    # resolve the turbidostat deck's resources: by a scan per lookup, then through the layout index
+    layfile = os.path.splitext(script_path)[0] + '.lay'
+    names = ['lagoons', 'turbidostats', 'waffle', 'turbidostat_tips', 'lagoon_tips', 'reader_tray']
+    prefixes = ['reader_tl_', 'reader_tr_', 'reader_bl_', 'reader_br_']
+    num_reader_plates = 7
+    def scan():
+        lmgr = bp.LayoutManager(layfile)
+        for name in names:
+            lmgr.assign_unused_resource(bp.ResourceType(bp.Plate96, name))
+        for prefix in prefixes:
+            test = lambda line, prefix=prefix: layout_index.layline_name(line).startswith(prefix)
+            for _ in range(num_reader_plates):
+                lmgr.assign_unused_resource(bp.ResourceType(bp.Plate96, test, layout_index.layline_name))
+    def indexed(cold):
+        if cold:
+            layout_index._names_by_hash.clear()
+            cache_path = layout_index.index_cache_path(layfile)
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+        lmgr = bp.LayoutManager(layfile)
+        index = layout_index.layout_index(lmgr, layfile)
+        for name in names:
+            index.assign(bp.Plate96, name)
+        for prefix in prefixes:
+            bp.resource_list_with_prefix(lmgr, prefix, bp.Plate96, num_reader_plates)
+    results['layout_resolve[scan]'] = time_it(scan, repeat)
+    results['layout_resolve[index_cold]'] = time_it(lambda: indexed(True), repeat)
+    layout_index._names_by_hash.clear() # warm here means from the on-disk cache, as after a restart
+    results['layout_resolve[index_cached]'] = time_it(lambda: (layout_index._names_by_hash.clear(), indexed(False)), repeat)
+
+def bench_twin(results, hours):
+    # full service routines against the digital twin; wall time here is all host overhead. The
+    # database and logs go to a scratch directory, leaving the real twin runs' results alone.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        twin_db = os.path.join(tmp_dir, 'bench_twin.db')
+        argv = sys.argv
+        sys.argv = [script_path, '--twin', '--twin_hours=' + str(hours), '--db=' + twin_db,
+                    '--log_dir=' + os.path.join(tmp_dir, 'log')]
+        start_time = time.perf_counter()
+        try:
+            runpy.run_path(script_path, run_name='__main__')
+        finally:
+            sys.argv = argv
+        wall_time = time.perf_counter() - start_time
+        cycles = hours*6
+        # one run, so only a mean per cycle; compared against baselines as such
+        results['twin_host_time_per_turb_cycle'] = {'mean_s': wall_time/cycles, 'repeat': cycles}
+        results['twin_db_size_bytes'] = {'value': os.path.getsize(twin_db)}
+        stop_logging() # the script's log files are in tmp_dir
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline['results'].items():
+        current = results.get(name)
+        if current is None:
+            continue
+        key = next((k for k in ('min_s', 'mean_s', 'value') if k in base), None)
+        if key is None or key not in current:
+            continue # measured differently than when the baseline was saved
+        if base[key] and current[key] > base[key]*(1 + tolerance):
+            regressions.append((name, base[key], current[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark host-side hot paths')
+    parser.add_argument('--hours', type=float, default=72, help='simulated run length for DB benchmarks')
+    parser.add_argument('--twin_hours', type=float, default=12, help='simulated run length for the twin benchmark, 0 to skip')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--baseline', help='compare against this results JSON')
+    parser.add_argument('--save-baseline', dest='save_baseline', help='write results JSON as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed fractional slowdown vs. baseline')
+    args = parser.parse_args()
+
+    results = {}
+    bench_db(results, args.hours, max(1, args.repeat//10))
+    bench_position_strings(results, args.repeat)
+    bench_controller(results, args.repeat)
+    bench_layout(results, max(1, args.repeat//10))
+    if args.twin_hours:
+        bench_twin(results, args.twin_hours)
+    report = {'python': platform.python_version(), 'machine': platform.node(), 'time': time.time(),
+              'hours': args.hours, 'results': results}
+    print(json.dumps(report, indent=2))
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, 'w') as out_file:
+                json.dump(report, out_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for name, base, current in regressions:
+            print('REGRESSION ' + name + ': ' + str(base) + ' -> ' + str(current), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+import os, sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for mod_dir in ('basic_pace', '180703_24_personal_turbs'):
+    mod_path = os.path.join(repo_dir, mod_dir)
+    if mod_path not in sys.path:
+        sys.path.append(mod_path)
@@ -0,0 +1,31 @@
+import os
+from checkpoint import Checkpoint
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path/'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    assert checkpoint.load() is None
+    state = {'count': 1}
+    checkpoint.track('counter', lambda: dict(state))
+    checkpoint.track('names', lambda: ['a', 'b'])
+    checkpoint.save()
+    state['count'] = 2
+    checkpoint.save()
+    loaded = Checkpoint(path).load()
+    assert loaded['counter'] == {'count': 2}
+    assert loaded['names'] == ['a', 'b']
+    assert 'saved_at' in loaded
+    assert checkpoint.saves == 2
+    assert os.listdir(str(tmp_path)) == ['checkpoint.json'] # no temporary file left behind
+
+def test_failed_save_keeps_the_last_checkpoint(tmp_path):
+    path = str(tmp_path/'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    checkpoint.track('value', lambda: 1)
+    checkpoint.save()
+    checkpoint.track('value', lambda: object()) # not JSON serializable
+    try:
+        checkpoint.save()
+    except TypeError:
+        pass
+    assert Checkpoint(path).load()['value'] == 1
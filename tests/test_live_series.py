@@ -0,0 +1,61 @@
+import numpy as np
+from live_series import lttb, SeriesCache
+from meas_store import MeasurementStore
+
+def test_lttb_keeps_ends_and_spikes():
+    x = np.arange(1000, dtype=float)
+    y = np.zeros(1000)
+    y[500] = 10.0
+    kept = lttb(x, y, 20)
+    assert len(kept) == 20
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 500 in kept
+    assert np.all(np.diff(kept) > 0)
+
+def test_lttb_leaves_short_series_alone():
+    x = np.arange(10, dtype=float)
+    assert list(lttb(x, x, 20)) == list(range(10))
+    assert list(lttb(x, x, 2)) == list(range(10))
+
+def reading(turb, timestamp, value, deck=None):
+    return (None, turb, 'file', 'plate', timestamp, 'A1', 0.0, value, 'abs', deck)
+
+def test_series_cache_refreshes_incrementally(tmp_path):
+    store = MeasurementStore(str(tmp_path/'meas.db'))
+    try:
+        cache = SeriesCache(store, 'turbidostat', 'abs')
+        store.add_rows([reading(0, 1.0, .1), reading(1, 1.0, .2), reading(0, 2.0, .3)])
+        assert cache.refresh() == {0, 1}
+        assert list(cache.series[0][0]) == [1.0, 2.0]
+        assert cache.refresh() == set()
+        store.add_rows([reading(0, 1.5, .4), reading(0, None, .5)]) # late, and one with no timestamp
+        assert cache.refresh() == {0}
+        times, readings = cache.series[0]
+        assert list(times) == [1.0, 1.5, 2.0]
+        assert list(readings) == [.1, .4, .3]
+    finally:
+        store.close()
+
+def test_series_cache_deck_and_window(tmp_path):
+    store = MeasurementStore(str(tmp_path/'meas.db'))
+    try:
+        store.add_rows([reading(0, float(t), .1, 'deck_0') for t in range(0, 100, 10)] + [reading(0, 5.0, .9, 'deck_1')])
+        cache = SeriesCache(store, 'turbidostat', 'abs', deck='deck_0', window=30)
+        cache.refresh()
+        assert list(cache.series[0][0]) == [60.0, 70.0, 80.0, 90.0]
+        assert store.decks() == ['deck_0', 'deck_1']
+    finally:
+        store.close()
+
+def test_series_cache_compacts_long_history(tmp_path):
+    store = MeasurementStore(str(tmp_path/'meas.db'))
+    try:
+        store.add_rows([reading(0, float(t), np.sin(t/10)) for t in range(500)])
+        cache = SeriesCache(store, 'turbidostat', 'abs', max_points=50)
+        cache.refresh()
+        times, _ = cache.series[0]
+        assert len(times) == 50 + 100 # compacted, and the latest max_points*2 at full resolution
+        assert list(times[-100:]) == [float(t) for t in range(400, 500)]
+        assert len(cache.visible(0)[0]) == 50
+    finally:
+        store.close()
@@ -0,0 +1,87 @@
+import pytest
+from concurrent.futures import Future
+from metrics import Registry, device_call_seconds, set_deck, current_deck
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Things', ('kind',))
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    assert counter.value(kind='a') == 3
+    assert counter.value(kind='b') is None
+    with pytest.raises(ValueError):
+        counter.inc(-1, kind='a')
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+    gauge = registry.gauge('test_level', 'Level')
+    gauge.set(5)
+    gauge.dec(2)
+    assert gauge.value() == 3
+
+def test_registering_again():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Things', ('kind',))
+    assert registry.counter('test_total', 'Things', ('kind',)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge('test_total', 'Things', ('kind',))
+    with pytest.raises(ValueError):
+        registry.counter('test_total', 'Things', ('other',))
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'Durations', ('task',), buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value, task='t')
+    assert histogram.value(task='t') == (14.5, 4)
+    samples = {(suffix, tuple(pairs)): value for suffix, pairs, value in histogram.samples()}
+    assert samples[('_bucket', (('task', 't'), ('le', '1.0')))] == 2 # bounds are inclusive
+    assert samples[('_bucket', (('task', 't'), ('le', '5.0')))] == 3
+    assert samples[('_bucket', (('task', 't'), ('le', '+Inf')))] == 4
+    assert samples[('_count', (('task', 't'),))] == 4
+
+def test_histogram_time_uses_the_clock():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'Durations')
+    times = iter([10.0, 12.5])
+    with histogram.time(clock=lambda: next(times)):
+        pass
+    assert histogram.value() == (2.5, 1)
+
+def test_exposition():
+    registry = Registry()
+    registry.counter('test_total', 'Things\ncounted', ('name',)).inc(name='say "hi"\\')
+    registry.histogram('test_seconds', 'Durations', buckets=(1,)).observe(2)
+    assert registry.exposition().splitlines() == [
+        '# HELP test_seconds Durations',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="1.0"} 0.0',
+        'test_seconds_bucket{le="+Inf"} 1.0',
+        'test_seconds_sum 2.0',
+        'test_seconds_count 1.0',
+        '# HELP test_total Things\\ncounted',
+        '# TYPE test_total counter',
+        'test_total{name="say \\"hi\\"\\\\"} 1.0']
+
+def test_time_calls_waits_for_futures_and_labels_the_deck():
+    class Device:
+        def call(self):
+            return 'done'
+        def job(self):
+            return self.future
+    registry = Registry()
+    times = iter([0.0, 1.0, 10.0, 14.0])
+    registry.clock = lambda: next(times)
+    device = Device()
+    device.future = Future()
+    registry.time_calls(device, ['call', 'job'], 'test_device')
+    set_deck('test_deck')
+    try:
+        assert device.call() == 'done'
+        assert device.job() is device.future
+    finally:
+        set_deck(None)
+    assert current_deck() == ''
+    assert device_call_seconds.value(deck='test_deck', device='test_device', call='Device.call') == (1.0, 1)
+    assert device_call_seconds.value(deck='test_deck', device='test_device', call='Device.job') is None
+    device.future.set_result(None)
+    assert device_call_seconds.value(deck='test_deck', device='test_device', call='Device.job') == (4.0, 1)
@@ -0,0 +1,139 @@
+import pytest
+from scheduler import Scheduler, SKIP, CATCH_UP, COALESCE
+from metrics import task_missed_deadlines
+
+class FakeClock:
+    '''Virtual time: sleep() moves it on, and tasks move it on by however long they take.'''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def make_scheduler(deck):
+    clock = FakeClock()
+    return clock, Scheduler(clock.time, clock.sleep, deck=deck)
+
+def task_taking(clock, durations, runs):
+    '''A task that records when it starts, then takes the next of durations (the last one repeating).'''
+    def run():
+        runs.append(clock.now)
+        clock.now += durations[min(len(runs) - 1, len(durations) - 1)]
+    return run
+
+def test_runs_on_the_interval():
+    clock, scheduler = make_scheduler('test_interval')
+    runs = []
+    scheduler.add('task', task_taking(clock, [1], runs), 10)
+    scheduler.run(until=35)
+    assert runs == [0, 10, 20, 30]
+    stats = scheduler.stats()['task']
+    assert stats['runs'] == 4 and stats['missed'] == 0 and stats['max_lateness'] == 0
+
+def test_first_time():
+    clock, scheduler = make_scheduler('test_first_time')
+    runs = []
+    scheduler.add('task', task_taking(clock, [1], runs), 10, first_time=5)
+    assert scheduler.next_deadline() == 5
+    scheduler.run(until=20)
+    assert runs == [5, 15]
+
+def test_skip_drops_missed_slots():
+    clock, scheduler = make_scheduler('test_skip')
+    runs = []
+    scheduler.add('task', task_taking(clock, [25, 1], runs), 10, SKIP)
+    scheduler.run(until=45)
+    assert runs == [0, 30, 40]
+    assert scheduler.stats()['task']['missed'] == 2
+    assert task_missed_deadlines.value(deck='test_skip', task='task') == 2
+
+def test_catch_up_runs_every_missed_slot_and_counts_each_once():
+    clock, scheduler = make_scheduler('test_catch_up')
+    runs = []
+    scheduler.add('task', task_taking(clock, [35, 1], runs), 10, CATCH_UP)
+    scheduler.run(until=45)
+    assert runs == [0, 35, 36, 37, 40]
+    stats = scheduler.stats()['task']
+    assert stats['missed'] == 3
+    assert stats['max_lateness'] == 25 # the slot at 10 started at 35
+    assert task_missed_deadlines.value(deck='test_catch_up', task='task') == 3
+
+def test_catch_up_counts_slots_missed_while_catching_up():
+    clock, scheduler = make_scheduler('test_catch_up_more')
+    runs = []
+    scheduler.add('task', task_taking(clock, [15, 15, 1], runs), 10, CATCH_UP)
+    scheduler.run(until=35)
+    # slot 10 missed by the first run, 20 and 30 by the second; 30 is already late when it runs
+    assert runs == [0, 15, 30, 31]
+    assert scheduler.stats()['task']['missed'] == 3
+
+def test_coalesce_runs_once_then_keeps_the_interval_from_there():
+    clock, scheduler = make_scheduler('test_coalesce')
+    runs = []
+    scheduler.add('task', task_taking(clock, [25, 1], runs), 10, COALESCE)
+    scheduler.run(until=50)
+    assert runs == [0, 25, 35, 45]
+    assert scheduler.stats()['task']['missed'] == 2
+
+def test_deadline_order_and_lateness():
+    clock, scheduler = make_scheduler('test_order')
+    runs = []
+    def run(name):
+        def go():
+            runs.append((name, clock.now))
+            clock.now += 4
+        return go
+    scheduler.add('a', run('a'), 10)
+    scheduler.add('b', run('b'), 10, first_time=2)
+    scheduler.run(until=5)
+    assert runs == [('a', 0), ('b', 4)]
+    assert scheduler.stats()['b']['last_lateness'] == 2
+
+def test_combined_tasks_run_in_one_call():
+    clock, scheduler = make_scheduler('test_combine')
+    calls = []
+    def service(names, arg):
+        calls.append((clock.now, sorted(names), arg))
+        clock.now += 1
+    scheduler.add('a', None, 10, args=('x',))
+    scheduler.add('b', None, 30, first_time=3, args=('y',))
+    scheduler.combine('both', ['a', 'b'], service, window=5)
+    scheduler.run(until=25)
+    assert calls == [(0, ['a', 'b'], 'x'), (10, ['a'], 'x'), (20, ['a'], 'x')]
+    assert scheduler.tasks['b'].deadline == 33
+    with pytest.raises(ValueError):
+        scheduler.combine('again', ['a'], service)
+
+def test_run_pending_only_runs_what_is_due():
+    clock, scheduler = make_scheduler('test_pending')
+    runs = []
+    scheduler.add('task', task_taking(clock, [0], runs), 10)
+    assert scheduler.run_pending() == 1
+    assert scheduler.run_pending() == 0
+    clock.now = 10
+    assert scheduler.run_pending() == 1
+
+def test_state_and_restore():
+    clock, scheduler = make_scheduler('test_state')
+    scheduler.add('a', lambda: None, 10)
+    scheduler.add('b', lambda: None, 10, first_time=4)
+    saved = scheduler.state()
+    assert saved == {'deadlines': {'a': 0, 'b': 4}}
+    _, other = make_scheduler('test_state')
+    other.add('a', lambda: None, 10, first_time=100)
+    other.add('b', lambda: None, 10, first_time=100)
+    other.restore({'deadlines': {'a': 7}})
+    assert other.tasks['a'].deadline == 7 and other.next_deadline() == 7
+    assert other.tasks['b'].deadline == 100
+
+def test_bad_tasks():
+    _, scheduler = make_scheduler('test_bad')
+    with pytest.raises(ValueError):
+        scheduler.add('task', lambda: None, 10, policy='sometimes')
+    scheduler.add('task', lambda: None, 10)
+    with pytest.raises(ValueError):
+        scheduler.add('task', lambda: None, 10)
@@ -0,0 +1,159 @@
+import pytest
+from transfer_plan import (Transfer, chunked_plan, grouped_plan, multi_dispense_plan, channels_in_order,
+    plan_transfers, passes_needed, run_plan, part_liq_class)
+
+class Labware:
+    '''Stands in for a plate: well idx is at column idx//rows, row idx%rows.'''
+
+    def __init__(self, name, rows=8):
+        self.name = name
+        self.rows = rows
+
+    def layout_name(self):
+        return self.name
+
+    def well_coords(self, idx):
+        return idx//self.rows, idx%self.rows
+
+tips, media, turbs, tip_corral = Labware('tips'), Labware('media'), Labware('turbs'), Labware('tip_corral')
+
+def transfers_for(volumes, source_idxs=None, target_idxs=None):
+    source_idxs = source_idxs or range(len(volumes))
+    target_idxs = target_idxs or range(len(volumes))
+    return [Transfer(i, (tips, i), (media, s), (turbs, t), (tip_corral, i), v)
+            for i, (v, s, t) in enumerate(zip(volumes, source_idxs, target_idxs))]
+
+def commands_of(plan, kind):
+    return [command for command in plan.commands if command[0] == kind]
+
+def dispensed(plan):
+    '''Total volume dispensed into each target position.'''
+    totals = {}
+    for _, poss, vols, _ in commands_of(plan, 'dispense'):
+        for pos, vol in zip(poss, vols):
+            if pos is not None and pos[0] is turbs:
+                totals[pos] = totals.get(pos, 0) + vol
+    return totals
+
+def test_passes_needed():
+    assert passes_needed(0, 985) == 1
+    assert passes_needed(985, 985) == 1
+    assert passes_needed(986, 985) == 2
+
+def test_chunked_plan_batches_channels_in_order():
+    plan = chunked_plan(transfers_for([100]*10))
+    assert plan.trips == 2
+    assert [len(poss) for _, poss, _, _ in commands_of(plan, 'pickup')] == [8, 2]
+    assert plan.tips_returned and plan.liquid_class is None
+    assert commands_of(plan, 'eject')[0][1] == [(tip_corral, i) for i in range(8)]
+
+def test_chunked_plan_splits_big_volumes_into_equal_passes():
+    plan = chunked_plan(transfers_for([1500, 100]), tip_capacity=985)
+    aspirates = commands_of(plan, 'aspirate')
+    assert [vols for _, _, vols, _ in aspirates] == [[750, 100], [750, None]]
+    assert aspirates[1][1] == [(media, 0), None]
+    assert all(final for _, _, _, final in commands_of(plan, 'dispense'))
+    assert dispensed(plan) == {(turbs, 0): 1500, (turbs, 1): 100}
+
+def test_grouped_plan_batches_by_passes():
+    volumes = [1500, 100, 1500, 100, 100, 100, 100, 100, 100, 100]
+    plan = grouped_plan(transfers_for(volumes), tip_capacity=985)
+    first_batch = commands_of(plan, 'pickup')[0][1]
+    assert first_batch == [(tips, i) for i in (1, 3, 4, 5, 6, 7, 8, 9)]
+    assert len(commands_of(plan, 'aspirate')) == 1 + 2
+    assert len(commands_of(chunked_plan(transfers_for(volumes), tip_capacity=985), 'aspirate')) == 2 + 1
+    assert dispensed(plan) == dispensed(chunked_plan(transfers_for(volumes)))
+
+def test_multi_dispense_plan_draws_once_for_several_targets():
+    transfers = transfers_for([100]*16, source_idxs=list(range(8))*2)
+    plan = multi_dispense_plan(transfers, excess_vol=20)
+    assert plan.trips == 1 and not plan.tips_returned
+    assert plan.liquid_class == part_liq_class
+    aspirates = commands_of(plan, 'aspirate')
+    assert len(aspirates) == 1
+    assert aspirates[0][2] == [220]*8
+    assert [final for _, _, _, final in commands_of(plan, 'dispense')] == [False, False]
+    returns = commands_of(plan, 'return')
+    assert len(returns) == 1 and returns[0][3]
+    assert returns[0][1] == aspirates[0][1] and returns[0][2] == [20]*8 # the excess goes back
+    assert dispensed(plan) == {(turbs, i): 100 for i in range(16)}
+
+def test_multi_dispense_plan_splits_segments_at_tip_capacity():
+    transfers = transfers_for([300]*24, source_idxs=list(range(8))*3)
+    plan = multi_dispense_plan(transfers, tip_capacity=700, excess_vol=20)
+    aspirates = commands_of(plan, 'aspirate')
+    assert [vols for _, _, vols, _ in aspirates] == [[620]*8, [320]*8]
+    assert all(max(vols) <= 700 for _, _, vols, _ in aspirates)
+    assert [kind for kind, _, _, _ in plan.commands if kind != 'pickup'] == [
+            'aspirate', 'dispense', 'dispense', 'return', 'aspirate', 'dispense', 'return', 'eject']
+    assert dispensed(plan) == {(turbs, i): 300 for i in range(24)}
+
+def test_multi_dispense_plan_short_last_batch():
+    plan = multi_dispense_plan(transfers_for([100]*10, source_idxs=list(range(8)) + [0, 1]), excess_vol=20)
+    assert commands_of(plan, 'aspirate')[0][2] == [220, 220] + [120]*6
+    assert commands_of(plan, 'dispense')[1][2] == [100, 100] + [None]*6
+
+def test_multi_dispense_plan_without_excess_empties_on_the_last_part():
+    plan = multi_dispense_plan(transfers_for([100]*16, source_idxs=list(range(8))*2), excess_vol=0)
+    assert not commands_of(plan, 'return')
+    assert [final for _, _, _, final in commands_of(plan, 'dispense')] == [False, True]
+
+def test_multi_dispense_plan_none_when_a_volume_overfills_a_tip():
+    assert multi_dispense_plan(transfers_for([970]), tip_capacity=985, excess_vol=20) is None
+    assert multi_dispense_plan([]) is None
+
+def test_channels_in_order():
+    assert channels_in_order([(turbs, 0), (turbs, 1), None, (turbs, 3)])
+    assert channels_in_order([(turbs, 8), (media, 0), (turbs, 1)]) # different columns and labware
+    assert not channels_in_order([(turbs, 1), (turbs, 0)])
+    assert not channels_in_order([(turbs, 2), (turbs, 2)])
+
+def test_plan_transfers_picks_multi_dispense_when_shared():
+    transfers = transfers_for([100]*16, source_idxs=list(range(8))*2)
+    assert plan_transfers(transfers, shared_tips=True).strategy == 'multi_dispense'
+    assert plan_transfers(transfers).strategy in ('chunked', 'grouped')
+
+def test_plan_transfers_skips_plans_with_invalid_geometry():
+    # in order the first batch's targets run backwards down a column; grouped by passes they don't
+    volumes = [1500] + [100]*8
+    plan = plan_transfers(transfers_for(volumes, target_idxs=[1, 0, 2, 3, 4, 5, 6, 7, 8]))
+    assert not chunked_plan(transfers_for(volumes, target_idxs=[1, 0, 2, 3, 4, 5, 6, 7, 8])).valid()
+    assert plan.strategy == 'grouped' and plan.valid()
+
+def test_plan_transfers_falls_back_on_chunked():
+    transfers = transfers_for([100]*2, target_idxs=[1, 0])
+    plan = plan_transfers(transfers)
+    assert plan.strategy == 'fallback'
+    assert commands_of(plan, 'dispense')[0][1] == [(turbs, 1), (turbs, 0)]
+    assert plan.predicted_duration is not None
+
+def recording_senders(sent):
+    def sender(kind):
+        def send(ham_int, poss, vols=None, **options):
+            sent.append((kind, poss, vols, options))
+        return send
+    return {kind: sender(kind) for kind in ('pickup', 'eject', 'aspirate', 'dispense')}
+
+def test_run_plan_options_for_each_kind_of_dispense():
+    sent = []
+    plan = multi_dispense_plan(transfers_for([100]*16, source_idxs=list(range(8))*2), excess_vol=20)
+    run_plan(None, plan, aspirate_options={'liquidHeight': 1},
+            dispense_options={'liquidHeight': 11, 'dispenseMode': 9},
+            partial_dispense_options={'liquidHeight': 11, 'dispenseMode': 0}, senders=recording_senders(sent))
+    assert [kind for kind, _, _, _ in sent] == ['pickup', 'aspirate', 'dispense', 'dispense', 'dispense', 'eject']
+    assert sent[1][3] == {'liquidHeight': 1, 'liquid_class': part_liq_class}
+    assert sent[2][3] == sent[3][3] == {'liquidHeight': 11, 'dispenseMode': 0, 'liquid_class': part_liq_class}
+    returned = sent[4]
+    assert returned[1] == [(media, i) for i in range(8)]
+    assert returned[3] == {'liquidHeight': 1, 'liquid_class': part_liq_class} # the source's height, not the targets'
+
+    sent.clear()
+    run_plan(None, plan, aspirate_options={'liquidHeight': 1}, return_options={'liquidHeight': 3, 'dispenseMode': 9},
+            senders=recording_senders(sent))
+    assert sent[4][3] == {'liquidHeight': 3, 'dispenseMode': 9, 'liquid_class': part_liq_class}
+
+def test_run_plan_leaves_the_default_liquid_class_to_the_wrappers():
+    sent = []
+    run_plan(None, chunked_plan(transfers_for([100, 100])), dispense_options={'dispenseMode': 9},
+            senders=recording_senders(sent))
+    assert [options for _, _, _, options in sent] == [{}, {}, {'dispenseMode': 9}, {}]
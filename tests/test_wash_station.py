@@ -0,0 +1,48 @@
+from wash_station import WashChamber, WashStation
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def make_station(clock):
+    return WashStation([WashChamber('bleach', 1000.0, min_strength=.5, max_age=100),
+                        WashChamber('rinse', 1000.0, max_uses=2)], clock)
+
+def test_needs_refill_until_first_filled():
+    clock = Clock()
+    station = make_station(clock)
+    assert station.needs_refill()
+    station.refill(lambda: setattr(clock, 'now', clock.now + 5))
+    assert not station.needs_refill()
+    assert station.stats() == {'refills': 1, 'refill_seconds': 5.0, 'washes': 0}
+
+def test_spent_by_waste_uses_and_age():
+    clock = Clock()
+    station = make_station(clock)
+    station.refill(lambda: None)
+    assert station.needs_refill({'bleach': (0, 1500.0)}) # would dilute below half strength
+    station.add_waste('bleach', 500.0)
+    assert not station.needs_refill()
+    assert station.needs_refill({'bleach': (0, 400.0)})
+    station.refill(lambda: None)
+    station.wash('bleach', 'rinse')
+    station.wash('rinse')
+    assert not station.needs_refill()
+    assert station.needs_refill({'rinse': (1, 0.0)})
+    station.refill(lambda: None)
+    clock.now = 101
+    assert station.needs_refill()
+
+def test_state_and_restore():
+    clock = Clock()
+    station = make_station(clock)
+    station.refill(lambda: None)
+    station.wash('rinse')
+    station.add_waste('bleach', 1000.0)
+    restored = make_station(clock)
+    restored.restore(station.state())
+    assert restored.state() == station.state()
+    assert restored.chambers['bleach'].strength == .5
+    assert restored.chambers['rinse'].uses == 1